@@ -0,0 +1,523 @@
+import ast
+import gzip
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import deque
+
+def is_terminal(target):
+    isatty = getattr(target, 'isatty', None)
+    try:
+        return bool(isatty and isatty())
+    except (OSError, ValueError):   # Closed or detached stream
+        return False
+
+class ConsoleDevice:
+    """Console output device (port 0x9000) with batched host writes"""
+    def __init__(self, target=None, buffer_size=4096, line_threshold=None, capture=False):
+        # target: None (stdout), a file object, or a callable taking bytes
+        self.target = target if target is not None else sys.stdout
+        self.buffer_size = buffer_size
+        if line_threshold is None:
+            # Flush per line only for a terminal someone is watching
+            line_threshold = 1 if is_terminal(self.target) else 0
+        self.line_threshold = line_threshold  # 0 = don't flush on newlines
+        self.capture = capture
+
+        self.buffer = bytearray()
+        self.pending_lines = 0
+        self.captured = bytearray()
+        self.host_writes = 0
+
+    def write_char(self, char):
+        """Queue a single character"""
+        self.buffer.append(char & 0xFF)
+        if char == 10:
+            self.pending_lines += 1
+            if self.line_threshold and self.pending_lines >= self.line_threshold:
+                self.flush()
+                return
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_bytes(self, data):
+        """Queue a block of characters"""
+        self.buffer += data
+        if self.line_threshold:
+            self.pending_lines += data.count(10)
+            if self.pending_lines >= self.line_threshold:
+                self.flush()
+                return
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Hand the buffered output to the host in one write"""
+        self.pending_lines = 0
+        if not self.buffer:
+            return
+        data = bytes(self.buffer)
+        self.buffer.clear()
+
+        if self.capture:
+            self.captured += data
+            return
+
+        self.host_writes += 1
+        if callable(self.target) and not hasattr(self.target, 'write'):
+            self.target(data)
+            return
+
+        stream = getattr(self.target, 'buffer', None)
+        if stream is not None:
+            # Text stream with an underlying binary buffer
+            self.target.flush()
+            stream.write(data)
+            stream.flush()
+        else:
+            try:
+                self.target.write(data)
+            except TypeError:
+                # Text-only stream
+                self.target.write(data.decode('latin-1'))
+            self.target.flush()
+
+    def getvalue(self):
+        """Return everything captured so far (capture mode)"""
+        self.flush()
+        return self.captured.decode('latin-1')
+
+    def close(self):
+        self.flush()
+
+class TimerDevice:
+    """Host millisecond timer (port 0x9002)"""
+    def __init__(self):
+        self.start = time.monotonic()
+
+    def read(self):
+        return int((time.monotonic() - self.start) * 1000) & 0xFFFF
+
+SECTOR_SIZE = 512   # Words per disk sector
+
+class DiskDevice:
+    """Sparse disk for INT 0x04; sectors never written read as zeros"""
+    def __init__(self, sectors=2880):
+        self.sectors = sectors
+        self.data = {}
+
+    def read_sector(self, sector):
+        if not 0 <= sector < self.sectors:
+            raise ValueError(f"Invalid disk sector: {sector}")
+        return self.data.get(sector) or [0] * SECTOR_SIZE
+
+    def write_sector(self, sector, words):
+        if not 0 <= sector < self.sectors:
+            raise ValueError(f"Invalid disk sector: {sector}")
+        self.data[sector] = list(words)
+
+    def fork(self):
+        """Disk sharing this one's sectors; writes on either side replace, never modify, a sector"""
+        disk = DiskDevice(self.sectors)
+        disk.data = dict(self.data)
+        return disk
+
+# Key names accepted in keyboard scripts (same codes as the pygame handler)
+KEY_NAMES = {
+    'ENTER': (13, 10), 'BACKSPACE': (8,), 'ESC': (27,), 'TAB': (9,),
+    'UP': (0x48,), 'DOWN': (0x50,), 'LEFT': (0x4B,), 'RIGHT': (0x4D,),
+}
+
+KEY_TOKEN = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|\S+')
+
+def parse_keys(token):
+    """Key codes for one script token: a quoted string, a number or a key name"""
+    if token[0] in '"\'':
+        return [ord(char) for char in ast.literal_eval(token)]
+    if token.upper() in KEY_NAMES:
+        return list(KEY_NAMES[token.upper()])
+    return [int(token, 0)]
+
+class ScriptedKeyboard:
+    """Keyboard input replayed from a script at fixed instruction counts
+
+    Script lines are "<cycle> <keys>...", where keys are quoted strings
+    (Python escapes allowed), numbers or names from KEY_NAMES; # starts a
+    comment. Keys are placed in the BDA buffer when the guest next asks for
+    keyboard input at or after their cycle, so delivery depends only on
+    the instruction count and not on host speed.
+    """
+    def __init__(self, events=()):
+        self.events = deque(sorted(events, key=lambda event: event[0]))
+
+    @classmethod
+    def parse(cls, text):
+        events = []
+        for number, line in enumerate(text.splitlines(), 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            tokens = KEY_TOKEN.findall(line)
+            try:
+                cycle = int(tokens[0], 0)
+                for token in tokens[1:]:
+                    if token.startswith('#'):
+                        break
+                    events.extend((cycle, key) for key in parse_keys(token))
+            except (ValueError, SyntaxError) as error:
+                raise ValueError(f"Keyboard script line {number}: {error}") from None
+        return cls(events)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            return cls.parse(file.read())
+
+    def poll(self, machine):
+        """Deliver every key that is due at the current cycle"""
+        events = self.events
+        while events and events[0][0] <= machine.cycles:
+            machine.add_key_to_buffer(events.popleft()[1])
+
+    def wait(self, machine):
+        """The guest is blocked on input: deliver the next keys now"""
+        if not self.events:
+            return False
+        cycle = self.events[0][0]
+        while self.events and self.events[0][0] == cycle:
+            machine.add_key_to_buffer(self.events.popleft()[1])
+        return True
+
+class RingBuffer:
+    """Lock-free single-producer/single-consumer queue of 32-bit values
+
+    Lives in any writable buffer (a bytearray, or SharedMemory.buf to cross
+    processes): a head word written only by the consumer, a tail word
+    written only by the producer, then `capacity` slots. The producer fills
+    a slot before publishing the new tail and the consumer reads a slot
+    before publishing the new head; each of those is one aligned 32-bit
+    store, so neither side ever takes a lock. One slot is kept empty to tell
+    a full ring from an empty one.
+    """
+    def __init__(self, buffer, capacity=256):
+        self.capacity = capacity
+        self.words = memoryview(buffer)[:self.size(capacity)].cast('I')
+
+    @staticmethod
+    def size(capacity):
+        """Bytes of buffer a ring of this capacity needs"""
+        return (2 + capacity) * 4
+
+    def push(self, value):
+        """Producer side; False if the ring is full"""
+        words = self.words
+        tail = words[1]
+        next_tail = tail + 1 if tail + 1 < self.capacity else 0
+        if next_tail == words[0]:
+            return False
+        words[2 + tail] = value & 0xFFFFFFFF
+        words[1] = next_tail
+        return True
+
+    def pop(self):
+        """Consumer side; None if the ring is empty"""
+        words = self.words
+        head = words[0]
+        if head == words[1]:
+            return None
+        value = words[2 + head]
+        words[0] = head + 1 if head + 1 < self.capacity else 0
+        return value
+
+    def drain(self, limit=None):
+        """Consumer side: everything queued so far, or at most limit values"""
+        values = []
+        while limit is None or len(values) < limit:
+            value = self.pop()
+            if value is None:
+                break
+            values.append(value)
+        return values
+
+    def __len__(self):
+        return (self.words[1] - self.words[0]) % self.capacity
+
+    def release(self):
+        """Drop the view of the buffer (required before closing shared memory)"""
+        self.words.release()
+
+class ThreadedKeyboard:
+    """Keyboard fed by a host input thread through a RingBuffer
+
+    A daemon thread reads keys from `source` (any iterable that blocks until
+    the next key, e.g. TerminalKeys or timed_keys) and pushes them onto a
+    single-producer/single-consumer ring, independently of the CPU loop.
+    The machine drains the ring into the BDA keyboard buffer whenever the
+    guest reads the keyboard (INT 0x02, ports 0x9004/0x9005), so an idle
+    keyboard costs one comparison per read. Only as many keys as the BDA
+    buffer has room for leave the ring; keys arriving while the ring is full
+    are dropped and counted.
+
+    With source=None there is no thread and the pygame display loop is the
+    producer (SDL delivers window events only to the thread that owns the
+    window): handle_pygame_events pushes into the ring instead.
+    """
+    def __init__(self, source=None, capacity=256):
+        self.ring = RingBuffer(bytearray(RingBuffer.size(capacity)), capacity)
+        self.ready = threading.Event()
+        self.source = source
+        self.finished = source is None
+        self.dropped = 0
+        self.thread = None
+        if source is not None:
+            self.thread = threading.Thread(target=self.produce, name="keyboard", daemon=True)
+            self.thread.start()
+
+    def produce(self):
+        try:
+            for key in self.source:
+                self.push(key)
+        finally:
+            self.finished = True
+            self.ready.set()
+
+    def push(self, key):
+        """Producer side: queue a key for the guest"""
+        if self.ring.push(key):
+            self.ready.set()
+        else:
+            self.dropped += 1
+
+    def poll(self, machine):
+        """Move queued keys into the BDA keyboard buffer; the rest wait in the ring"""
+        words = self.ring.words
+        if words[0] != words[1]:
+            keys = self.ring.drain(machine.keyboard_buffer_space())
+            self.dropped += len(keys) - machine.add_keys_to_buffer(keys)
+
+    def wait(self, machine):
+        """The guest is blocked on input: sleep until the thread delivers a key"""
+        while not len(self.ring):
+            if self.finished:
+                return False
+            self.ready.wait(0.1)
+            self.ready.clear()
+        self.poll(machine)
+        return True
+
+    def close(self):
+        """Stop the source if it can be stopped (e.g. restore the terminal)"""
+        close = getattr(self.source, 'close', None)
+        if close is not None:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Terminal input bytes with guest codes other than themselves (ANSI arrows, Enter, Delete)
+TERMINAL_KEYS = {
+    b'\x1b[A': (0x48,), b'\x1b[B': (0x50,), b'\x1b[C': (0x4D,), b'\x1b[D': (0x4B,),
+    b'\r': (13, 10), b'\n': (13, 10), b'\x7f': (8,),
+}
+TERMINAL_TOKEN = re.compile(rb'\x1b\[[A-D]|.', re.S)
+
+class TerminalKeys:
+    """Key source reading a terminal (or pipe) byte by byte, in cbreak mode on a tty"""
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdin
+        self.saved = None
+
+    def __iter__(self):
+        fd = self.stream.fileno()
+        if os.isatty(fd):
+            import termios
+            import tty
+            self.saved = (fd, termios.tcgetattr(fd))
+            tty.setcbreak(fd)   # Unbuffered and unechoed; Ctrl-C still interrupts
+        try:
+            while data := os.read(fd, 64):
+                for token in TERMINAL_TOKEN.findall(data):
+                    yield from TERMINAL_KEYS.get(token, token)
+        finally:
+            self.close()
+
+    def close(self):
+        """Restore the terminal settings"""
+        if self.saved is not None:
+            import termios
+            fd, attributes = self.saved
+            self.saved = None
+            termios.tcsetattr(fd, termios.TCSADRAIN, attributes)
+
+def timed_keys(events, speed=1.0):
+    """Key source replaying (seconds, key) events in real time"""
+    start = time.monotonic()
+    for at, key in events:
+        delay = start + at / speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        yield key
+
+# I/O log event kinds
+IO_CONSOLE = 0      # payload = bytes written to the console
+IO_KEY = 1          # value = key placed in the keyboard buffer
+IO_TIMER = 2        # value = timer reading
+IO_DISK_READ = 3    # value = sector, payload = sector words
+IO_DISK_WRITE = 4   # value = sector, payload = sector words
+
+IO_NAMES = {IO_CONSOLE: "console", IO_KEY: "key", IO_TIMER: "timer",
+            IO_DISK_READ: "disk read", IO_DISK_WRITE: "disk write"}
+
+LOG_MAGIC = b'SCIO\x01'
+LOG_RECORD = struct.Struct('<BQII')    # kind, cycle, value, payload length
+
+def pack_words(words):
+    return array('I', [word & 0xFFFFFFFF for word in words]).tobytes()
+
+def unpack_words(payload):
+    return array('I', payload).tolist()
+
+class IORecorder:
+    """Records all device I/O of a session to a compact binary log
+
+    Attach with machine.recorder = IORecorder(path). Each event is a fixed
+    17-byte header (kind, cycle, value, payload length) plus its payload;
+    consecutive console output is coalesced into one event, and logs written
+    to a path are gzip-compressed.
+    """
+    def __init__(self, target):
+        if isinstance(target, (str, os.PathLike)):
+            self.file = gzip.open(target, 'wb')
+            self.owns_file = True
+        else:
+            self.file = target
+            self.owns_file = False
+        self.file.write(LOG_MAGIC)
+        self.events = 0
+        self.console_cycle = 0
+        self.console_data = bytearray()
+
+    def record(self, kind, cycle, value=0, payload=b''):
+        if kind == IO_CONSOLE:
+            if not self.console_data:
+                self.console_cycle = cycle
+            self.console_data += payload
+            return
+        self.flush_console()
+        self.write(kind, cycle, value, payload)
+
+    def write(self, kind, cycle, value, payload):
+        self.file.write(LOG_RECORD.pack(kind, cycle, value & 0xFFFFFFFF, len(payload)))
+        self.file.write(payload)
+        self.events += 1
+
+    def flush_console(self):
+        if self.console_data:
+            self.write(IO_CONSOLE, self.console_cycle, 0, bytes(self.console_data))
+            self.console_data.clear()
+
+    def close(self):
+        self.flush_console()
+        if self.owns_file:
+            self.file.close()
+        else:
+            self.file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_io_log(source):
+    """Parse a log written by IORecorder into (kind, cycle, value, payload) tuples"""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as file:
+            data = file.read()
+    elif isinstance(source, (bytes, bytearray)):
+        data = bytes(source)
+    else:
+        data = source.read()
+    if data[:2] == b'\x1f\x8b':
+        data = gzip.decompress(data)
+    if not data.startswith(LOG_MAGIC):
+        raise ValueError("Not an I/O log")
+
+    events = []
+    offset = len(LOG_MAGIC)
+    while offset < len(data):
+        kind, cycle, value, length = LOG_RECORD.unpack_from(data, offset)
+        offset += LOG_RECORD.size
+        events.append((kind, cycle, value, data[offset:offset + length]))
+        offset += length
+    return events
+
+class ReplayError(Exception):
+    """The replayed guest asked for input the log does not contain"""
+
+class ReplayTimer:
+    """Timer that returns recorded readings in order"""
+    def __init__(self, values):
+        self.values = deque(values)
+
+    def read(self):
+        if not self.values:
+            raise ReplayError("Timer read past the end of the log")
+        return self.values.popleft()
+
+class ReplayDisk(DiskDevice):
+    """Disk whose reads return the recorded sector contents in order"""
+    def __init__(self, reads):
+        super().__init__()
+        self.reads = deque(reads)
+
+    def read_sector(self, sector):
+        if not self.reads:
+            raise ReplayError("Disk read past the end of the log")
+        recorded, words = self.reads.popleft()
+        if recorded != sector:
+            raise ReplayError(f"Disk read of sector {sector}, log has sector {recorded}")
+        return words
+
+class IOReplay:
+    """Input devices that reproduce a recorded session exactly
+
+    Keys re-enter the keyboard buffer at their recorded cycles, and timer
+    readings and disk sectors are returned in recorded order, so a guest
+    that only takes input through these devices follows the same path.
+    The recorded console output is kept for comparison.
+    """
+    def __init__(self, events):
+        self.keyboard = ScriptedKeyboard(
+            (cycle, value) for kind, cycle, value, _ in events if kind == IO_KEY)
+        self.timer = ReplayTimer(value for kind, _, value, _ in events if kind == IO_TIMER)
+        self.disk = ReplayDisk((value, unpack_words(payload))
+                               for kind, _, value, payload in events if kind == IO_DISK_READ)
+        self.console = b''.join(payload for kind, _, _, payload in events if kind == IO_CONSOLE)
+
+    @classmethod
+    def load(cls, source):
+        return cls(read_io_log(source))
+
+    def attach(self, machine):
+        machine.keyboard = self.keyboard
+        machine.timer = self.timer
+        machine.disk = self.disk
+
+    def console_mismatch(self, output):
+        """Offset of the first difference from the recorded console output, or None"""
+        if isinstance(output, str):
+            output = output.encode('latin-1')
+        for offset, (expected, actual) in enumerate(zip(self.console, output)):
+            if expected != actual:
+                return offset
+        if len(output) != len(self.console):
+            return min(len(output), len(self.console))
+        return None
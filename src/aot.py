@@ -0,0 +1,458 @@
+import importlib.util
+import os
+import py_compile
+import sys
+
+from engine import decode
+
+# Opcodes compiled inline; everything else ends the block and runs through cpu.execute()
+RR_INLINE = {0x00, 0x02, 0x03, 0x04, 0x10, 0x11, 0x12, 0x13, 0x14, 0x15, 0x16, 0x17,
+             0x18, 0x1A, 0x1D, 0x1E, 0x23, 0x24, 0x26, 0x32, 0x33}
+RI_INLINE = {0x00, 0x10, 0x11, 0x12, 0x13, 0x14, 0x15, 0x16, 0x17, 0x18, 0x19, 0x1A,
+             0x1B, 0x1C, 0x1D, 0x1E, 0x23, 0x24, 0x26, 0x32, 0x33}
+RM_INLINE = {0x00, 0x01, 0x10, 0x11, 0x12, 0x13, 0x14, 0x15, 0x16, 0x17, 0x18, 0x19,
+             0x1A, 0x1B, 0x1C, 0x20, 0x22, 0x23}
+RCM_INLINE = {0x20, 0x21, 0x22, 0x27}
+
+ALU_OPS = {0x10: '+', 0x11: '-', 0x12: '*', 0x14: '&', 0x15: '|', 0x16: '^'}
+
+def is_inline(d):
+    return d[1] in (RR_INLINE, RI_INLINE, RM_INLINE, RCM_INLINE)[d[0]]
+
+def ends_block(d):
+    """Instructions after which control may not fall through"""
+    format, opcode = d[0], d[1]
+    if not is_inline(d):
+        return True
+    if format in (0b00, 0b01):
+        return opcode == 0x24                   # RET
+    if format == 0b10:
+        return opcode in (0x20, 0x22)           # JMP, JSR
+    return True                                 # Every RCM instruction branches
+
+def direct_targets(d):
+    """Statically known branch targets of an instruction"""
+    format, opcode = d[0], d[1]
+    if format == 0b11 and opcode in RCM_INLINE:
+        return [d[4]]
+    if format == 0b10 and opcode in (0x20, 0x22) and d[3] == 0b00:
+        return [d[4] & 0xFFFF]
+    return []
+
+def find_blocks(image, base):
+    """Leader addresses of the basic blocks of an image"""
+    end = base + len(image)
+    leaders = {base}
+    for offset, word in enumerate(image):
+        d = decode(word)
+        if ends_block(d) or (d[0] == 0b10 and d[1] == 0x22):
+            leaders.add(base + offset + 1)
+        for target in direct_targets(d):
+            leaders.add(target)
+    return sorted(address for address in leaders if base <= address < end)
+
+class BlockCompiler:
+    """Generates the Python function for one basic block"""
+    def __init__(self, start):
+        self.start = start
+        self.lines = []
+        self.used = set()       # Registers loaded into locals
+        self.written = set()    # Registers to store back
+        self.flags = False      # fv holds the value of the last flag update
+        self.uses_flags = False
+        self.fallible = False
+
+    def reg(self, index):
+        self.used.add(index)
+        return f"r{index}"
+
+    def set_reg(self, index, expression):
+        self.used.add(index)
+        self.written.add(index)
+        self.emit(f"r{index} = {expression}")
+
+    def emit(self, line):
+        self.lines.append("        " + line)
+
+    def at(self, address):
+        """Mark address as the instruction that may fault next"""
+        self.fallible = True
+        self.emit(f"ip = {address:#06x}")
+
+    def set_flags(self, expression):
+        self.uses_flags = True
+        self.flags = True
+        self.emit(f"fv = {expression}")
+
+    def flag_terms(self):
+        if self.flags:
+            return "((fv & 0xFFFF) == 0)", "((fv & 0x8000) != 0)"
+        return "m.zf", "m.sf"
+
+    def address(self, d):
+        mode, field = d[3], d[4]
+        if mode == 0b00:
+            return f"{field & 0xFFFF:#06x}"
+        if mode == 0b01:
+            return f"({self.reg(8 + ((field >> 14) & 0b11))} + {(field >> 10) & 0b1111})"
+        if mode == 0b10:
+            return f"({(field >> 4) & 0xFFF:#05x} + {self.reg(field & 0b1111)})"
+        return f"({self.reg(8 + ((field >> 14) & 0b11))} + {self.reg((field >> 10) & 0b1111)})"
+
+    def push(self, address, value):
+        self.at(address)
+        self.emit(f"sp = ({self.reg(7)} - 1) & 0xFFFF")
+        self.emit("if sp < m.stack_limit:")
+        self.emit("    raise CPUTrap(TRAP_STACK_FAULT, 'stack overflow')")
+        self.emit(f"mem[sp] = {value} & 0xFFFF")
+        self.set_reg(7, "sp")
+
+    def pop(self, address, target):
+        """Pop into the local `target` (assigned after SP moves, as cpu.pop does)"""
+        self.at(address)
+        self.emit(f"v = mem[{self.reg(7)}]")
+        self.set_reg(7, f"({self.reg(7)} + 1) & 0xFFFF")
+        self.emit(f"{target} = v")
+
+    def alu(self, rd, left, opcode, right):
+        result = f"{left} {ALU_OPS[opcode]} {right}"
+        self.set_flags(result)
+        self.set_reg(rd, "fv & 0xFFFF")
+
+    def compile(self, address, d):
+        """Emit one inline instruction; returns the next-PC expression if it branches"""
+        format, opcode = d[0], d[1]
+        next_pc = f"{address + 1:#06x}"
+        self.emit(f"# {address:#06x}: {('RR', 'RI', 'RM', 'RCM')[format]} {opcode:#04x}")
+
+        if format == 0b00:
+            rd, rs1, rs2 = d[2], d[3], d[4]
+            match opcode:
+                case 0x00:
+                    self.set_reg(rd, self.reg(rs1))
+                case 0x02:
+                    self.push(address, self.reg(rd))
+                case 0x03:
+                    self.pop(address, self.reg(rd))
+                    self.written.add(rd)
+                case 0x04:
+                    self.emit(f"{self.reg(rd)}, {self.reg(rs1)} = {self.reg(rs1)}, {self.reg(rd)}")
+                    self.written.update((rd, rs1))
+                case 0x10 | 0x11 | 0x12 | 0x14 | 0x15 | 0x16:
+                    self.alu(rd, self.reg(rs1), opcode, self.reg(rs2))
+                case 0x13:
+                    self.at(address)
+                    self.emit(f"if {self.reg(rs2)} == 0:")
+                    self.emit("    raise CPUTrap(TRAP_DIVIDE_ERROR)")
+                    self.set_flags(f"{self.reg(rs1)} // {self.reg(rs2)}")
+                    self.set_reg(rd, "fv & 0xFFFF")
+                case 0x17:
+                    self.set_flags(f"~{self.reg(rs1)}")
+                    self.set_reg(rd, "fv & 0xFFFF")
+                case 0x18:
+                    self.set_flags(f"{self.reg(rs1)} << {self.reg(rs2)}")
+                    self.set_reg(rd, "fv & 0xFFFF")
+                case 0x1A:
+                    self.set_flags(f"{self.reg(rs1)} >> {self.reg(rs2)}")
+                    self.set_reg(rd, "fv & 0xFFFF")
+                case 0x1D | 0x1E:
+                    sign = '+' if opcode == 0x1D else '-'
+                    self.set_reg(rd, f"({self.reg(rd)} {sign} 1) & 0xFFFF")
+                    self.set_flags(self.reg(rd))
+                case 0x23:
+                    self.set_flags(f"{self.reg(rd)} - {self.reg(rs1)}")
+                case 0x24:
+                    self.pop(address, "target")
+                    return "target"
+                case 0x26:
+                    pass
+                case 0x32 | 0x33:
+                    self.emit(f"m.ie = {opcode == 0x32}")
+            return None
+
+        if format == 0b01:
+            rd, imm = d[2], d[3]
+            match opcode:
+                case 0x00:
+                    self.set_reg(rd, f"{imm & 0xFFFF:#x}")
+                case 0x10 | 0x11 | 0x12 | 0x14 | 0x15 | 0x16:
+                    self.alu(rd, self.reg(rd), opcode, f"{imm:#x}")
+                case 0x13:
+                    if imm == 0:
+                        self.at(address)
+                        self.emit("raise CPUTrap(TRAP_DIVIDE_ERROR)")
+                    else:
+                        self.set_flags(f"{self.reg(rd)} // {imm:#x}")
+                        self.set_reg(rd, "fv & 0xFFFF")
+                case 0x17:
+                    self.set_flags(f"{~imm}")
+                    self.set_reg(rd, "fv & 0xFFFF")
+                case 0x18 | 0x19:
+                    self.set_flags(f"{self.reg(rd)} {'<<' if opcode == 0x18 else '>>'} {imm & 0xF}")
+                    self.set_reg(rd, "fv & 0xFFFF")
+                case 0x1A:
+                    shift = imm & 0xF
+                    self.set_flags(f"(({self.reg(rd)} >> {shift}) | {(0xFFFF << (16 - shift))}) "
+                                   f"if {self.reg(rd)} & 0x8000 else {self.reg(rd)} >> {shift}")
+                    self.set_reg(rd, "fv & 0xFFFF")
+                case 0x1B | 0x1C:
+                    shift = imm & 0xF
+                    first, second = ('<<', '>>') if opcode == 0x1B else ('>>', '<<')
+                    self.set_flags(f"(({self.reg(rd)} {first} {shift}) | "
+                                   f"({self.reg(rd)} {second} {16 - shift})) & 0xFFFF")
+                    self.set_reg(rd, "fv")
+                case 0x1D | 0x1E:
+                    self.set_flags(f"{self.reg(rd)} {'+' if opcode == 0x1D else '-'} 1")
+                    self.set_reg(rd, "fv & 0xFFFF")
+                case 0x23:
+                    self.set_flags(f"{self.reg(rd)} - {imm:#x}")
+                case 0x24:
+                    self.pop(address, "target")
+                    return "target"
+                case 0x26:
+                    pass
+                case 0x32 | 0x33:
+                    self.emit(f"m.ie = {opcode == 0x32}")
+            return None
+
+        if format == 0b10:
+            rd = d[2]
+            operand = self.address(d)
+            match opcode:
+                case 0x00:
+                    self.at(address)
+                    self.set_reg(rd, f"mem[{operand}]")
+                case 0x01:
+                    self.at(address)
+                    self.emit(f"mem[{operand}] = {self.reg(rd)}")
+                case 0x10 | 0x11 | 0x12:
+                    self.at(address)
+                    self.alu(rd, self.reg(rd), opcode, f"mem[{operand}]")
+                case 0x13:
+                    self.at(address)
+                    self.emit(f"v = mem[{operand}]")
+                    self.emit("if v == 0:")
+                    self.emit("    raise CPUTrap(TRAP_DIVIDE_ERROR)")
+                    self.set_flags(f"{self.reg(rd)} // v")
+                    self.set_reg(rd, "fv & 0xFFFF")
+                case 0x14 | 0x15 | 0x16:
+                    self.at(address)
+                    self.set_flags(f"{self.reg(rd)} {ALU_OPS[opcode]} mem[{operand}]")
+                    self.set_reg(rd, "fv")
+                case 0x17:
+                    self.at(address)
+                    self.set_flags(f"~mem[{operand}]")
+                    self.set_reg(rd, "fv & 0xFFFF")
+                case 0x18 | 0x19:
+                    self.at(address)
+                    direction = '<<' if opcode == 0x18 else '>>'
+                    self.set_flags(f"{self.reg(rd)} {direction} (mem[{operand}] & 0xF)")
+                    self.set_reg(rd, "fv & 0xFFFF")
+                case 0x1A:
+                    self.at(address)
+                    self.emit(f"s = mem[{operand}] & 0xF")
+                    self.set_flags(f"(({self.reg(rd)} >> s) | (0xFFFF << (16 - s))) "
+                                   f"if {self.reg(rd)} & 0x8000 else {self.reg(rd)} >> s")
+                    self.set_reg(rd, "fv & 0xFFFF")
+                case 0x1B | 0x1C:
+                    self.at(address)
+                    self.emit(f"s = mem[{operand}] & 0xF")
+                    first, second = ('<<', '>>') if opcode == 0x1B else ('>>', '<<')
+                    self.set_flags(f"(({self.reg(rd)} {first} s) | "
+                                   f"({self.reg(rd)} {second} (16 - s))) & 0xFFFF")
+                    self.set_reg(rd, "fv")
+                case 0x20:
+                    return f"{operand} & 0xFFFF"
+                case 0x22:
+                    self.emit(f"target = {operand} & 0xFFFF")
+                    self.push(address, next_pc)
+                    return "target"
+                case 0x23:
+                    self.at(address)
+                    self.set_flags(f"{self.reg(rd)} - mem[{operand}]")
+            return None
+
+        reg, condition, target = d[2], d[3], f"{d[4]:#06x}"
+        match opcode:
+            case 0x20:
+                return target
+            case 0x21:
+                value = self.reg(reg)
+                terms = [term for bit, term in ((0b100, f"{value} < 0"), (0b010, f"{value} == 0"),
+                                                (0b001, f"{value} > 0")) if condition & bit]
+                return f"{target} if ({' or '.join(terms) or 'False'}) else {next_pc}"
+            case 0x22:
+                self.push(address, next_pc)
+                return target
+            case 0x27:
+                zf, sf = self.flag_terms()
+                terms = [term for bit, term in ((0b100, sf), (0b010, zf),
+                                                (0b001, f"(not {sf} and not {zf})"))
+                         if condition & bit]
+                return f"{target} if ({' or '.join(terms) or 'False'}) else {next_pc}"
+
+    def writeback(self, indent="        "):
+        lines = [f"{indent}regs[{index}] = r{index}" for index in sorted(self.written)]
+        if self.flags:
+            lines.append(f"{indent}m.zf = (fv & 0xFFFF) == 0")
+            lines.append(f"{indent}m.sf = (fv & 0x8000) != 0")
+            lines.append(f"{indent}m.cf = fv > 0xFFFF or fv < 0")
+        return lines
+
+def compile_block(image, base, start, leaders):
+    """Python source of the function for the block starting at `start`"""
+    block = BlockCompiler(start)
+    end = base + len(image)
+    address = start
+    next_pc = None
+    slow = None
+    while address < end:
+        d = decode(image[address - base])
+        if not is_inline(d):
+            slow = (address, image[address - base])
+            break
+        next_pc = block.compile(address, d)
+        address += 1
+        if next_pc is not None or ends_block(d) or address in leaders:
+            break
+    count = address - start
+    if next_pc is None:
+        next_pc = f"{address:#06x}"
+
+    lines = [f"def block_{start:04x}(m):"]
+    lines.append("    regs = m.regs")
+    lines.append("    mem = m.mem")
+    if block.used:
+        lines.append("    " + ", ".join(f"r{index}" for index in sorted(block.used)) + " = "
+                     + ", ".join(f"regs[{index}]" for index in sorted(block.used)))
+    if block.flags:
+        lines.append("    fv = None")
+    if block.fallible:
+        # Precise faults: store the state before the faulting instruction and re-raise
+        lines.append("    try:")
+        lines.extend(block.lines)
+        lines.append("    except Exception:")
+        lines.extend(line for line in block.writeback() if not line.strip().startswith("m."))
+        if block.flags:
+            lines.append("        if fv is not None:")
+            lines.extend(block.writeback("            ")[len(block.written):])
+        lines.append("        m.pc = ip + 1")
+        lines.append(f"        m.cycles += ip - {start:#06x}")
+        lines.append("        raise")
+    else:
+        lines.extend(line[4:] for line in block.lines)
+    if count:
+        lines.append(f"    next_pc = {next_pc}")
+    lines.extend(line[4:] for line in block.writeback())
+    if slow:
+        # Rare instruction: run it on the interpreter and continue wherever it leaves PC
+        address, word = slow
+        if count:
+            lines.append(f"    m.cycles += {count}")
+        lines.append(f"    m.pc = {address + 1:#06x}")
+        lines.append(f"    m.execute({word:#010x})")
+        lines.append("    m.cycles += 1")
+        lines.append("    return m.pc")
+    else:
+        lines.append(f"    m.cycles += {count}")
+        lines.append("    return next_pc")
+    return "\n".join(lines)
+
+RUNTIME = '''
+def run_for(m, count):
+    """Run about count instructions (a block may overshoot); returns instructions retired"""
+    blocks = BLOCKS
+    start = m.cycles
+    pc = m.pc
+    while m.run and m.cycles - start < count:
+        block = blocks.get(pc)
+        try:
+            if block is None:
+                # Not a block entry (e.g. a trap handler or a return into a block)
+                m.pc = pc
+                m.step()
+                pc = m.pc
+            else:
+                pc = block(m)
+        except (CPUTrap, IndexError) as error:
+            m.handle_fault(error)
+            pc = m.pc
+    m.pc = pc
+    return m.cycles - start
+
+def run(m):
+    """Run until HLT or an unhandled trap"""
+    while m.run:
+        run_for(m, 1 << 20)
+    m.console.flush()
+
+def load(m):
+    """Copy the compiled image into guest memory"""
+    m.mem[BASE:BASE + len(IMAGE)] = IMAGE
+'''
+
+def compile_image(image, base=0, name="program"):
+    """Python module source for an assembled, non-self-modifying image"""
+    leaders = set(find_blocks(image, base))
+    parts = [
+        f'"""Ahead-of-time compiled {name} ({len(image)} words at {base:#06x}); '
+        f'generated by aot.py"""',
+        "from cpu import CPUTrap, TRAP_DIVIDE_ERROR, TRAP_STACK_FAULT",
+        "",
+        f"BASE = {base:#06x}",
+        f"IMAGE = {tuple(image)!r}",
+    ]
+    for start in sorted(leaders):
+        parts.append("")
+        parts.append(compile_block(image, base, start, leaders))
+    parts.append("")
+    parts.append("BLOCKS = {" + ", ".join(f"{start:#06x}: block_{start:04x}"
+                                          for start in sorted(leaders)) + "}")
+    parts.append(RUNTIME)
+    return "\n".join(parts)
+
+def build(image, path, base=0):
+    """Write the compiled module to path and byte-compile it to __pycache__"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    with open(path, "w") as file:
+        file.write(compile_image(image, base, name))
+    py_compile.compile(path, doraise=True)
+    return load_module(path)
+
+def load_module(path):
+    """Import a compiled module from a file path"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def compile_module(image, base=0, name="program"):
+    """Compile an image straight into an in-memory module"""
+    module = type(sys)(name)
+    exec(compile(compile_image(image, base, name), f"<aot {name}>", "exec"), module.__dict__)
+    return module
+
+class CompiledEngine:
+    """Runs a cpu through an AOT-compiled module (drop-in for cosim.Lockstep)"""
+    def __init__(self, machine, module):
+        self.machine = machine
+        self.module = module
+
+    def __getattr__(self, name):
+        return getattr(self.machine, name)
+
+    def run_for(self, count):
+        return self.module.run_for(self.machine, count)
+
+    def run_continuous(self):
+        self.module.run(self.machine)
+
+if __name__ == '__main__':
+    # python aot.py program.asm program_aot.py
+    from codecache import CodeCache
+
+    with open(sys.argv[1]) as source:
+        image = CodeCache().assemble(source.read(), sys.argv[1])
+    build(image, sys.argv[2])
+    print(f"{sys.argv[2]}: {len(find_blocks(image, 0))} blocks from {len(image)} words")
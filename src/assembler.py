@@ -1,3 +1,50 @@
+from bisect import bisect_right
+import json
+
+class DebugMap:
+    """Address to source line and label mapping emitted by the assembler"""
+    def __init__(self, filename, lines, labels):
+        self.filename = filename
+        self.lines = lines      # lines[address] = 1-based source line number
+        # (start, end, name) sorted by start; a label covers up to the next label
+        ordered = sorted(labels.items(), key=lambda item: (item[1], item[0]))
+        self.labels = []
+        for index, (name, start) in enumerate(ordered):
+            end = ordered[index + 1][1] if index + 1 < len(ordered) else len(lines)
+            self.labels.append((start, max(end, start), name))
+        self.starts = [start for start, _, _ in self.labels]
+        self.addresses = dict(labels)
+
+    def line_for(self, address):
+        """(filename, line) that produced the word at address, or None"""
+        if 0 <= address < len(self.lines):
+            return self.filename, self.lines[address]
+        return None
+
+    def label_for(self, address):
+        """Innermost label whose range contains address, or None"""
+        index = bisect_right(self.starts, address) - 1
+        if index >= 0 and address < self.labels[index][1]:
+            return self.labels[index][2]
+        return None
+
+    def function_for(self, address):
+        """Label defined exactly at address (a call target), else the enclosing label"""
+        index = bisect_right(self.starts, address) - 1
+        if index >= 0 and self.starts[index] == address:
+            return self.labels[index][2]
+        return self.label_for(address)
+
+    def save(self, path):
+        with open(path, 'w') as file:
+            json.dump({'file': self.filename, 'lines': self.lines, 'labels': self.addresses}, file)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as file:
+            data = json.load(file)
+        return cls(data['file'], data['lines'], data['labels'])
+
 class Assembler:
     def __init__(self):
         self.registers = {
@@ -15,6 +62,7 @@ class Assembler:
         self.opcodes = {
             # Data manipulation
             'MOV': 0x00, 'STR': 0x01, 'PSH': 0x02, 'POP': 0x03, 'SWP': 0x04,
+            'TAS': 0x05, 'CAS': 0x06,
             # Math
             'ADD': 0x10, 'SUB': 0x11, 'MUL': 0x12, 'DIV': 0x13,
             'AND': 0x14, 'OR': 0x15, 'XOR': 0x16, 'NOT': 0x17,
@@ -24,15 +72,18 @@ class Assembler:
             'JMP': 0x20, 'JCR': 0x21, 'JSR': 0x22, 'CMP': 0x23, 'RET': 0x24, 
             'HLT': 0x25, 'NOP': 0x26, 'JCF': 0x27,
             # System
-            'INT': 0x30, 'RTI': 0x31, 'STI': 0x32, 'CLI': 0x33,
+            'INT': 0x30, 'RTI': 0x31, 'STI': 0x32, 'CLI': 0x33, 'IPI': 0x34,
         }
         
         self.labels = {}
         self.address = 0
+        self.line_numbers = []  # Source line of each preprocessed line
+        self.debug_map = None
     
-    def assemble(self, source_code):
-        """Assemble source code to machine code"""
+    def assemble(self, source_code, filename='<source>'):
+        """Assemble source code to machine code (the debug map is left in self.debug_map)"""
         lines = self.preprocess(source_code)
+        source_lines = []
         machine_code = []
         
         # First pass: collect labels
@@ -48,21 +99,24 @@ class Assembler:
         
         # Second pass: generate machine code
         self.address = 0
-        for line in lines:
+        for line, number in zip(lines, self.line_numbers):
             if not line.strip() or line.endswith(':'):
                 continue
                 
             instruction = self.assemble_line(line)
             if instruction is not None:
                 machine_code.append(instruction)
+                source_lines.append(number)
                 self.address += 1
         
+        self.debug_map = DebugMap(filename, source_lines, self.labels)
         return machine_code
     
     def preprocess(self, source_code):
-        """Remove comments and clean lines"""
+        """Remove comments and clean lines, remembering their line numbers"""
         lines = []
-        for line in source_code.split('\n'):
+        self.line_numbers = []
+        for number, line in enumerate(source_code.split('\n'), 1):
             # Remove comments
             if ';' in line:
                 line = line.split(';')[0]
@@ -70,6 +124,7 @@ class Assembler:
             line = line.strip()
             if line:
                 lines.append(line.upper())
+                self.line_numbers.append(number)
         return lines
     
     def assemble_line(self, line):
@@ -189,7 +244,14 @@ class Assembler:
             base = base.strip()
             offset = offset.strip()
             
-            if base.startswith('MP'):
+            if base.startswith('MP') and offset in self.registers:
+                # Mode 11: MP + register offset
+                mode = 0b11
+                mp_reg = self.registers[base]
+                offset_reg = self.registers[offset]
+                mem_field = ((mp_reg - 8) << 14) | (offset_reg << 10)
+
+            elif base.startswith('MP'):
                 # Memory pointer with offset
                 mp_reg = self.registers[base]
                 offset_num = self.parse_immediate(offset)
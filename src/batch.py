@@ -0,0 +1,454 @@
+import numpy as np
+
+from cpu import cpu
+from IO import ConsoleDevice
+
+class LaneMemory:
+    """One lane of batch memory presented as a cpu.mem list of Python ints"""
+    __slots__ = ('row',)
+
+    def __init__(self, row):
+        self.row = row
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.row[index].tolist()
+        return int(self.row[index])
+
+    def __setitem__(self, index, value):
+        self.row[index] = value
+
+    def __len__(self):
+        return len(self.row)
+
+class BatchCPU:
+    """Run one program over many machine states in lockstep with NumPy
+
+    Lane state is held in arrays: regs (N,16), mem (N,65536), pc (N,) and
+    boolean flag vectors. Each step picks the lowest PC among running lanes
+    and executes that instruction for every lane sitting on it with
+    vectorized ALU operations; lanes that branched elsewhere are masked out
+    and catch up when control flow reconverges. A lane left waiting for
+    `patience` steps (e.g. behind another lane's loop at lower addresses)
+    is scheduled next regardless of its PC, so no lane starves.
+
+    Anything the vector path does not model exactly (BIOS calls, atomics,
+    traps such as divide by zero or bad addresses) is executed for the
+    affected lanes only by the reference cpu, so results match running the
+    program N times with cpu.run_continuous(). Each lane has its own copy of
+    the disk.
+    """
+    def __init__(self, image, lanes, address=0, entry=0, patience=64):
+        self.lanes = lanes
+        self.patience = patience
+        base = cpu()
+        base.mem[address:address + len(image)] = image
+
+        self.regs = np.zeros((lanes, 16), dtype=np.int64)
+        self.mem = np.empty((lanes, 65536), dtype=np.uint32)
+        self.mem[:] = np.array(base.mem, dtype=np.uint32)
+        self.pc = np.full(lanes, entry, dtype=np.int64)
+        self.zf = np.zeros(lanes, dtype=bool)
+        self.cf = np.zeros(lanes, dtype=bool)
+        self.sf = np.zeros(lanes, dtype=bool)
+        self.ie = np.zeros(lanes, dtype=bool)
+        self.running = np.ones(lanes, dtype=bool)
+        self.halt_reason = [None] * lanes
+        self.retired = np.zeros(lanes, dtype=np.int64)   # Instructions per lane
+        self.waiting = np.zeros(lanes, dtype=np.int64)   # Steps since each lane last ran
+        self.consoles = [ConsoleDevice(capture=True) for _ in range(lanes)]
+        self.disks = [base.disk.fork() for _ in range(lanes)]
+        self.steps = 0
+
+        # Scalar machine used for per-lane fallback
+        self.scalar = base
+        self.decoded = {}
+
+    def lane_state(self, lane):
+        """Registers, PC and flags of one lane"""
+        return {
+            'pc': int(self.pc[lane]),
+            'regs': self.regs[lane].tolist(),
+            'zf': bool(self.zf[lane]),
+            'cf': bool(self.cf[lane]),
+            'sf': bool(self.sf[lane]),
+            'ie': bool(self.ie[lane]),
+            'run': bool(self.running[lane]),
+        }
+
+    def decode(self, word):
+        """Split an instruction word into its fields (cached per word)"""
+        fields = self.decoded.get(word)
+        if fields is None:
+            format = (word >> 30) & 0b11
+            opcode = (word >> 24) & 0b111111
+            match format:
+                case 0b00:
+                    fields = (format, opcode, (word >> 8) & 0xF, (word >> 4) & 0xF, word & 0xF)
+                case 0b01:
+                    imm = word & 0xFFFF
+                    if imm & 0x8000:
+                        imm |= 0xFFFF0000
+                    fields = (format, opcode, (word >> 16) & 0xF, imm, 0)
+                case 0b10:
+                    fields = (format, opcode, (word >> 19) & 0xF, (word >> 17) & 0b11,
+                              word & 0x1FFFF)
+                case 0b11:
+                    fields = (format, opcode, (word >> 19) & 0xF, (word >> 16) & 0b111,
+                              word & 0xFFFF)
+            self.decoded[word] = fields
+        return fields
+
+    def step(self):
+        """Execute one instruction for the lanes at the lowest PC (or a starved lane's)"""
+        running = self.running
+        if not running.any():
+            return False
+        pcs = np.where(running, self.pc, 1 << 40)
+        waiting = self.waiting
+        starved = int(waiting.argmax())
+        pc = int(pcs[starved] if waiting[starved] >= self.patience else pcs.min())
+        lanes = np.flatnonzero(pcs == pc)
+        waiting += running
+        self.steps += 1
+        if pc > 0xFFFF:
+            waiting[lanes] = 0
+            self.retired[lanes] += 1
+            self.fallback(lanes, pc)
+            return True
+
+        words = self.mem[lanes, pc]
+        word = int(words[0])
+        if (words != word).any():
+            lanes = lanes[words == word]  # Lanes with different code wait their turn
+        waiting[lanes] = 0
+        self.pc[lanes] = pc + 1
+        self.retired[lanes] += 1
+        self.execute(word, lanes, pc)
+        return True
+
+    def run(self, max_steps=None):
+        """Run until every lane halts (or max_steps batch steps)"""
+        steps = 0
+        while (max_steps is None or steps < max_steps) and self.step():
+            steps += 1
+        for console in self.consoles:
+            console.flush()
+        return steps
+
+    def fallback(self, lanes, pc):
+        """Execute the instruction at pc with the reference cpu, lane by lane"""
+        machine = self.scalar
+        for lane in lanes.tolist():
+            machine.regs = self.regs[lane].tolist()
+            machine.pc = pc
+            machine.zf = bool(self.zf[lane])
+            machine.cf = bool(self.cf[lane])
+            machine.sf = bool(self.sf[lane])
+            machine.ie = bool(self.ie[lane])
+            machine.run = True
+            machine.halt_reason = None
+            machine.mem = LaneMemory(self.mem[lane])
+            machine.console = self.consoles[lane]
+            machine.disk = self.disks[lane]
+            machine.cycles = int(self.retired[lane]) - 1     # Counted by step()
+
+            machine.run_for(1)
+
+            self.regs[lane] = machine.regs
+            self.pc[lane] = machine.pc
+            self.zf[lane] = machine.zf
+            self.cf[lane] = machine.cf
+            self.sf[lane] = machine.sf
+            self.ie[lane] = machine.ie
+            self.retired[lane] = machine.cycles     # A fault fetching the instruction retires none
+            if not machine.run:
+                self.running[lane] = False
+                self.halt_reason[lane] = machine.halt_reason
+
+    def set_flags(self, lanes, result):
+        """Vector form of cpu.update_flags()"""
+        self.zf[lanes] = (result & 0xFFFF) == 0
+        self.sf[lanes] = (result & 0x8000) != 0
+        self.cf[lanes] = (result > 0xFFFF) | (result < 0)
+
+    def split(self, lanes, bad, pc):
+        """Send lanes flagged in `bad` to the fallback, return the rest"""
+        if bad.any():
+            self.fallback(lanes[bad], pc)
+            return ~bad
+        return None
+
+    def push(self, lanes, values):
+        sp = (self.regs[lanes, 7] - 1) & 0xFFFF
+        self.regs[lanes, 7] = sp
+        self.mem[lanes, sp] = values & 0xFFFF
+
+    def pop(self, lanes):
+        sp = self.regs[lanes, 7]
+        values = self.mem[lanes, sp].astype(np.int64)
+        self.regs[lanes, 7] = (sp + 1) & 0xFFFF
+        return values
+
+    def execute(self, word, lanes, pc):
+        format, opcode, a, b, c = self.decode(word)
+        match format:
+            case 0b00:
+                self.exec_rr(opcode, lanes, a, b, c, pc)
+            case 0b01:
+                self.exec_ri(opcode, lanes, a, b, pc)
+            case 0b10:
+                self.exec_rm(opcode, lanes, a, b, c, pc)
+            case 0b11:
+                self.exec_rcm(opcode, lanes, a, b, c, pc)
+
+    def exec_rr(self, opcode, lanes, rd, rs1, rs2, pc):
+        regs = self.regs
+        match opcode:
+            case 0x00:  # MOV
+                regs[lanes, rd] = regs[lanes, rs1]
+            case 0x02:  # PSH
+                if self.scalar.stack_limit:
+                    return self.fallback(lanes, pc)
+                self.push(lanes, regs[lanes, rd])
+            case 0x03:  # POP
+                regs[lanes, rd] = self.pop(lanes)
+            case 0x04:  # SWP
+                first = regs[lanes, rs1]
+                second = regs[lanes, rd]
+                regs[lanes, rd] = first
+                regs[lanes, rs1] = second
+            case 0x10 | 0x11 | 0x12 | 0x13 | 0x14 | 0x15 | 0x16 | 0x17 | 0x18 | 0x1A:
+                x = regs[lanes, rs1]
+                y = regs[lanes, rs2]
+                if opcode == 0x12:  # MUL: keep the product exact in int64
+                    keep = self.split(lanes, x >= 1 << 31, pc)
+                elif opcode == 0x13:  # DIV: divide by zero traps
+                    keep = self.split(lanes, y == 0, pc)
+                else:
+                    keep = None
+                if keep is not None:
+                    lanes, x, y = lanes[keep], x[keep], y[keep]
+                    if not len(lanes):
+                        return
+                result = self.alu(opcode, x, y)
+                self.set_flags(lanes, result)
+                regs[lanes, rd] = result & 0xFFFF
+            case 0x1D:  # INC
+                regs[lanes, rd] = (regs[lanes, rd] + 1) & 0xFFFF
+                self.set_flags(lanes, regs[lanes, rd])
+            case 0x1E:  # DEC
+                regs[lanes, rd] = (regs[lanes, rd] - 1) & 0xFFFF
+                self.set_flags(lanes, regs[lanes, rd])
+            case 0x23:  # CMP
+                self.set_flags(lanes, regs[lanes, rd] - regs[lanes, rs1])
+            case 0x24 | 0x31:  # RET, RTI
+                self.pc[lanes] = self.pop(lanes)
+            case 0x25:  # HLT
+                self.halt(lanes)
+            case 0x26 | 0x34:  # NOP, IPI (no other processors)
+                pass
+            case 0x32:  # STI
+                self.ie[lanes] = True
+            case 0x33:  # CLI
+                self.ie[lanes] = False
+            case _:
+                self.fallback(lanes, pc)
+
+    def alu(self, opcode, x, y):
+        """Two-operand ALU shared by the RR/RI/RM forms"""
+        match opcode:
+            case 0x10:
+                return x + y
+            case 0x11:
+                return x - y
+            case 0x12:
+                return x * y
+            case 0x13:
+                return x // y
+            case 0x14:
+                return x & y
+            case 0x15:
+                return x | y
+            case 0x16:
+                return x ^ y
+            case 0x17:
+                return ~x
+            case 0x18:  # SHL: any shift >= 16 clears the low word
+                return x << np.minimum(y, 16)
+            case 0x1A:
+                return x >> np.minimum(y, 40)
+
+    def shift(self, opcode, value, amount):
+        """SLR/SAR/ROL/ROR with a 4-bit shift amount"""
+        match opcode:
+            case 0x18:  # SHL
+                return value << amount
+            case 0x19:  # SLR
+                return value >> amount
+            case 0x1A:  # SAR
+                return np.where(value & 0x8000,
+                                (value >> amount) | (0xFFFF << (16 - amount)),
+                                value >> amount)
+            case 0x1B:  # ROL
+                return ((value << amount) | (value >> (16 - amount))) & 0xFFFF
+            case 0x1C:  # ROR
+                return ((value >> amount) | (value << (16 - amount))) & 0xFFFF
+
+    def exec_ri(self, opcode, lanes, rd, imm, pc):
+        regs = self.regs
+        match opcode:
+            case 0x00:  # MOV
+                regs[lanes, rd] = imm & 0xFFFF
+            case 0x10 | 0x11 | 0x12 | 0x13 | 0x14 | 0x15 | 0x16:
+                x = regs[lanes, rd]
+                if opcode == 0x13 and imm == 0:
+                    return self.fallback(lanes, pc)
+                if opcode == 0x12:
+                    keep = self.split(lanes, x >= 1 << 31, pc)
+                    if keep is not None:
+                        lanes, x = lanes[keep], x[keep]
+                result = self.alu(opcode, x, np.int64(imm))
+                self.set_flags(lanes, result)
+                regs[lanes, rd] = result & 0xFFFF
+            case 0x17:  # NOT
+                result = np.full(len(lanes), ~imm, dtype=np.int64)
+                self.set_flags(lanes, result)
+                regs[lanes, rd] = result & 0xFFFF
+            case 0x18 | 0x19 | 0x1A | 0x1B | 0x1C:
+                result = self.shift(opcode, regs[lanes, rd], imm & 0xF)
+                self.set_flags(lanes, result)
+                regs[lanes, rd] = result & 0xFFFF
+            case 0x1D:  # INC
+                result = regs[lanes, rd] + 1
+                self.set_flags(lanes, result)
+                regs[lanes, rd] = result & 0xFFFF
+            case 0x1E:  # DEC
+                result = regs[lanes, rd] - 1
+                self.set_flags(lanes, result)
+                regs[lanes, rd] = result & 0xFFFF
+            case 0x23:  # CMP
+                self.set_flags(lanes, regs[lanes, rd] - imm)
+            case 0x24:  # RET
+                self.pc[lanes] = self.pop(lanes)
+            case 0x25:  # HLT
+                self.halt(lanes)
+            case 0x26:  # NOP
+                pass
+            case 0x31:  # RTI
+                regs[lanes, 0] = self.pop(lanes)
+                self.pc[lanes] = self.pop(lanes)
+            case 0x32:  # STI
+                self.ie[lanes] = True
+            case 0x33:  # CLI
+                self.ie[lanes] = False
+            case _:  # INT and invalid opcodes
+                self.fallback(lanes, pc)
+
+    def calc_address(self, lanes, mode, mem_field):
+        regs = self.regs
+        match mode:
+            case 0b00:
+                return np.full(len(lanes), mem_field & 0xFFFF, dtype=np.int64)
+            case 0b01:
+                return regs[lanes, 8 + ((mem_field >> 14) & 0b11)] + ((mem_field >> 10) & 0b1111)
+            case 0b10:
+                return ((mem_field >> 4) & 0xFFF) + regs[lanes, mem_field & 0b1111]
+            case 0b11:
+                return (regs[lanes, 8 + ((mem_field >> 14) & 0b11)]
+                        + regs[lanes, (mem_field >> 10) & 0b1111])
+
+    def exec_rm(self, opcode, lanes, rd, mode, mem_field, pc):
+        regs = self.regs
+        address = self.calc_address(lanes, mode, mem_field)
+
+        match opcode:
+            case 0x20:  # JMP
+                self.pc[lanes] = address & 0xFFFF
+                return
+            case 0x22:  # JSR
+                if self.scalar.stack_limit:
+                    return self.fallback(lanes, pc)
+                self.push(lanes, self.pc[lanes])
+                self.pc[lanes] = address & 0xFFFF
+                return
+            case 0x05 | 0x06:  # TAS, CAS
+                return self.fallback(lanes, pc)
+
+        # Out-of-range addresses fault in the reference cpu
+        keep = self.split(lanes, address > 0xFFFF, pc)
+        if keep is not None:
+            lanes, address = lanes[keep], address[keep]
+            if not len(lanes):
+                return
+
+        match opcode:
+            case 0x00:  # MOV (load)
+                regs[lanes, rd] = self.mem[lanes, address]
+                return
+            case 0x01:  # STR
+                self.mem[lanes, address] = regs[lanes, rd]
+                return
+
+        value = self.mem[lanes, address].astype(np.int64)
+        x = regs[lanes, rd]
+        match opcode:
+            case 0x10 | 0x11 | 0x12 | 0x13:  # ADD, SUB, MUL, DIV
+                bad = (value == 0) if opcode == 0x13 else (x >= 1 << 31) if opcode == 0x12 else None
+                if bad is not None:
+                    keep = self.split(lanes, bad, pc)
+                    if keep is not None:
+                        lanes, x, value = lanes[keep], x[keep], value[keep]
+                result = self.alu(opcode, x, value)
+                self.set_flags(lanes, result)
+                regs[lanes, rd] = result & 0xFFFF
+            case 0x14 | 0x15 | 0x16:  # AND, OR, XOR (result stored unmasked)
+                result = self.alu(opcode, x, value)
+                self.set_flags(lanes, result)
+                regs[lanes, rd] = result
+            case 0x17:  # NOT
+                result = ~value
+                self.set_flags(lanes, result)
+                regs[lanes, rd] = result & 0xFFFF
+            case 0x18 | 0x19 | 0x1A | 0x1B | 0x1C:
+                result = self.shift(opcode, x, value & 0xF)
+                self.set_flags(lanes, result)
+                regs[lanes, rd] = result & 0xFFFF
+            case 0x23:  # CMP
+                self.set_flags(lanes, x - value)
+            case _:
+                self.fallback(lanes, pc)
+
+    def exec_rcm(self, opcode, lanes, reg, condition, address, pc):
+        match opcode:
+            case 0x20:  # JMP
+                self.pc[lanes] = address
+            case 0x21:  # JCR
+                value = self.regs[lanes, reg]
+                taken = np.zeros(len(lanes), dtype=bool)
+                if condition & 0b010:
+                    taken |= value == 0
+                if condition & 0b001:
+                    taken |= value > 0
+                self.pc[lanes[taken]] = address
+            case 0x27:  # JCF
+                taken = np.zeros(len(lanes), dtype=bool)
+                if condition & 0b100:
+                    taken |= self.sf[lanes]
+                if condition & 0b010:
+                    taken |= self.zf[lanes]
+                if condition & 0b001:
+                    taken |= ~self.sf[lanes] & ~self.zf[lanes]
+                self.pc[lanes[taken]] = address
+            case 0x22:  # JSR
+                if self.scalar.stack_limit:
+                    return self.fallback(lanes, pc)
+                self.push(lanes, self.pc[lanes])
+                self.pc[lanes] = address & 0xFFFF
+            case _:
+                self.fallback(lanes, pc)
+
+    def halt(self, lanes):
+        self.running[lanes] = False
+        for lane in lanes.tolist():
+            self.halt_reason[lane] = "HLT"
@@ -0,0 +1,254 @@
+import random
+import sys
+
+# Access kinds, stored in the low two bits of each trace entry (address << 2 | kind)
+FETCH = 0
+READ = 1
+WRITE = 2
+
+# RM opcodes that read their memory operand (MOV, ADD..ROR, CMP)
+RM_READS = frozenset([0x00, *range(0x10, 0x1D), 0x23])
+RM_STORE = 0x01
+RM_TAS = 0x05
+RM_CAS = 0x06
+
+POLICIES = ('lru', 'fifo', 'random')
+
+class Cache:
+    """One set-associative cache level; sizes are in (16-bit) words
+
+    Each set is a list of line numbers, most recently filled (or, for LRU,
+    used) first, so a repeat access to the same line is a single compare.
+    Caches are write-allocate and stores are counted like loads.
+    """
+    def __init__(self, size=1024, line_size=8, associativity=2, policy='lru', seed=0):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown replacement policy: {policy}")
+        lines = size // line_size
+        if line_size & (line_size - 1) or size % line_size or lines % associativity:
+            raise ValueError("Line size must be a power of two dividing the size into whole sets")
+        set_count = lines // associativity
+        if set_count & (set_count - 1):
+            raise ValueError("Number of sets must be a power of two")
+        self.size = size
+        self.line_size = line_size
+        self.associativity = associativity
+        self.policy = policy
+        self.line_bits = line_size.bit_length() - 1
+        self.set_mask = set_count - 1
+        self.sets = [[] for _ in range(set_count)]
+        self.random = random.Random(seed)
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, line):
+        """Slow path after the MRU compare failed; True on a hit, filling the line on a miss"""
+        ways = self.sets[line & self.set_mask]
+        if line in ways:
+            self.hits += 1
+            if self.policy == 'lru':
+                ways.remove(line)
+                ways.insert(0, line)
+            return True
+        self.misses += 1
+        if len(ways) >= self.associativity:
+            if self.policy == 'random':
+                del ways[self.random.randrange(len(ways))]
+            else:
+                ways.pop()      # LRU: least recently used; FIFO: oldest fill
+        ways.insert(0, line)
+        return False
+
+    def describe(self):
+        return (f"{self.size} words, {self.line_size}-word lines, "
+                f"{self.associativity}-way, {self.policy}")
+
+class CacheSimulator:
+    """Models I/D L1 caches over an optional unified L2 for a running machine
+
+    Instruction fetches (cpu.step), operand accesses (cpu.exec_rm, using the
+    address calc_address produced) and stack traffic (cpu.push/cpu.pop) are
+    appended to a flat trace by hooks installed on the machine instance, like
+    the profiler's, so a machine without a simulator attached runs the
+    unmodified class methods. Once `batch` accesses are buffered the trace is
+    fed to the model in one tight loop. Each access is charged to the instruction
+    that made it: L1 misses that hit in L2 stall for l2_latency cycles, L2
+    misses (or L1 misses without an L2) for memory_latency more.
+
+    Simulation runs on the interpreter (cpu.run_for); engines that bypass
+    cpu.step and cpu.exec_* are not observed. BIOS services are host code
+    and their memory accesses are not modelled.
+    """
+    def __init__(self, machine, icache=None, dcache=None, l2=None,
+                 l2_latency=10, memory_latency=100, batch=4096):
+        self.machine = machine
+        self.icache = icache or Cache(512, 8, 2)
+        self.dcache = dcache or Cache(512, 8, 2)
+        self.l2 = l2
+        self.l2_latency = l2_latency
+        self.memory_latency = memory_latency
+        self.batch = batch
+
+        self.trace = []
+        self.pc = machine.pc        # Instruction the next data accesses belong to
+        self.per_pc = {}            # pc -> [accesses, L1 misses, L2 misses, stall cycles]
+        self.stall_cycles = 0
+        self.instructions = 0
+        self.attached = False
+
+    def attach(self):
+        """Install the access hooks on the machine instance"""
+        if self.attached:
+            return
+        machine = self.machine
+        step, push, pop, exec_rm = machine.step, machine.push, machine.pop, machine.exec_rm
+        trace = self.trace
+        record = trace.append
+        batch = self.batch
+
+        def hooked_step():
+            if machine.run:
+                record(machine.pc << 2)     # FETCH
+                if len(trace) >= batch:
+                    self.flush()
+            step()
+
+        def hooked_push(value):
+            record(((machine.regs[7] - 1) & 0xFFFF) << 2 | WRITE)
+            push(value)
+
+        def hooked_pop():
+            record(machine.regs[7] << 2 | READ)
+            return pop()
+
+        def hooked_rm(opcode, rd, address):
+            if opcode in RM_READS:
+                record(address << 2 | READ)
+            elif opcode == RM_STORE:
+                record(address << 2 | WRITE)
+            elif opcode == RM_TAS:
+                record(address << 2 | READ)
+                record(address << 2 | WRITE)
+            elif opcode == RM_CAS:
+                record(address << 2 | READ)
+                exec_rm(opcode, rd, address)
+                if machine.zf:
+                    record(address << 2 | WRITE)
+                return
+            exec_rm(opcode, rd, address)
+
+        machine.step, machine.push, machine.pop = hooked_step, hooked_push, hooked_pop
+        machine.exec_rm = hooked_rm
+        self.attached = True
+
+    def detach(self):
+        """Process what is left of the trace and restore the class methods"""
+        if self.attached:
+            self.flush()
+            for name in ('step', 'push', 'pop', 'exec_rm'):
+                del self.machine.__dict__[name]
+            self.attached = False
+
+    def flush(self):
+        """Feed the buffered accesses through the cache model"""
+        trace = self.trace
+        icache, dcache, l2 = self.icache, self.dcache, self.l2
+        l2_latency, memory_latency = self.l2_latency, self.memory_latency
+        per_pc = self.per_pc
+        pc = self.pc
+        row = per_pc.setdefault(pc, [0, 0, 0, 0])
+        stall_cycles = 0
+        instructions = 0
+        for entry in trace:
+            address = entry >> 2
+            if entry & 3 == FETCH:
+                pc = address
+                row = per_pc.get(pc)
+                if row is None:
+                    row = per_pc[pc] = [0, 0, 0, 0]
+                instructions += 1
+                cache = icache
+            else:
+                cache = dcache
+            row[0] += 1
+            line = address >> cache.line_bits
+            ways = cache.sets[line & cache.set_mask]
+            if ways and ways[0] == line:
+                cache.hits += 1
+                continue
+            if cache.lookup(line):
+                continue
+            row[1] += 1
+            if l2 is None:
+                stall = memory_latency
+            elif l2.lookup(address >> l2.line_bits):
+                stall = l2_latency
+            else:
+                row[2] += 1
+                stall = l2_latency + memory_latency
+            row[3] += stall
+            stall_cycles += stall
+        trace.clear()
+        self.pc = pc
+        self.stall_cycles += stall_cycles
+        self.instructions += instructions
+
+    def run(self, max_instructions=None, chunk=10000):
+        """Run the machine until it stops (or max_instructions) with the model attached"""
+        self.attach()
+        machine = self.machine
+        executed = 0
+        try:
+            while machine.run and (max_instructions is None or executed < max_instructions):
+                count = chunk
+                if max_instructions is not None:
+                    count = min(count, max_instructions - executed)
+                executed += machine.run_for(count)
+        finally:
+            self.detach()
+        machine.console.flush()
+
+    def report(self, limit=20, debug_map=None, file=None):
+        """Print per-level hit rates and the instructions with the most stall cycles"""
+        file = file or sys.stdout
+        print(f"{self.instructions} instructions, {self.stall_cycles} stall cycles "
+              f"({self.stall_cycles / max(self.instructions, 1):.2f} per instruction)", file=file)
+
+        print(f"\n{'level':<4} {'accesses':>10} {'hits':>10} {'misses':>10} {'hit %':>7}  "
+              "geometry", file=file)
+        levels = [('L1I', self.icache), ('L1D', self.dcache)]
+        if self.l2 is not None:
+            levels.append(('L2', self.l2))
+        for name, cache in levels:
+            accesses = cache.hits + cache.misses
+            print(f"{name:<4} {accesses:>10} {cache.hits:>10} {cache.misses:>10} "
+                  f"{100 * cache.hits / max(accesses, 1):>7.2f}  {cache.describe()}", file=file)
+
+        print(f"\n{'pc':>6} {'accesses':>10} {'L1 miss':>8} {'L2 miss':>8} {'stalls':>10}  "
+              "location", file=file)
+        rows = sorted(self.per_pc.items(), key=lambda item: -item[1][3])
+        for pc, (accesses, l1_misses, l2_misses, stalls) in rows[:limit]:
+            if not stalls:
+                break
+            location = ''
+            if debug_map is not None:
+                label = debug_map.label_for(pc)
+                line = debug_map.line_for(pc)
+                location = ' '.join(filter(None, [label, line and f"{line[0]}:{line[1]}"]))
+            print(f"{pc:#06x} {accesses:>10} {l1_misses:>8} {l2_misses:>8} {stalls:>10}  "
+                  f"{location}", file=file)
+
+if __name__ == '__main__':
+    # python cachesim.py program.asm [max_instructions]
+    from codecache import CodeCache
+    from cpu import STACK_TOP, cpu
+
+    cache = CodeCache()
+    with open(sys.argv[1]) as source:
+        image = cache.assemble(source.read(), sys.argv[1])
+    machine = cpu()
+    machine.mem[:len(image)] = image
+    machine.regs[7] = STACK_TOP
+    simulator = CacheSimulator(machine, l2=Cache(8192, 16, 4))
+    simulator.run(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    simulator.report(debug_map=cache.debug_map)
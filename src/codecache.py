@@ -0,0 +1,132 @@
+import hashlib
+import marshal
+import mmap
+import os
+import sys
+import tempfile
+import time
+from array import array
+
+import assembler
+
+CACHE_FORMAT = 2
+TRANSLATOR_SOURCES = ('assembler.py', 'aot.py', 'engine.py')    # Code the entries depend on
+
+def emulator_version():
+    """Hash of the assembler and translator sources and the Python bytecode version
+
+    Any edit to them, or a different Python (marshal and code objects are
+    version specific), invalidates the cache.
+    """
+    digest = hashlib.sha256(b'starcpu-code-cache-%d' % CACHE_FORMAT)
+    digest.update(sys.implementation.cache_tag.encode())
+    directory = os.path.dirname(os.path.abspath(assembler.__file__))
+    for name in TRANSLATOR_SOURCES:
+        with open(os.path.join(directory, name), 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()[:16]
+
+def image_key(image, base=0):
+    return array('I', [base, *image]).tobytes()
+
+def default_directory():
+    return os.environ.get('STARCPU_CACHE') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'starcpu')
+
+class CodeCache:
+    """On-disk cache of assembled images and their translated code
+
+    Two kinds of entry, each named by a SHA-256 of its key together with
+    the emulator version, stored as marshal blobs read back through mmap:
+
+        source  (program source, file name) -> image and debug map
+        aot     (machine-code image, base)  -> compiled AOT module code
+
+    Translated code is keyed by the image, so edits that assemble to the
+    same machine code (comments, layout, another file name) still reuse
+    it. A corrupt or stale entry is treated as a miss and rewritten.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory or default_directory()
+        self.version = emulator_version()
+        self.hits = 0
+        self.misses = 0
+        self.debug_map = None       # Of the last assemble(), as Assembler.debug_map
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, kind, data):
+        digest = hashlib.sha256(self.version.encode() + kind.encode() + data).hexdigest()
+        return os.path.join(self.directory, f"{kind}-{digest}.bin")
+
+    def load(self, path):
+        """Unmarshalled entry at path, or None"""
+        try:
+            with open(path, 'rb') as file:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as blob:
+                    value = marshal.loads(blob)
+        except (OSError, ValueError, EOFError, TypeError):
+            return None
+        self.hits += 1
+        return value
+
+    def store(self, path, value):
+        """Write an entry atomically so concurrent workers never see a partial file"""
+        self.misses += 1
+        fd, temporary = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                marshal.dump(value, file)
+            os.replace(temporary, path)
+        except OSError:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+
+    def assemble(self, source, filename="<source>"):
+        """Machine code for assembler source, assembling only on a miss
+
+        Also sets self.debug_map to the program's assembler.DebugMap.
+        """
+        path = self.path('source', filename.encode() + b'\0' + source.encode())
+        entry = self.load(path)
+        if entry is None:
+            program = assembler.Assembler()
+            image = program.assemble(source, filename)
+            debug_map = program.debug_map
+            self.store(path, {'image': image, 'file': debug_map.filename,
+                              'lines': debug_map.lines, 'labels': debug_map.addresses})
+        else:
+            image = entry['image']
+            debug_map = assembler.DebugMap(entry['file'], entry['lines'], entry['labels'])
+        self.debug_map = debug_map
+        return image
+
+    def compile_module(self, image, base=0, name="program"):
+        """aot.compile_module for an image, translating only on a miss"""
+        import aot
+
+        path = self.path('aot', image_key(image, base) + name.encode())
+        code = self.load(path)
+        if code is None:
+            code = compile(aot.compile_image(image, base, name), f"<aot {name}>", "exec")
+            self.store(path, code)
+        module = type(sys)(name)
+        exec(code, module.__dict__)
+        return module
+
+    def clear(self):
+        """Remove every cache entry"""
+        for name in os.listdir(self.directory):
+            if name.endswith('.bin'):
+                os.unlink(os.path.join(self.directory, name))
+
+if __name__ == '__main__':
+    # Warm the cache for assembler source files: python codecache.py prog.asm...
+    cache = CodeCache()
+    for name in sys.argv[1:]:
+        with open(name) as file:
+            source = file.read()
+        start = time.perf_counter()
+        image = cache.assemble(source, name)
+        cache.compile_module(image)
+        print(f"{name}: {len(image)} words in {(time.perf_counter() - start) * 1000:.1f} ms")
+    print(f"{cache.directory}: {cache.hits} hits, {cache.misses} misses")
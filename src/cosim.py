@@ -0,0 +1,373 @@
+import random
+import sys
+from collections import deque
+
+from assembler import Assembler
+from cpu import STACK_TOP, cpu
+from IO import ConsoleDevice
+
+# Valid (format, mnemonic) pairs of the reference interpreter
+RR_OPS = ['MOV', 'SWP', 'ADD', 'SUB', 'MUL', 'DIV', 'AND', 'OR', 'XOR', 'NOT',
+          'SHL', 'SAR', 'INC', 'DEC', 'CMP', 'NOP', 'STI', 'CLI', 'IPI']
+RI_OPS = ['MOV', 'ADD', 'SUB', 'MUL', 'DIV', 'AND', 'OR', 'XOR', 'NOT', 'SHL',
+          'SLR', 'SAR', 'ROL', 'ROR', 'INC', 'DEC', 'CMP', 'NOP', 'STI', 'CLI']
+RM_OPS = ['MOV', 'STR', 'TAS', 'CAS', 'ADD', 'SUB', 'MUL', 'DIV', 'AND', 'OR',
+          'XOR', 'NOT', 'SHL', 'SLR', 'SAR', 'ROL', 'ROR', 'CMP']
+CONDITIONS = ['LT', 'EQ', 'GT', 'LE', 'GE', 'NE', 'AL']
+
+# Registers the generator may overwrite (SP and MP1-MP4 stay valid pointers,
+# H is the index register used by the register-offset addressing modes)
+WRITABLE = ['A', 'B', 'C', 'D', 'X', 'Y', 'Z', 'E', 'F', 'G']
+READABLE = WRITABLE + ['H', 'SP', 'MP1', 'MP2', 'MP3', 'MP4']
+
+DATA_BASE = 0x8000      # MP1-MP4 point into 0x8000-0x8FFF
+LOW_DATA_BASE = 0x800   # Mode 10 (direct + register) window, 0x800-0x10FF
+MAX_PROGRAM = 0x800     # Generated code must stay below LOW_DATA_BASE
+
+class Divergence(Exception):
+    """Reference and candidate states differ"""
+    def __init__(self, report):
+        super().__init__(report)
+        self.report = report
+
+def machine_state(machine):
+    """Registers, PC and flags of a cpu-like machine"""
+    return {
+        'pc': machine.pc,
+        'regs': list(machine.regs),
+        'zf': bool(machine.zf),
+        'cf': bool(machine.cf),
+        'sf': bool(machine.sf),
+        'ie': bool(machine.ie),
+        'run': bool(machine.run),
+    }
+
+def memory_difference(reference, candidate, limit=8):
+    """First differing memory words as (address, reference, candidate)"""
+    ref_mem = reference.mem if isinstance(reference.mem, list) else list(reference.mem)
+    cand_mem = candidate.mem if isinstance(candidate.mem, list) else list(candidate.mem)
+    if ref_mem == cand_mem:
+        return []
+    diffs = []
+    for address, (a, b) in enumerate(zip(ref_mem, cand_mem)):
+        if a != b:
+            diffs.append((address, a, b))
+            if len(diffs) >= limit:
+                break
+    return diffs
+
+class Lockstep:
+    """Run a candidate engine against the reference cpu and compare state
+
+    The candidate must look like a cpu (regs, pc, zf/cf/sf/ie, run, mem) and
+    provide run_for(count) returning the number of guest instructions it
+    retired; engines that retire several instructions at once (fused or
+    collapsed sequences) are fine, the reference is advanced to match.
+    """
+    def __init__(self, reference, candidate, interval=64, trace_window=16, check_memory=True):
+        self.reference = reference
+        self.candidate = candidate
+        self.interval = interval
+        self.check_memory = check_memory
+        self.trace = deque(maxlen=trace_window)
+        self.instructions = 0
+        self.synced = 0         # Instructions retired at the last matching compare
+
+    def step_reference(self, count):
+        """Advance the reference one instruction at a time, recording a trace"""
+        ref = self.reference
+        for _ in range(count):
+            if not ref.run:
+                break
+            pc = ref.pc
+            word = ref.mem[pc] if 0 <= pc < len(ref.mem) else None
+            self.trace.append((self.instructions, pc, word))
+            ref.run_for(1)
+            self.instructions += 1
+
+    def compare(self):
+        """Raise Divergence if the two machines differ"""
+        ref_state = machine_state(self.reference)
+        cand_state = machine_state(self.candidate)
+        fields = [(name, ref_state[name], cand_state[name])
+                  for name in ref_state if ref_state[name] != cand_state[name]]
+        memory = memory_difference(self.reference, self.candidate) if self.check_memory else []
+        if fields or memory:
+            raise Divergence(self.format_report(fields, memory))
+        self.synced = self.instructions
+
+    def format_report(self, fields, memory):
+        lines = [f"Divergence after {self.instructions} instructions "
+                 f"(last sync {self.synced}):"]
+        for name, ref_value, cand_value in fields:
+            lines.append(f"  {name}: reference={ref_value} candidate={cand_value}")
+        for address, ref_value, cand_value in memory:
+            lines.append(f"  mem[{address:#06x}]: reference={ref_value:#x} "
+                         f"candidate={cand_value:#x}")
+        lines.append("Trace (instruction, pc, word):")
+        for index, pc, word in self.trace:
+            word_text = f"{word:#010x}" if word is not None else "--"
+            lines.append(f"  {index:>10}  {pc:#06x}  {word_text}")
+        return "\n".join(lines)
+
+    def run(self, max_instructions):
+        """Run both machines until they stop or max_instructions have retired"""
+        while self.instructions < max_instructions and (self.reference.run or self.candidate.run):
+            count = min(self.interval, max_instructions - self.instructions)
+            retired = self.candidate.run_for(count) if self.candidate.run else 0
+            self.step_reference(retired if retired else count)
+            self.compare()
+        return self.instructions
+
+def random_program(rng, length=200, subroutines=4):
+    """Random assembler source exercising every opcode and addressing mode
+
+    The program installs trap handlers for all CPU trap vectors, so faults
+    such as divide by zero are part of the compared behaviour, then runs a
+    random body with forward branches, counted and copy/fill loops,
+    subroutine calls (returning with RET or RR RTI), console output and
+    rare guarded HLTs in an endless loop.
+    """
+    lines = []
+    emit = lines.append
+    labels = iter(range(1 << 30))
+
+    def reg(choices=WRITABLE):
+        return rng.choice(choices)
+
+    def imm():
+        return str(rng.choice([0, 1, 2, 15, 0x7FFF, 0x8000, 0xFFFF, rng.randrange(0x10000)]))
+
+    def address():
+        match rng.randrange(4):
+            case 0:
+                return f"[{DATA_BASE + rng.randrange(0x1000):#x}]"
+            case 1:
+                return f"[MP{rng.randrange(1, 5)} + {rng.randrange(16)}]"
+            case 2:
+                return f"[{LOW_DATA_BASE + rng.randrange(0x800):#x} + H]"
+            case 3:
+                return f"[MP{rng.randrange(1, 5)} + H]"
+
+    # Setup: stack, pointers and trap handlers
+    emit("RI MOV SP, " + str(STACK_TOP))
+    for mp in range(1, 5):
+        emit(f"RI MOV MP{mp}, {DATA_BASE + rng.randrange(0xF00):#x}")
+    emit("RI MOV H, 0")
+    for vector in range(4):
+        emit("RI MOV A, TRAP_HANDLER")
+        emit(f"RM STR A, [{0xE080 + vector:#x}]")
+    emit("START:")
+
+    pending_labels = []
+    for position in range(length):
+        # Place forward labels
+        while pending_labels and pending_labels[0][0] <= position:
+            emit(f"{pending_labels.pop(0)[1]}:")
+
+        kind = rng.randrange(112)
+        if kind < 30:
+            op = rng.choice(RR_OPS)
+            if op in ('MOV', 'SWP'):
+                emit(f"RR {op} {reg()}, {reg()}")
+            elif op == 'IPI':
+                emit(f"RR IPI {reg(READABLE)}, {reg(READABLE)}")
+            else:
+                emit(f"RR {op} {reg()}, {reg(READABLE)}, {reg(READABLE)}")
+        elif kind < 55:
+            emit(f"RI {rng.choice(RI_OPS)} {reg()}, {imm()}")
+        elif kind < 75:
+            op = rng.choice(RM_OPS)
+            emit(f"RM {op} {reg()}, {address()}")
+        elif kind < 80:
+            emit(f"RI AND H, {rng.choice([0xFF, 0x7F, 0x0F])}")
+            emit(f"RR MOV H, {reg()}")
+            emit("RI AND H, 0xFF")
+        elif kind < 88:
+            # Forward conditional branch
+            target = f"L{next(labels)}"
+            pending_labels.append((position + rng.randrange(1, 6), target))
+            pending_labels.sort()
+            match rng.randrange(4):
+                case 0:
+                    emit(f"RCM JCF A, {rng.choice(CONDITIONS)}, {target}")
+                case 1:
+                    emit(f"RCM JCR {reg(READABLE)}, {rng.choice(CONDITIONS)}, {target}")
+                case 2:
+                    emit(f"RCM JMP A, AL, {target}")
+                case 3:
+                    emit(f"RM JMP A, [{target}]")
+        elif kind < 93:
+            sub = rng.randrange(subroutines)
+            saved = reg() if rng.randrange(2) else None
+            if saved:
+                emit(f"RR PSH {saved}, A")
+            if rng.randrange(2):
+                emit(f"RCM JSR A, AL, SUB{sub}")
+            else:
+                emit(f"RM JSR A, [SUB{sub}]")
+            if saved:
+                emit(f"RR POP {saved}, A")
+        elif kind < 97:
+            emit(f"RR PSH {reg(READABLE)}, A")
+            emit(f"RR {rng.choice(RR_OPS[:3])} {reg()}, {reg()}")
+            emit(f"RR POP {reg()}, A")
+        elif kind < 100:
+            # Counted loop (INC/DEC + CMP + JCF back-edge)
+            counter = reg()
+            body = [r for r in WRITABLE if r != counter]
+            target = f"L{next(labels)}"
+            start = rng.randrange(0x10000)
+            emit(f"RI MOV {counter}, {start}")
+            emit(f"{target}:")
+            for _ in range(rng.randrange(3)):
+                op = rng.choice(['ADD', 'XOR', 'SUB', 'MOV'])
+                emit(f"RI {op} {rng.choice(body)}, {imm()}")
+            step = rng.choice(['INC', 'DEC'])
+            if rng.randrange(2):
+                emit(f"RR {step} {counter}, {counter}")
+            else:
+                emit(f"RI {step} {counter}, 0")
+            end = (start + rng.randrange(1, 20) * (1 if step == 'INC' else -1)) & 0xFFFF
+            if rng.randrange(2):
+                emit(f"RI CMP {counter}, {end}")
+            else:
+                limit = rng.choice(body)
+                emit(f"RI MOV {limit}, {end}")
+                emit(f"RR CMP {counter}, {limit}")
+            emit(f"RCM JCF A, NE, {target}")
+        elif kind < 105:
+            # Copy/fill loop over MP-addressed buffers
+            body = [r for r in WRITABLE]
+            target = f"L{next(labels)}"
+            src, dst = rng.sample(range(1, 5), 2)
+            value = rng.choice(body)
+            if rng.randrange(2):
+                # Index form: [MPa + I], INC I, CMP I, N
+                index = rng.choice([r for r in body if r != value])
+                start = rng.randrange(0x100)
+                emit(f"RI MOV {index}, {start}")
+                emit(f"{target}:")
+                if rng.randrange(2):
+                    emit(f"RM MOV {value}, [MP{src} + {index}]")
+                emit(f"RM STR {value}, [MP{dst} + {index}]")
+                emit(f"RR INC {index}, {index}" if rng.randrange(2) else f"RI INC {index}, 0")
+                emit(f"RI CMP {index}, {start + rng.randrange(1, 40)}")
+                emit(f"RCM JCF A, {rng.choice(['NE', 'LT'])}, {target}")
+            else:
+                # Pointer form: [MPa + k], INC MPa, DEC C
+                count = rng.choice([r for r in body if r != value])
+                emit(f"RR PSH MP{src}, A")
+                emit(f"RR PSH MP{dst}, A")
+                emit(f"RI MOV {count}, {rng.randrange(1, 40)}")
+                emit(f"{target}:")
+                copy = rng.randrange(2)
+                if copy:
+                    emit(f"RM MOV {value}, [MP{src} + {rng.randrange(16)}]")
+                emit(f"RM STR {value}, [MP{dst} + {rng.randrange(16)}]")
+                pointers = [dst, src] if copy else [dst]
+                rng.shuffle(pointers)
+                for mp in pointers:
+                    emit(f"RR INC MP{mp}, MP{mp}" if rng.randrange(2) else f"RI INC MP{mp}, 0")
+                emit(f"RR DEC {count}, {count}" if rng.randrange(2) else f"RI DEC {count}, 0")
+                emit(f"RCM JCF A, NE, {target}")
+                emit(f"RR POP MP{dst}, A")
+                emit(f"RR POP MP{src}, A")
+        elif kind < 110:
+            # Console output through the BIOS
+            emit("RR PSH A, A")
+            if rng.randrange(2):
+                emit("RI MOV A, 0")
+                emit(f"RI MOV B, {rng.randrange(32, 127)}")
+                emit("RI INT A, 3")
+            else:
+                emit("RI MOV A, 1")
+                emit(f"RI MOV B, {DATA_BASE + rng.randrange(0x1000):#x}")
+                emit("RI INT A, 3")
+            emit("RR POP A, A")
+        else:
+            # HLT behind a compare that seldom matches, so most runs keep going
+            target = f"L{next(labels)}"
+            emit(f"RI CMP {reg(READABLE)}, {imm()}")
+            emit(f"RCM JCF A, NE, {target}")
+            emit("RR HLT A, A")
+            emit(f"{target}:")
+    for _, label in pending_labels:
+        emit(f"{label}:")
+    emit("RM JMP A, [START]")
+
+    for sub in range(subroutines):
+        emit(f"SUB{sub}:")
+        saved = reg() if rng.randrange(2) else None
+        if saved:
+            emit(f"RR PSH {saved}, A")
+        for _ in range(rng.randrange(1, 5)):
+            emit(f"RI {rng.choice(RI_OPS)} {reg()}, {imm()}")
+        if saved:
+            emit(f"RR POP {saved}, A")
+        emit(rng.choice(["RR RET A, A", "RI RET A, 0", "RR RTI A, A"]))
+
+    emit("TRAP_HANDLER:")
+    emit("RI RTI A, 0")
+    return "\n".join(lines)
+
+def make_machine(image):
+    """Fresh reference cpu with an image loaded at address 0"""
+    machine = cpu()
+    machine.mem[:len(image)] = image
+    machine.console = ConsoleDevice(capture=True)
+    return machine
+
+def first_divergence(image, make_candidate, synced, instructions, interval=64):
+    """Replay a diverging program, comparing after every candidate step past synced
+
+    Returns the Divergence at the first differing instruction (or the first
+    fused group, for engines that retire several at once), or None if the
+    replay does not diverge.
+    """
+    lockstep = Lockstep(make_machine(image), make_candidate(image), interval=interval)
+    try:
+        lockstep.run(synced)
+        lockstep.interval = 1
+        lockstep.run(instructions)
+    except Divergence as divergence:
+        return divergence
+    return None
+
+def fuzz(make_candidate=make_machine, programs=100, instructions=10000, seed=0,
+         interval=64, length=200):
+    """Differentially test a candidate engine on random programs
+
+    make_candidate(image) must return a candidate loaded with the image.
+    Returns (compared instructions, skipped programs); programs that
+    assemble to more than MAX_PROGRAM words are skipped. Raises Divergence
+    (with the program source attached) on the first mismatch, narrowed to
+    the first diverging instruction by replaying one step at a time.
+    """
+    rng = random.Random(seed)
+    total = skipped = 0
+    for number in range(programs):
+        source = random_program(rng, length)
+        image = Assembler().assemble(source)
+        if len(image) > MAX_PROGRAM:
+            skipped += 1
+            continue
+        reference = make_machine(image)
+        candidate = make_candidate(image)
+        lockstep = Lockstep(reference, candidate, interval=interval)
+        try:
+            total += lockstep.run(instructions)
+        except Divergence as divergence:
+            if interval > 1:
+                divergence = first_divergence(image, make_candidate, lockstep.synced,
+                                              instructions, interval) or divergence
+            divergence.source = source
+            divergence.program = number
+            raise divergence
+    return total, skipped
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    compared, skipped = fuzz(programs=count)
+    print(f"{count} programs ({skipped} skipped, over {MAX_PROGRAM:#x} words), "
+          f"{compared} instructions compared, no divergence")
@@ -1,5 +1,69 @@
 import pygame
 import sys
+from contextlib import nullcontext
+
+from memory import CowMemory, DirtyMemory
+from IO import (ConsoleDevice, DiskDevice, TimerDevice, ThreadedKeyboard, SECTOR_SIZE, pack_words,
+                IO_CONSOLE, IO_KEY, IO_TIMER, IO_DISK_READ, IO_DISK_WRITE)
+
+# CPU trap vectors (entries 0x00-0x03 of the interrupt vector table)
+TRAP_INVALID_OPCODE = 0x00
+TRAP_DIVIDE_ERROR = 0x01
+TRAP_STACK_FAULT = 0x02
+TRAP_MEMORY_FAULT = 0x03
+
+TRAP_NAMES = {
+    TRAP_INVALID_OPCODE: "invalid opcode",
+    TRAP_DIVIDE_ERROR: "divide by zero",
+    TRAP_STACK_FAULT: "stack fault",
+    TRAP_MEMORY_FAULT: "memory fault",
+}
+
+# Graphics video mode (rendering and drawing in video.py)
+GRAPHICS_MODE = 0x13
+GRAPHICS_WIDTH = 320
+GRAPHICS_HEIGHT = 200
+FRAMEBUFFER_WORDS = GRAPHICS_WIDTH * GRAPHICS_HEIGHT // 4   # 4 bits per pixel
+
+# Video memory starts at VIDEO_MEMORY (the BDA default) and in mode 0x13 covers
+# 0xA000-0xDE7F, which a mode set or clear screen wipes; keep stacks and data
+# below it. STACK_TOP is the initial SP the tools and test programs use.
+VIDEO_MEMORY = 0xA000
+STACK_TOP = VIDEO_MEMORY
+
+# 16-colour palette as 12-bit 0xRGB entries
+DEFAULT_PALETTE = [
+    0x000, 0x00A, 0x0A0, 0x0AA, 0xA00, 0xA0A, 0xA50, 0xAAA,
+    0x555, 0x55F, 0x5F5, 0x5FF, 0xF55, 0xF5F, 0xFF5, 0xFFF,
+]
+
+# Guest key codes for special pygame keys (same codes as IO.KEY_NAMES)
+PYGAME_KEYS = {
+    pygame.K_RETURN: (13, 10),      # Carriage return, line feed
+    pygame.K_BACKSPACE: (8,),
+    pygame.K_ESCAPE: (27,),
+    pygame.K_TAB: (9,),
+    pygame.K_UP: (0x48,),
+    pygame.K_DOWN: (0x50,),
+    pygame.K_LEFT: (0x4B,),
+    pygame.K_RIGHT: (0x4D,),
+}
+
+def pygame_key_codes(event):
+    """Guest key codes for a pygame KEYDOWN event"""
+    if event.key in PYGAME_KEYS:
+        return PYGAME_KEYS[event.key]
+    if event.unicode and ord(event.unicode) >= 32:
+        return (ord(event.unicode),)    # Regular character
+    return ()
+
+class CPUTrap(Exception):
+    """Guest-visible CPU exception raised by an instruction"""
+    def __init__(self, vector, message="", pc=None):
+        super().__init__(message or TRAP_NAMES.get(vector, "trap"))
+        self.vector = vector
+        self.message = message or TRAP_NAMES.get(vector, "trap")
+        self.pc = pc  # Address of the faulting instruction
 
 class cpu:
     def __init__(self):
@@ -14,6 +78,18 @@ class cpu:
         self.ie = False
         
         self.run = True
+        self.cycles = 0             # Instructions retired since power on
+        self.halt_reason = None     # "HLT", "SHUTDOWN", "TRAP" or "DOUBLE_FAULT"
+        self.last_trap = None       # CPUTrap that stopped or was delivered last
+        self.stack_limit = 0x0000   # Pushing below this address raises a stack fault
+
+        # Multiprocessor support (see smp.py)
+        self.core_id = 0
+        self.bus_lock = nullcontext()   # Held by atomic instructions
+        self.ipi_handler = None         # Called as ipi_handler(core, vector) by IPI
+
+        # Paged memory (see mmu.py); when enabled, mem is the MMU itself
+        self.mmu = None
         
         # Register name mapping for debugging
         self.reg_names = ["A", "B", "C", "D", "X", "Y", "Z", "SP", 
@@ -32,58 +108,92 @@ class cpu:
         self.SYSTEM_TIME = self.BDA_BASE + 0x40             # 4 bytes
         self.VIDEO_MEMORY_BASE = self.BDA_BASE + 0x50       # 1 word
         self.INSTALLED_MEMORY = self.BDA_BASE + 0x60        # 1 word (in KB)
+        self.INTERRUPT_VECTORS = self.BDA_BASE + 0x80       # 16 words (handlers, 0 = none)
+        self.FAULT_PC = self.BDA_BASE + 0x90                # 1 word (faulting instruction)
+        self.FAULT_VECTOR = self.BDA_BASE + 0x91            # 1 word
+        self.PALETTE = self.BDA_BASE + 0xA0                 # 16 words (0xRGB)
         
         # Pygame display variables
         self.screen = None
         self.clock = None
         self.font = None
         self.last_key_event = None
+        self.graphics = None        # video.GraphicsRenderer, created on first use
+        self.display_tracker = None # memory.DirtyTracker; redraw only when video memory changes
+
+        # Host devices
+        self.console = ConsoleDevice()
+        self.timer = TimerDevice()
+        self.disk = DiskDevice()
+        self.keyboard = None        # Polled input source (IO.ScriptedKeyboard, IO.ThreadedKeyboard)
+        self.recorder = None        # IO.IORecorder logging all device I/O
         
         self.initialize_bios_data()
 
+    def spawn(self, count=1):
+        """Clone this machine count times without re-running __init__ or the BIOS setup
+
+        The clones share one snapshot of this machine's memory copy-on-write
+        (see memory.CowMemory), so each costs a page table plus the pages it
+        writes; a template whose memory is already a CowMemory shares it too.
+        Registers, flags and BDA contents are copied as they are now; each
+        clone gets its own console (same settings), timer and a fork of the
+        disk, and no keyboard, recorder or display.
+        """
+        if self.mmu is not None:
+            raise ValueError("Machines with an MMU cannot be spawned")
+        self.console.flush()
+        base = self.mem if isinstance(self.mem, CowMemory) else CowMemory.from_list(self.mem)
+        state = dict(self.__dict__)
+        state.update(screen=None, clock=None, font=None, last_key_event=None, graphics=None,
+                     display_tracker=None, keyboard=None, recorder=None, ipi_handler=None)
+        console = self.console
+        clones = []
+        for _ in range(count):
+            clone = cpu.__new__(cpu)
+            clone.__dict__.update(state)
+            clone.regs = self.regs[:]
+            clone.mem = base.fork()
+            clone.console = ConsoleDevice(console.target, console.buffer_size,
+                                          console.line_threshold, console.capture)
+            clone.timer = TimerDevice()
+            clone.disk = self.disk.fork()
+            clones.append(clone)
+        return clones
+
     def execute(self, instruction):
         format = (instruction >> 30) & 0b11
         opcode = (instruction >> 24) & 0b111111
         
-        try:
-            match format:
-                case 0b00:  # Register-Register
-                    rd = (instruction >> 8) & 0xF
-                    rs1 = (instruction >> 4) & 0xF
-                    rs2 = instruction & 0xF
-                    self.exec_rr(opcode, rd, rs1, rs2)
-                
-                case 0b01:  # Register-Immediate
-                    rd = (instruction >> 16) & 0xF
-                    imm = instruction & 0xFFFF
-                    # Sign extend 16-bit immediate
-                    if imm & 0x8000:
-                        imm |= 0xFFFF0000
-                    self.exec_ri(opcode, rd, imm)
-                
-                case 0b10:  # Register-Memory
-                    rd = (instruction >> 19) & 0xF
-                    mode = (instruction >> 17) & 0b11
-                    mem_field = instruction & 0x1FFFF
-                    address = self.calc_address(mode, mem_field)
-                    self.exec_rm(opcode, rd, address)
-                
-                case 0b11:  # Register-Condition-Memory
-                    reg = (instruction >> 19) & 0xF
-                    condition = (instruction >> 16) & 0b111
-                    address = instruction & 0xFFFF
-                    self.exec_rcm(opcode, reg, condition, address)
-        except ValueError as verr:
-            print("ERR: Error when parsing instruction: ", verr)
-            input("Press a key to continue... ")
-        except ZeroDivisionError as zde:
-            print("ERR: Division by 0 occured.")
-            input("Press a key to continue... ")
-        except Exception as exe:
-            print("FATAL: Other error occured... ", exe)
-            print("If you're reading this, I messed up somehow.")
-            self.run = False
-            print("CPU halted.")
+        # Faults are raised as CPUTrap/IndexError and handled by the run loop,
+        # so there is no per-instruction exception frame here.
+        match format:
+            case 0b00:  # Register-Register
+                rd = (instruction >> 8) & 0xF
+                rs1 = (instruction >> 4) & 0xF
+                rs2 = instruction & 0xF
+                self.exec_rr(opcode, rd, rs1, rs2)
+            
+            case 0b01:  # Register-Immediate
+                rd = (instruction >> 16) & 0xF
+                imm = instruction & 0xFFFF
+                # Sign extend 16-bit immediate
+                if imm & 0x8000:
+                    imm |= 0xFFFF0000
+                self.exec_ri(opcode, rd, imm)
+            
+            case 0b10:  # Register-Memory
+                rd = (instruction >> 19) & 0xF
+                mode = (instruction >> 17) & 0b11
+                mem_field = instruction & 0x1FFFF
+                address = self.calc_address(mode, mem_field)
+                self.exec_rm(opcode, rd, address)
+            
+            case 0b11:  # Register-Condition-Memory
+                reg = (instruction >> 19) & 0xF
+                condition = (instruction >> 16) & 0b111
+                address = instruction & 0xFFFF
+                self.exec_rcm(opcode, reg, condition, address)
 
     def calc_address(self, mode, mem_field):
         match mode:
@@ -123,13 +233,17 @@ class cpu:
 
     def push(self, value):
         """Push value onto stack"""
-        self.regs[7] -= 1  # SP is register 7
-        self.mem[self.regs[7]] = value & 0xFFFF
+        sp = (self.regs[7] - 1) & 0xFFFF  # SP is register 7
+        if sp < self.stack_limit:
+            raise CPUTrap(TRAP_STACK_FAULT, "stack overflow")
+        self.regs[7] = sp
+        self.mem[sp] = value & 0xFFFF
 
     def pop(self):
         """Pop value from stack"""
-        value = self.mem[self.regs[7]]
-        self.regs[7] += 1
+        sp = self.regs[7]
+        value = self.mem[sp]
+        self.regs[7] = (sp + 1) & 0xFFFF
         return value
 
     def exec_rr(self, opcode, rd, rs1, rs2):
@@ -163,6 +277,8 @@ class cpu:
                 self.regs[rd] = result & 0xFFFF
 
             case 0x13:  # DIV
+                if self.regs[rs2] == 0:
+                    raise CPUTrap(TRAP_DIVIDE_ERROR)
                 result = self.regs[rs1] // self.regs[rs2]
                 self.update_flags(result)
                 self.regs[rd] = result & 0xFFFF
@@ -213,7 +329,7 @@ class cpu:
                 self.pc = self.pop()
 
             case 0x25:  # HLT
-                self.run = False
+                self.halt()
 
             case 0x26:  # NOP
                 pass
@@ -226,9 +342,13 @@ class cpu:
 
             case 0x33:  # CLI
                 self.ie = False
+
+            case 0x34:  # IPI (core in RD, vector in RS1)
+                if self.ipi_handler:
+                    self.ipi_handler(self.regs[rd], self.regs[rs1] & 0xF)
                 
             case _:
-                raise ValueError(f"Unknown RR opcode: {opcode:#x}")
+                raise CPUTrap(TRAP_INVALID_OPCODE, f"Unknown RR opcode: {opcode:#x}")
 
     def exec_ri(self, opcode, rd, imm):
         """Execute Register-Immediate instructions"""
@@ -252,6 +372,8 @@ class cpu:
                 self.regs[rd] = result & 0xFFFF
 
             case 0x13:  # DIV
+                if imm == 0:
+                    raise CPUTrap(TRAP_DIVIDE_ERROR)
                 result = self.regs[rd] // imm
                 self.update_flags(result)
                 self.regs[rd] = result & 0xFFFF
@@ -330,7 +452,7 @@ class cpu:
                 self.pc = self.pop()
 
             case 0x25:  # HLT
-                self.run = False
+                self.halt()
 
             case 0x26:  # NOP
                 pass
@@ -342,26 +464,41 @@ class cpu:
                 self.push(self.regs[1])   # Save B  
                 self.push(self.regs[2])   # Save C
     
-                # Call the appropriate BIOS service
-                match imm:
-                    case 0x01:  # Video Services
-                        self.bios_video_services()
-                    case 0x02:  # Keyboard Services  
-                        self.bios_keyboard_services()
-                    case 0x03:  # Console I/O Services
-                        self.bios_console_services()
-                    case 0x04:  # Disk Services
-                        self.bios_disk_services()
-                    case 0x05:  # System Services
-                        self.bios_system_services()
-                    case _:
-                        print(f"Unknown BIOS service: {imm:#x}")
+                # Call the appropriate BIOS service; it returns the registers it sets
+                outputs = None
+                try:
+                    match imm:
+                        case 0x01:  # Video Services
+                            outputs = self.bios_video_services()
+                        case 0x02:  # Keyboard Services  
+                            outputs = self.bios_keyboard_services()
+                        case 0x03:  # Console I/O Services
+                            outputs = self.bios_console_services()
+                        case 0x04:  # Disk Services
+                            outputs = self.bios_disk_services()
+                        case 0x05:  # System Services
+                            outputs = self.bios_system_services()
+                        case _:
+                            raise CPUTrap(TRAP_INVALID_OPCODE, f"Unknown BIOS service: {imm:#x}")
+                except (CPUTrap, IndexError, ValueError) as error:
+                    # Unwind the frame so the trap sees the stack of a plain faulting instruction
+                    self.regs[2] = self.pop()
+                    self.regs[1] = self.pop()
+                    self.regs[0] = self.pop()
+                    self.pc = self.pop()
+                    if isinstance(error, ValueError):
+                        # A device refused the request (e.g. a disk sector it does not have)
+                        raise CPUTrap(TRAP_MEMORY_FAULT, str(error)) from error
+                    raise
+                results = self.regs[:3]
     
                 # Restore state and return
                 self.regs[2] = self.pop()  # Restore C
                 self.regs[1] = self.pop()  # Restore B
                 self.regs[0] = self.pop()  # Restore A
                 self.pc = self.pop()       # Restore PC
+                for reg in outputs or ():
+                    self.regs[reg] = results[reg]  # Return values survive the restore
                 # Note: interrupts remain enabled during BIOS calls
 
             case 0x31:  # RTI
@@ -375,7 +512,7 @@ class cpu:
                 self.ie = False
                 
             case _:
-                raise ValueError(f"Unknown RI opcode: {opcode:#x}")
+                raise CPUTrap(TRAP_INVALID_OPCODE, f"Unknown RI opcode: {opcode:#x}")
 
     def exec_rm(self, opcode, rd, address):
         """Execute Register-Memory instructions"""
@@ -386,6 +523,21 @@ class cpu:
             
             case 0x01:  # STR (store to memory)
                 self.mem[address] = self.regs[rd]
+
+            case 0x05:  # TAS (atomic test-and-set, ZF set if the lock was free)
+                with self.bus_lock:
+                    old = self.mem[address]
+                    self.mem[address] = 1
+                self.regs[rd] = old
+                self.zf = old == 0
+
+            case 0x06:  # CAS (atomic compare-and-swap against A, ZF set on success)
+                with self.bus_lock:
+                    old = self.mem[address]
+                    if old == self.regs[0]:
+                        self.mem[address] = self.regs[rd]
+                self.zf = old == self.regs[0]
+                self.regs[0] = old
             
             # Math instructions (0x1X)
             case 0x10:  # ADD (with memory)
@@ -406,12 +558,10 @@ class cpu:
             case 0x13:  # DIV (with memory)
                 divisor = self.mem[address]
                 if divisor == 0:
-                    # Handle division by zero - maybe trigger interrupt?
-                    self.regs[rd] = 0xFFFF
-                else:
-                    result = self.regs[rd] // divisor
-                    self.update_flags(result)
-                    self.regs[rd] = result & 0xFFFF
+                    raise CPUTrap(TRAP_DIVIDE_ERROR)
+                result = self.regs[rd] // divisor
+                self.update_flags(result)
+                self.regs[rd] = result & 0xFFFF
             
             case 0x14:  # AND (with memory)
                 result = self.regs[rd] & self.mem[address]
@@ -482,7 +632,7 @@ class cpu:
                 self.update_flags(result)
             
             case _:
-                raise ValueError(f"Unknown RM opcode: {opcode:#x}")
+                raise CPUTrap(TRAP_INVALID_OPCODE, f"Unknown RM opcode: {opcode:#x}")
 
     def exec_rcm(self, opcode, reg, condition, address):
         """Execute Register-Condition-Memory instructions"""
@@ -503,21 +653,93 @@ class cpu:
                 self.pc = address & 0xFFFF
                     
             case _:
-                raise ValueError(f"Unknown RCM opcode: {opcode:#x}")
+                raise CPUTrap(TRAP_INVALID_OPCODE, f"Unknown RCM opcode: {opcode:#x}")
 
     def step(self):
-        """Execute one instruction"""
+        """Execute one instruction, delivering a fault it raises as a guest trap"""
         if not self.run:
             return
-            
-        instruction = self.mem[self.pc]
-        self.pc += 1
-        self.execute(instruction)
+
+        pc = self.pc
+        try:
+            instruction = self.mem[pc]
+        except (CPUTrap, IndexError) as error:
+            self.handle_fault(error, pc, retired=False)     # Nothing was fetched
+            return
+        self.pc = pc + 1
+        try:
+            self.execute(instruction)
+        except (CPUTrap, IndexError) as error:
+            self.handle_fault(error, pc)
+            return
+        self.cycles += 1
 
     def run_continuous(self):
         """Run until HLT instruction or error"""
         while self.run:
             self.step()
+        self.console.flush()
+
+    def run_for(self, count):
+        """Run at most count instructions, handling traps; returns instructions retired"""
+        start = self.cycles
+        steps = 0
+        while self.run and steps < count:
+            self.step()
+            steps += 1
+        return self.cycles - start
+
+    def halt(self, reason="HLT"):
+        """Stop the CPU and flush buffered device output"""
+        self.run = False
+        self.halt_reason = reason
+        self.console.flush()
+
+    def handle_fault(self, error, pc=None, retired=True):
+        """Turn an exception raised by an instruction into a guest trap
+
+        pc is the address the instruction was fetched from; engines that
+        leave the PC just past it may omit it. A faulting instruction
+        retires, unless the fault was in fetching it.
+        """
+        if isinstance(error, CPUTrap):
+            trap = error
+        elif isinstance(error, IndexError):
+            trap = CPUTrap(TRAP_MEMORY_FAULT, f"bad memory access: {error}")
+        else:
+            raise error
+        if trap.pc is None:
+            trap.pc = (self.pc - 1 if pc is None else pc) & 0xFFFF
+        if retired:
+            self.cycles += 1
+        self.trap(trap)
+
+    def trap(self, trap):
+        """Vector a CPUTrap to its guest handler, or halt if there is none"""
+        self.last_trap = trap
+        try:
+            if self.mem[self.INTERRUPT_VECTORS + trap.vector] == 0:
+                self.halt("TRAP")
+                return
+            self.mem[self.FAULT_PC] = trap.pc
+            self.mem[self.FAULT_VECTOR] = trap.vector
+            self.interrupt(trap.vector)
+        except (CPUTrap, IndexError):
+            # The vector table, fault words or stack cannot be used (e.g. a read-only BDA page)
+            self.halt("DOUBLE_FAULT")
+
+    def interrupt(self, vector):
+        """Enter the handler for an interrupt vector (return with RI RTI)
+
+        Interrupts are disabled on entry; a handler that wants to be
+        interrupted again re-enables them with STI.
+        """
+        handler = self.mem[self.INTERRUPT_VECTORS + vector]
+        self.push(self.pc)          # Return address
+        self.push(self.regs[0])     # Save A
+        self.regs[0] = vector       # Handler receives the vector in A
+        self.pc = handler
+        self.ie = False
 
     def debug_state(self):
         """Print current CPU state for debugging"""
@@ -554,13 +776,30 @@ class cpu:
         screen_width = self.read_bda_byte(self.SCREEN_WIDTH)
         screen_height = self.read_bda_byte(self.SCREEN_HEIGHT)
         video_base = self.read_bda_word(self.VIDEO_MEMORY_BASE)
+        if video_mode == GRAPHICS_MODE:
+            video_end = video_base + FRAMEBUFFER_WORDS
+        else:
+            video_end = video_base + screen_width * screen_height
+
+        # Redraw only if video memory or the BDA (cursor, mode, palette) changed
+        tracker = self.display_tracker
+        if tracker is not None and tracker.memory is not self.mem:
+            # Memory was replaced (rewind journal, MMU): start over with a full redraw
+            tracker = self.display_tracker = (
+                self.mem.tracker(dirty=True) if isinstance(self.mem, DirtyMemory) else None)
+        if tracker is None or tracker.is_dirty(video_base, video_end) or tracker.is_dirty(
+                self.BDA_BASE, self.BDA_BASE + 0x100):
+            if tracker is not None:
+                tracker.clear()
+
+            # Clear screen
+            self.screen.fill((0, 0, 0))
         
-        # Clear screen
-        self.screen.fill((0, 0, 0))
-        
-        # Render text mode (mode 0x03 - 80x25 text)
-        if video_mode == 0x03:
-            self.render_text_mode(video_base, screen_width, screen_height)
+            # Render text mode (mode 0x03 - 80x25 text)
+            if video_mode == 0x03:
+                self.render_text_mode(video_base, screen_width, screen_height)
+            elif video_mode == GRAPHICS_MODE:
+                self.render_graphics_mode(video_base)
         
         # Update display
         pygame.display.flip()
@@ -599,6 +838,14 @@ class cpu:
                         (cursor_x * char_width, cursor_y * char_height, 
                          char_width, 2))
                          
+    def render_graphics_mode(self, video_base):
+        """Render the mode 0x13 framebuffer (requires NumPy)"""
+        if self.graphics is None:
+            from video import GraphicsRenderer
+            self.graphics = GraphicsRenderer()
+        palette = self.mem[self.PALETTE:self.PALETTE + 16]
+        self.graphics.render(self, self.screen, video_base, palette)
+
     def handle_pygame_events(self):
         """Handle Pygame events and convert to CPU keyboard input"""
         for event in pygame.event.get():
@@ -608,28 +855,12 @@ class cpu:
                 sys.exit()
                 
             elif event.type == pygame.KEYDOWN:
-                # Handle special keys
-                if event.key == pygame.K_RETURN:
-                    self.add_key_to_buffer(13)  # Carriage return
-                    self.add_key_to_buffer(10)  # Line feed
-                elif event.key == pygame.K_BACKSPACE:
-                    self.add_key_to_buffer(8)   # Backspace
-                elif event.key == pygame.K_ESCAPE:
-                    self.add_key_to_buffer(27)  # Escape
-                elif event.key == pygame.K_TAB:
-                    self.add_key_to_buffer(9)   # Tab
-                elif event.key == pygame.K_UP:
-                    self.add_key_to_buffer(0x48)  # Up arrow
-                elif event.key == pygame.K_DOWN:
-                    self.add_key_to_buffer(0x50)  # Down arrow
-                elif event.key == pygame.K_LEFT:
-                    self.add_key_to_buffer(0x4B)  # Left arrow
-                elif event.key == pygame.K_RIGHT:
-                    self.add_key_to_buffer(0x4D)  # Right arrow
+                keyboard = self.keyboard
+                if isinstance(keyboard, ThreadedKeyboard) and keyboard.thread is None:
+                    for key in pygame_key_codes(event):
+                        keyboard.push(key)
                 else:
-                    # Regular character
-                    if event.unicode and ord(event.unicode) >= 32:
-                        self.add_key_to_buffer(ord(event.unicode))
+                    self.add_keys_to_buffer(pygame_key_codes(event))
     
     def step_with_display(self):
         """Execute one instruction and update display"""
@@ -646,13 +877,19 @@ class cpu:
         # Update display
         self.update_display()
     
-    def run_with_display(self):
-        """Run CPU continuously with Pygame display"""
+    def run_with_display(self, instructions_per_frame=20000):
+        """Run CPU continuously with Pygame display, redrawing once per frame"""
         self.initialize_pygame()
+        if type(self.mem) is list:
+            self.mem = DirtyMemory(self.mem)
+        if isinstance(self.mem, DirtyMemory):
+            self.display_tracker = self.mem.tracker(dirty=True)    # First frame draws everything
         
         while self.run:
-            self.step_with_display()
+            self.run_for(instructions_per_frame)
+            self.update_display()   # Also paces the loop to 60 FPS
             
+        self.console.flush()
         pygame.quit()
     def initialize_bios_data(self):
         """Initialize BIOS Data Area with default values"""
@@ -668,33 +905,37 @@ class cpu:
         self.write_bda_byte(self.KEYBOARD_BUFFER_TAIL, 0)
         
         # System information
-        self.write_bda_word(self.VIDEO_MEMORY_BASE, 0xA000)
-        self.write_bda_word(self.INSTALLED_MEMORY, 65536)  # 64KB
+        self.write_bda_word(self.VIDEO_MEMORY_BASE, VIDEO_MEMORY)
+        installed = len(self.mmu.physical) if self.mmu else len(self.mem)
+        self.write_bda_word(self.INSTALLED_MEMORY, installed // 1024)
         
         # Clear keyboard buffer area
         for i in range(32):
             self.write_bda_byte(self.KEYBOARD_BUFFER + i, 0)
+
+        # Graphics palette
+        self.mem[self.PALETTE:self.PALETTE + 16] = DEFAULT_PALETTE
     
     def read_bda_byte(self, address):
         """Read byte from BIOS Data Area"""
         if self.BDA_BASE <= address < self.BDA_BASE + 4096:
             return self.mem[address]
         else:
-            raise ValueError(f"Invalid BDA access: {address:#06x}")
+            raise CPUTrap(TRAP_MEMORY_FAULT, f"Invalid BDA access: {address:#06x}")
     
     def write_bda_byte(self, address, value):
         """Write byte to BIOS Data Area"""
         if self.BDA_BASE <= address < self.BDA_BASE + 4096:
             self.mem[address] = value & 0xFF
         else:
-            raise ValueError(f"Invalid BDA access: {address:#06x}")
+            raise CPUTrap(TRAP_MEMORY_FAULT, f"Invalid BDA access: {address:#06x}")
     
     def read_bda_word(self, address):
         """Read word from BIOS Data Area"""
         if self.BDA_BASE <= address < self.BDA_BASE + 4095:
             return self.mem[address] | (self.mem[address + 1] << 8)
         else:
-            raise ValueError(f"Invalid BDA access: {address:#06x}")
+            raise CPUTrap(TRAP_MEMORY_FAULT, f"Invalid BDA access: {address:#06x}")
     
     def write_bda_word(self, address, value):
         """Write word to BIOS Data Area"""
@@ -702,7 +943,7 @@ class cpu:
             self.mem[address] = value & 0xFF
             self.mem[address + 1] = (value >> 8) & 0xFF
         else:
-            raise ValueError(f"Invalid BDA access: {address:#06x}")
+            raise CPUTrap(TRAP_MEMORY_FAULT, f"Invalid BDA access: {address:#06x}")
         
     def bios_video_services(self):
         """INT 0x01 - Video Services using BDA"""
@@ -712,6 +953,7 @@ class cpu:
             case 0x00:  # Set Video Mode
                 mode = self.regs[1]
                 self.write_bda_byte(self.VIDEO_MODE, mode)
+                self.clear_screen()
             
             case 0x01:  # Clear Screen
                 self.clear_screen()
@@ -725,11 +967,47 @@ class cpu:
             case 0x03:  # Get Cursor Position
                 self.regs[1] = self.read_bda_byte(self.CURSOR_X)  # B = X
                 self.regs[2] = self.read_bda_byte(self.CURSOR_Y)  # C = Y
+                return (1, 2)
             
             case 0x0E:  # Teletype Output
                 char = self.regs[1] & 0xFF
                 self.bios_print_char(char)
 
+            case 0x0C | 0x0D | 0x10 | 0x11:  # Graphics drawing (mode 0x13 only)
+                if self.read_bda_byte(self.VIDEO_MODE) == GRAPHICS_MODE:
+                    return self.bios_graphics_services(function)
+
+            case 0x12:  # Set Palette Entry (B = index, C = 0xRGB)
+                self.mem[self.PALETTE + (self.regs[1] & 0xF)] = self.regs[2] & 0xFFF
+
+    def bios_graphics_services(self, function):
+        """INT 0x01 drawing functions, done in bulk on the packed framebuffer"""
+        import video
+        base = self.read_bda_word(self.VIDEO_MEMORY_BASE)
+        regs = self.regs
+        match function:
+            case 0x0C:  # Write Pixel (B = x, C = y, D = colour)
+                video.plot_pixel(self, base, regs[1], regs[2], regs[3])
+            case 0x0D:  # Read Pixel (B = x, C = y) -> A = colour
+                regs[0] = video.read_pixel(self, base, regs[1], regs[2])
+                return (0,)
+            case 0x10:  # Draw Line (B, C) to (D, X) in colour Y
+                video.draw_line(self, base, regs[1], regs[2], regs[3], regs[4], regs[5])
+            case 0x11:  # Fill Rectangle at (B, C), D wide, X high, colour Y
+                video.fill_rect(self, base, regs[1], regs[2], regs[3], regs[4], regs[5])
+
+    def clear_screen(self):
+        """Blank the screen in the current video mode and home the cursor"""
+        video_base = self.read_bda_word(self.VIDEO_MEMORY_BASE)
+        if self.read_bda_byte(self.VIDEO_MODE) == GRAPHICS_MODE:
+            size = FRAMEBUFFER_WORDS
+        else:
+            size = self.read_bda_byte(self.SCREEN_WIDTH) * self.read_bda_byte(self.SCREEN_HEIGHT)
+        size = max(0, min(size, len(self.mem) - video_base))
+        self.mem[video_base:video_base + size] = [0] * size
+        self.write_bda_byte(self.CURSOR_X, 0)
+        self.write_bda_byte(self.CURSOR_Y, 0)
+
     def bios_print_char(self, char):
         """Print character using BDA cursor position"""
         # Get current cursor from BDA
@@ -786,6 +1064,7 @@ class cpu:
     def bios_keyboard_services(self):
         """INT 0x02 - Keyboard Services using BDA circular buffer"""
         function = self.regs[0]
+        self.poll_keyboard()
     
         match function:
             case 0x00:  # Get Keystroke
@@ -800,21 +1079,57 @@ class cpu:
                     head = (head + 1) % 32
                     self.write_bda_byte(self.KEYBOARD_BUFFER_HEAD, head)
                     self.regs[0] = key  # Return key
+                return (0,)
         
             case 0x01:  # Check for Keystroke
                 head = self.read_bda_byte(self.KEYBOARD_BUFFER_HEAD)
                 tail = self.read_bda_byte(self.KEYBOARD_BUFFER_TAIL)
                 self.regs[0] = 0xFFFF if head != tail else 0x0000
+                return (0,)
+
+    def poll_keyboard(self):
+        """Let the attached input source deliver keys that are due"""
+        if self.keyboard is not None:
+            self.keyboard.poll(self)
+
+    def wait_for_key(self):
+        """Block until a key is buffered; False if no input source can supply one"""
+        while self.read_io(0x9004) == 0:
+            if self.keyboard is not None and self.keyboard.wait(self):
+                continue
+            if self.screen:
+                self.update_display()   # Pumps pygame key events
+                continue
+            return False
+        return True
 
     def add_key_to_buffer(self, key):
         """Add key to keyboard buffer (called by hardware)"""
-        head = self.read_bda_byte(self.KEYBOARD_BUFFER_HEAD)
-        tail = self.read_bda_byte(self.KEYBOARD_BUFFER_TAIL)
-    
-        next_tail = (tail + 1) % 32
-        if next_tail != head:  # Buffer not full
-            self.write_bda_byte(self.KEYBOARD_BUFFER + tail, key & 0xFF)
-            self.write_bda_byte(self.KEYBOARD_BUFFER_TAIL, next_tail)
+        self.add_keys_to_buffer((key,))
+
+    def add_keys_to_buffer(self, keys):
+        """Add keys to the keyboard buffer, reading and writing head/tail once
+
+        Returns how many were stored; keys that find the buffer full are lost.
+        """
+        mem = self.mem
+        head = mem[self.KEYBOARD_BUFFER_HEAD]
+        tail = mem[self.KEYBOARD_BUFFER_TAIL]
+        stored = 0
+        for key in keys:
+            if self.recorder:
+                self.recorder.record(IO_KEY, self.cycles, key)
+            next_tail = (tail + 1) % 32
+            if next_tail != head:  # Buffer not full
+                mem[self.KEYBOARD_BUFFER + tail] = key & 0xFF
+                tail = next_tail
+                stored += 1
+        mem[self.KEYBOARD_BUFFER_TAIL] = tail
+        return stored
+
+    def keyboard_buffer_space(self):
+        """Keys the BDA keyboard buffer can take before it is full"""
+        return (self.mem[self.KEYBOARD_BUFFER_HEAD] - self.mem[self.KEYBOARD_BUFFER_TAIL] - 1) % 32
 
     def bios_console_services(self):
         """INT 0x03 - Console I/O Services"""
@@ -827,22 +1142,26 @@ class cpu:
             case 0x01:  # Print String
                 # B = address of null-terminated string
                 addr = self.regs[1]
+                data = bytearray()
                 while True:
                     char = self.mem[addr] & 0xFF
                     if char == 0:
                         break
-                    self.write_io(0x9000, char)
+                    data.append(char)
                     addr += 1
+                self.console.write_bytes(data)  # One buffer append per string
+                if self.recorder:
+                    self.recorder.record(IO_CONSOLE, self.cycles, 0, bytes(data))
             case 0x02:  # Read Character
-                # Wait for keypress
-                while self.read_io(0x9004) == 0:
-                    pass  # Busy wait
-                self.regs[0] = self.read_io(0x9005)
+                self.wait_for_key()
+                self.regs[0] = self.read_io(0x9005)  # 0 if no key can arrive
+                return (0,)
             case 0x03:  # Check Key
                 if self.read_io(0x9004):
                     self.regs[0] = 0xFFFF
                 else:
                     self.regs[0] = 0x0000
+                return (0,)
 
     def bios_disk_services(self):
         """INT 0x04 - Disk Services"""
@@ -852,15 +1171,26 @@ class cpu:
             case 0x00:  # Read Sector
                 sector = self.regs[1]
                 buffer_addr = self.regs[2]
-                # Simulate disk read
-                for i in range(512):  # Standard sector size
-                    self.mem[buffer_addr + i] = self.disk_data[sector * 512 + i]
+                self.check_disk_request(sector, buffer_addr)
+                words = self.disk.read_sector(sector)
+                self.mem[buffer_addr:buffer_addr + SECTOR_SIZE] = words
+                if self.recorder:
+                    self.recorder.record(IO_DISK_READ, self.cycles, sector, pack_words(words))
             case 0x01:  # Write Sector
                 sector = self.regs[1]
                 buffer_addr = self.regs[2]
-                # Simulate disk write
-                for i in range(512):
-                    self.disk_data[sector * 512 + i] = self.mem[buffer_addr + i]
+                self.check_disk_request(sector, buffer_addr)
+                words = self.mem[buffer_addr:buffer_addr + SECTOR_SIZE]
+                self.disk.write_sector(sector, words)
+                if self.recorder:
+                    self.recorder.record(IO_DISK_WRITE, self.cycles, sector, pack_words(words))
+
+    def check_disk_request(self, sector, buffer_addr):
+        """Raise a memory fault for a sector past the disk or a buffer past memory"""
+        if not 0 <= sector < self.disk.sectors:
+            raise CPUTrap(TRAP_MEMORY_FAULT, f"disk sector {sector} out of range")
+        if buffer_addr + SECTOR_SIZE > len(self.mem):
+            raise CPUTrap(TRAP_MEMORY_FAULT, f"sector buffer {buffer_addr:#06x} out of range")
 
     def bios_system_services(self):
         """INT 0x05 - System Services"""
@@ -873,6 +1203,62 @@ class cpu:
                 self.write_io(0x900B, 0x0002)
             case 0x02:  # Get Timer
                 self.regs[0] = self.read_io(0x9002)
+                return (0,)
             case 0x03:  # Play Sound
                 frequency = self.regs[1]
-                self.write_io(0x9006, frequency)
\ No newline at end of file
+                self.write_io(0x9006, frequency)
+            case 0x04:  # Map Page (B = virtual page, C = mapping register)
+                self.write_io(0x9100 + (self.regs[1] & 0xF), self.regs[2])
+            case 0x05:  # Get Page Mapping (B = virtual page)
+                self.regs[0] = self.read_io(0x9100 + (self.regs[1] & 0xF))
+                return (0,)
+
+    def write_io(self, port, value):
+        """Write a value to an I/O port"""
+        match port:
+            case 0x9000:  # Console output
+                self.console.write_char(value & 0xFF)
+                if self.recorder:
+                    self.recorder.record(IO_CONSOLE, self.cycles, 0, bytes((value & 0xFF,)))
+            case 0x9006:  # Sound frequency (no audio device attached)
+                pass
+            case _ if 0x9100 <= port <= 0x910F:  # MMU page mapping registers
+                if self.mmu:
+                    self.mmu.map(port - 0x9100, value)
+            case 0x900B:  # System control
+                if value == 0x0001:  # Reset
+                    self.console.flush()
+                    self.regs = [0] * 16
+                    self.pc = 0
+                    if self.mmu:
+                        self.mmu.reset()
+                    self.initialize_bios_data()
+                elif value == 0x0002:  # Shutdown
+                    self.halt("SHUTDOWN")
+
+    def read_io(self, port):
+        """Read a value from an I/O port"""
+        match port:
+            case 0x9002:  # Timer (milliseconds since power on)
+                value = self.timer.read()
+                if self.recorder:
+                    self.recorder.record(IO_TIMER, self.cycles, value)
+                return value
+            case 0x9004:  # Keyboard status
+                self.poll_keyboard()
+                head = self.read_bda_byte(self.KEYBOARD_BUFFER_HEAD)
+                tail = self.read_bda_byte(self.KEYBOARD_BUFFER_TAIL)
+                return 1 if head != tail else 0
+            case 0x9005:  # Keyboard data
+                self.poll_keyboard()
+                head = self.read_bda_byte(self.KEYBOARD_BUFFER_HEAD)
+                tail = self.read_bda_byte(self.KEYBOARD_BUFFER_TAIL)
+                if head == tail:
+                    return 0
+                key = self.read_bda_byte(self.KEYBOARD_BUFFER + head)
+                self.write_bda_byte(self.KEYBOARD_BUFFER_HEAD, (head + 1) % 32)
+                return key
+            case _ if 0x9100 <= port <= 0x910F:  # MMU page mapping registers
+                return self.mmu.registers[port - 0x9100] if self.mmu else port - 0x9100
+            case _:
+                return 0
@@ -0,0 +1,781 @@
+import random
+
+import pytest
+
+import mmu
+from assembler import Assembler
+from cosim import (Divergence, fuzz, machine_state, make_machine, memory_difference,
+                   random_program)
+from cpu import (TRAP_DIVIDE_ERROR, TRAP_INVALID_OPCODE, TRAP_MEMORY_FAULT, TRAP_STACK_FAULT,
+                 cpu)
+from IO import ConsoleDevice
+
+PROGRAMS = 8
+INSTRUCTIONS = 3000
+
+def assemble(source):
+    return Assembler().assemble(source)
+
+def run_source(source, limit=10000):
+    machine = make_machine(assemble(source))
+    machine.run_for(limit)
+    return machine
+
+class FakeTerminal:
+    def __init__(self, tty=False):
+        self.tty = tty
+        self.writes = []
+
+    def isatty(self):
+        return self.tty
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def flush(self):
+        pass
+
+def test_console_capture_collects_guest_output():
+    machine = make_machine(assemble("""
+        RI MOV A, 0
+        RI MOV B, 72
+        RI INT A, 3
+        RI MOV A, 1
+        RI MOV B, 0x9000
+        RI INT A, 3
+        RR HLT A, A, A
+    """))
+    machine.mem[0x9000:0x9008] = list(b"i there") + [0]
+    machine.run_for(100)
+    assert machine.halt_reason == "HLT"
+    assert machine.console.getvalue() == "Hi there"
+    assert machine.console.host_writes == 0
+
+def test_console_flushes_by_size_unless_writing_to_a_terminal():
+    pipe = FakeTerminal()
+    console = ConsoleDevice(pipe, buffer_size=8)
+    assert console.line_threshold == 0
+    console.write_bytes(b"a\nb\n")
+    console.write_char(ord("c"))
+    assert pipe.writes == []
+    console.write_bytes(b"defgh")
+    assert pipe.writes == [b"a\nb\ncdefgh"]
+    console.write_char(10)
+    console.close()
+    assert pipe.writes[-1] == b"\n" and console.host_writes == 2
+
+    terminal = FakeTerminal(tty=True)
+    console = ConsoleDevice(terminal)
+    assert console.line_threshold == 1
+    console.write_bytes(b"one")
+    assert terminal.writes == []
+    console.write_char(10)
+    assert terminal.writes == [b"one\n"]
+
+def test_console_line_threshold_on_request():
+    writes = []
+    console = ConsoleDevice(writes.append, line_threshold=2)
+    console.write_bytes(b"1\n")
+    assert writes == []
+    console.write_bytes(b"2\n3")
+    assert writes == [b"1\n2\n3"]
+
+def trap_machine(setup, faulting):
+    """Machine whose handler for every trap vector records FAULT_PC/FAULT_VECTOR in X/Y"""
+    lines = ["RI MOV SP, 0x9000"]
+    for vector in range(4):
+        lines += ["RI MOV A, HANDLER", f"RM STR A, [{0xE080 + vector:#x}]"]
+    lines += setup + [faulting, "RR HLT A, A, A",
+                      "HANDLER:", "RM MOV X, [0xE090]", "RM MOV Y, [0xE091]", "RR HLT A, A, A"]
+    return make_machine(assemble("\n".join(lines))), 9 + len(setup)
+
+@pytest.mark.parametrize("setup, faulting, vector", [
+    ([], "RR NOP A, A, A", TRAP_INVALID_OPCODE),             # Patched to an unknown opcode
+    (["RI MOV B, 0"], "RR DIV A, A, B", TRAP_DIVIDE_ERROR),
+    (["RI MOV MP1, 0xFFFF"], "RM MOV A, [MP1 + 1]", TRAP_MEMORY_FAULT),
+    ([], "RI INT A, 9", TRAP_INVALID_OPCODE),                # Unknown BIOS service
+    (["RI MOV A, 0", "RI MOV B, 5000"], "RI INT A, 4", TRAP_MEMORY_FAULT),     # Bad sector
+    (["RI MOV B, 0x1000", "RM STR B, [0xE030]", "RI MOV A, 2"],      # Keyboard head
+     "RI INT A, 3", TRAP_MEMORY_FAULT),                                  # outside the BDA
+])
+def test_traps_reach_the_guest_handler(setup, faulting, vector):
+    machine, fault_pc = trap_machine(setup, faulting)
+    if faulting == "RR NOP A, A, A":
+        machine.mem[fault_pc] = 0x3F000000
+    machine.run_for(100)
+    assert machine.halt_reason == "HLT"
+    assert machine.last_trap.vector == vector
+    assert machine.regs[0] == vector
+    assert (machine.regs[4], machine.regs[5]) == (fault_pc, vector)
+    assert machine.regs[7] == 0x9000 - 2      # Only the trap frame; BIOS calls unwind theirs
+
+def test_stack_fault_without_room_for_the_handler_is_a_double_fault():
+    machine, fault_pc = trap_machine([], "RR PSH A, A, A")
+    machine.stack_limit = 0x9000
+    machine.run_for(100)
+    assert machine.halt_reason == "DOUBLE_FAULT"
+    assert machine.last_trap.vector == TRAP_STACK_FAULT
+    assert machine.mem[machine.FAULT_PC] == fault_pc
+    assert machine.mem[machine.FAULT_VECTOR] == TRAP_STACK_FAULT
+
+def test_fetch_fault_reports_the_fetched_address_and_does_not_retire():
+    machine = make_machine(assemble("RM JMP A, [0xFFFF]"))
+    machine.mem[0xFFFF] = assemble("RR NOP A, A, A")[0]
+    assert machine.run_for(10) == 2
+    assert machine.halt_reason == "TRAP"
+    assert machine.last_trap.vector == TRAP_MEMORY_FAULT
+    assert machine.last_trap.pc == 0x10000 & 0xFFFF
+    assert machine.cycles == 2
+
+def test_step_delivers_faults_instead_of_raising():
+    machine = make_machine(assemble("RI DIV A, 0"))
+    machine.step()
+    assert machine.halt_reason == "TRAP"
+    assert machine.last_trap.vector == TRAP_DIVIDE_ERROR
+    assert machine.last_trap.pc == 0 and machine.cycles == 1
+
+def test_trap_with_read_only_bios_data_area_is_a_double_fault():
+    machine, _ = trap_machine(["RI MOV B, 0"], "RR DIV A, A, B")
+    machine.run_for(9)
+    memory = mmu.enable(machine, 65536)
+    memory.map(0xE, 0xE | mmu.PAGE_READ_ONLY)
+    machine.run_for(100)
+    assert machine.halt_reason == "DOUBLE_FAULT"
+    assert machine.last_trap.vector == TRAP_DIVIDE_ERROR
+
+def test_smp_cores_run_bios_services():
+    from smp import SMPSystem
+    image = assemble("""
+        RR MOV Z, A, A
+        RI MOV A, 1
+        RI INT A, 1
+        RI MOV A, 0
+        RI MOV B, 0x13
+        RI INT A, 1
+        RI MOV A, 0x11
+        RI MOV B, 0
+        RI MOV C, 0
+        RI MOV D, 8
+        RI MOV X, 4
+        RI MOV Y, 5
+        RI INT A, 1
+        RI MOV A, 0x0D
+        RI MOV B, 3
+        RI MOV C, 2
+        RI INT A, 1
+        RI MOV MP1, 0x8900
+        RR ADD MP1, MP1, Z
+        RM STR A, [MP1 + 0]
+        RI MOV A, 0
+        RI MOV B, 0
+        RI MOV C, 0x8000
+        RI INT A, 4
+        RR HLT A, A, A
+    """)
+    with SMPSystem(2) as system:
+        system.load(image)
+        system.mem[0x8000:0x8010] = range(1, 17)
+        system.start(max_instructions=100000)
+        results = system.join(timeout=30)
+        assert [result['halt_reason'] for result in results] == ["HLT", "HLT"]
+        assert system.mem[0x8900:0x8902] == [5, 5]
+        assert system.mem[0x8000:0x8010] == [0] * 16     # Each core read a blank sector
+
+def test_shared_words_behave_like_a_list():
+    from memory import SharedWords
+    machine = cpu()
+    words = SharedWords(memoryview(bytearray(65536 * 4)).cast('I'))
+    words[:] = machine.mem
+    machine.mem = words
+    machine.initialize_bios_data()
+    palette = slice(machine.PALETTE, machine.PALETTE + 16)
+    assert words[palette] == cpu().mem[palette]
+    words[0x100:0x104:2] = [7, 8]
+    assert words[0x100:0x104] == [7, 0, 8, 0] and len(words) == 65536
+    with pytest.raises(IndexError):
+        words[0x10000]
+
+def test_interrupt_entry_disables_interrupts():
+    machine = make_machine(assemble("""
+        RI MOV SP, 0x9000
+        RI STI A, 0
+        RR HLT A, A, A
+    """))
+    machine.mem[0xE084] = 0x40
+    machine.run_for(10)
+    assert machine.ie
+    machine.interrupt(4)
+    assert not machine.ie and machine.pc == 0x40 and machine.regs[0] == 4
+
+def test_recorded_session_replays_exactly():
+    import io
+    from IO import SECTOR_SIZE, IORecorder, IOReplay, ScriptedKeyboard, read_io_log
+    image = assemble("""
+        RI MOV C, 3
+    LOOP:
+        RI MOV A, 2
+        RI INT A, 3
+        RR MOV B, A, A
+        RI MOV A, 0
+        RI INT A, 3
+        RI DEC C, 0
+        RCM JCF A, NE, LOOP
+        RI MOV A, 2
+        RI INT A, 5
+        RR MOV D, A, A
+        RI MOV A, 0
+        RI MOV B, 1
+        RI MOV C, 0x8000
+        RI INT A, 4
+        RR HLT A, A, A
+    """)
+    machine = make_machine(image)
+    machine.keyboard = ScriptedKeyboard.parse('5 "ab"  # two keys\n40 ENTER')
+    machine.disk.write_sector(1, [0x1234] * SECTOR_SIZE)
+    log = io.BytesIO()
+    with IORecorder(log) as recorder:
+        machine.recorder = recorder
+        machine.run_for(1000)
+    assert machine.halt_reason == "HLT"
+    assert machine.console.getvalue() == "ab\r"
+    assert machine.mem[0x8000] == 0x1234
+
+    replay = IOReplay(read_io_log(log.getvalue()))
+    replayed = make_machine(image)
+    replay.attach(replayed)
+    replayed.run_for(1000)
+    assert machine_state(replayed) == machine_state(machine)
+    assert memory_difference(machine, replayed) == []
+    assert replay.console_mismatch(replayed.console.getvalue()) is None
+    assert replay.console_mismatch("ab!") == 2
+
+def test_threaded_keyboard_delivers_every_key_through_the_ring():
+    from IO import ThreadedKeyboard
+    text = bytes(random.Random(4).choice(b"abcdefgh") for _ in range(200))
+    machine = make_machine(assemble("""
+        RI MOV C, 200
+    LOOP:
+        RI MOV A, 2
+        RI INT A, 3
+        RR MOV B, A, A
+        RI MOV A, 0
+        RI INT A, 3
+        RI DEC C, 0
+        RCM JCF A, NE, LOOP
+        RR HLT A, A, A
+    """))
+    with ThreadedKeyboard(iter(text)) as keyboard:
+        keyboard.thread.join()
+        assert len(keyboard.ring) == len(text)      # More than the BDA buffer holds
+        machine.keyboard = keyboard
+        machine.run_for(10000)
+    assert machine.halt_reason == "HLT"
+    assert machine.console.getvalue() == text.decode()
+    assert keyboard.dropped == 0 and len(keyboard.ring) == 0
+
+def test_code_cache_hits_misses_and_debug_map(tmp_path):
+    from aot import CompiledEngine
+    from codecache import CodeCache
+    source = """
+        RI MOV C, 5
+    LOOP:
+        RI DEC C, 0
+        RCM JCF A, NE, LOOP
+        RR HLT A, A, A
+    """
+    cache = CodeCache(str(tmp_path))
+    image = cache.assemble(source, "loop.asm")
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert cache.debug_map.label_for(2) == "LOOP" and cache.debug_map.line_for(1) == ("loop.asm", 4)
+
+    warm = CodeCache(str(tmp_path))
+    assert warm.assemble(source, "loop.asm") == image
+    assert (warm.hits, warm.misses) == (1, 0)
+    assert warm.debug_map.lines == cache.debug_map.lines
+    assert warm.debug_map.label_for(2) == "LOOP"
+
+    module = warm.compile_module(image)
+    assert warm.misses == 1
+    edited = warm.assemble("; same code\n" + source, "loop.asm")
+    assert edited == image and warm.misses == 2
+    machine = make_machine(image)
+    CompiledEngine(machine, warm.compile_module(edited)).run_for(100)
+    assert warm.hits == 2 and warm.misses == 2
+    assert machine.halt_reason == "HLT" and machine.cycles == 12
+    assert module.BLOCKS.keys() == warm.compile_module(image).BLOCKS.keys()
+
+    for entry in tmp_path.iterdir():
+        entry.write_bytes(b"corrupt")
+    assert warm.assemble(source, "loop.asm") == image and warm.misses == 3
+
+PROFILED = """
+START:
+    RI MOV SP, 0x9000
+    RCM JSR A, AL, WORK
+    RCM JSR A, AL, WORK
+
+    RR HLT A, A, A      ; done
+WORK:
+    RI MOV C, 10
+WLOOP:
+    RI DEC C, 0
+    RCM JCF A, NE, WLOOP
+    RR RET A, A
+"""
+
+def test_debug_map_maps_addresses_to_lines_and_labels(tmp_path):
+    from assembler import DebugMap
+    program = Assembler()
+    program.assemble(PROFILED, "work.asm")
+    debug_map = program.debug_map
+    assert [debug_map.line_for(address)[1] for address in range(8)] == [3, 4, 5, 7, 9, 11, 12, 13]
+    assert debug_map.line_for(8) is None
+    assert [debug_map.label_for(address) for address in (0, 3, 4, 5, 7)] == [
+        "START", "START", "WORK", "WLOOP", "WLOOP"]
+    assert debug_map.function_for(4) == "WORK" and debug_map.function_for(6) == "WLOOP"
+    path = str(tmp_path / "work.json")
+    debug_map.save(path)
+    loaded = DebugMap.load(path)
+    assert loaded.lines == debug_map.lines and loaded.labels == debug_map.labels
+
+def test_profiler_attributes_samples_to_labels_lines_and_calls():
+    from profiler import Profiler
+    program = Assembler()
+    machine = make_machine(program.assemble(PROFILED, "work.asm"))
+    profiler = Profiler(machine, program.debug_map, interval=1)
+    profiler.run()
+    assert machine.halt_reason == "HLT" and profiler.instructions == 48
+    assert profiler.calls == {"WORK": 2}
+    assert profiler.inclusive["WORK"] == 44 and profiler.inclusive["START"] == 48
+    assert profiler.exclusive == {"START": 4, "WORK": 2, "WLOOP": 42}
+    assert profiler.tree == {("START",): 4, ("START", "WORK"): 44}
+    assert sum(profiler.lines.values()) == 48
+    assert profiler.lines.most_common(1)[0][0] == ("work.asm", 11)
+    assert "exec_rm" not in vars(machine)      # Hooks removed
+
+def test_cache_simulator_charges_misses_and_stalls_to_each_pc():
+    import io
+    from cachesim import Cache, CacheSimulator
+    machine = make_machine(assemble("""
+        RM MOV A, [0x8000]
+        RM MOV B, [0x8010]
+        RM MOV C, [0x8000]
+        RR HLT A, A, A
+    """))
+    # Direct-mapped two-line L1D: 0x8000 and 0x8010 evict each other, the L2 keeps both
+    simulator = CacheSimulator(machine, dcache=Cache(16, 8, 1), l2=Cache(4096, 8, 4),
+                               l2_latency=10, memory_latency=100, batch=3)
+    simulator.run()
+    assert simulator.per_pc == {
+        0: [2, 2, 2, 220],      # Fetch and load both miss to memory
+        1: [2, 1, 1, 110],      # Fetch hits the line filled at pc 0
+        2: [2, 1, 0, 10],       # Reload of an evicted line hits in the L2
+        3: [1, 0, 0, 0],
+    }
+    assert simulator.instructions == 4 and simulator.stall_cycles == 340
+    report = io.StringIO()
+    simulator.report(file=report)
+    assert report.getvalue().splitlines()[-3].startswith("0x0000          2        2        2")
+
+def test_mode_13_pixels_draw_and_read_back_without_touching_the_stack():
+    from cpu import STACK_TOP
+    machine = make_machine(assemble(f"""
+        RI MOV SP, {STACK_TOP}
+        RCM JSR A, AL, DRAW
+        RR HLT A, A, A
+    DRAW:
+        RI MOV A, 0
+        RI MOV B, 0x13
+        RI INT A, 1
+        RI MOV A, 0x0C
+        RI MOV B, 5
+        RI MOV C, 2
+        RI MOV D, 9
+        RI INT A, 1
+        RI MOV A, 0x0D
+        RI INT A, 1
+        RR MOV E, A, A
+        RI MOV A, 0x0D
+        RI MOV B, 4
+        RI INT A, 1
+        RR MOV F, A, A
+        RR RET A, A
+    """))
+    machine.mem[0xDE7F] = 0x1234
+    machine.mem[0xDE80] = 0x5678
+    machine.run_for(100)
+    assert machine.halt_reason == "HLT"
+    assert (machine.regs[12], machine.regs[13]) == (9, 0)
+    assert machine.mem[0xA000 + 2 * 80 + 1] == 9 << 4
+    assert machine.mem[0xDE7F] == 0 and machine.mem[0xDE80] == 0x5678
+
+def test_mmu_read_only_page_traps():
+    machine = make_machine(assemble("""
+        RI MOV A, 7
+        RM STR A, [0x2000]
+        RR HLT A, A, A
+    """))
+    memory = mmu.enable(machine, 65536)
+    memory.map(2, 2 | mmu.PAGE_READ_ONLY)
+    machine.run_for(10)
+    assert machine.halt_reason == "TRAP"
+    assert machine.last_trap.vector == TRAP_MEMORY_FAULT
+    assert machine.last_trap.pc == 1
+    assert machine.mem[0x2000] == 0
+    assert memory.physical[0x2000] == 0
+
+def test_mmu_banks_memory_beyond_64k():
+    machine = make_machine(assemble("""
+        RI MOV A, 4
+        RI MOV B, 3
+        RI MOV C, 0x30
+        RI INT A, 5
+        RI MOV D, 11
+        RM STR D, [0x3005]
+        RI MOV A, 4
+        RI MOV C, 3
+        RI INT A, 5
+        RM MOV E, [0x3005]
+        RI MOV A, 5
+        RI MOV B, 3
+        RI INT A, 5
+        RR HLT A, A, A
+    """))
+    memory = mmu.enable(machine, 1 << 18)
+    machine.run_for(100)
+    assert machine.halt_reason == "HLT"
+    assert memory.physical[0x30005] == 11 and memory.physical[0x3005] == 0
+    assert machine.regs[12] == 0 and machine.regs[0] == 3
+    assert machine.read_bda_word(machine.INSTALLED_MEMORY) == 256
+
+def test_decoded_engine_matches_interpreter():
+    from engine import DecodedEngine
+    for fusion in [False, True]:
+        compared, _ = fuzz(lambda image: DecodedEngine(make_machine(image), fusion, False),
+                           programs=PROGRAMS, instructions=INSTRUCTIONS, seed=1)
+        assert compared
+
+def test_decoded_engine_idioms_match_interpreter():
+    from engine import DecodedEngine
+    compared, _ = fuzz(lambda image: DecodedEngine(make_machine(image), True, True),
+                       programs=PROGRAMS, instructions=INSTRUCTIONS, seed=1)
+    assert compared
+
+def dirty_engine(image):
+    from engine import DecodedEngine
+    from memory import DirtyMemory
+    machine = make_machine(image)
+    machine.mem = DirtyMemory(machine.mem)
+    return DecodedEngine(machine, True, True)
+
+def test_decoded_engine_on_dirty_memory_matches_interpreter():
+    compared, _ = fuzz(dirty_engine, programs=PROGRAMS, instructions=INSTRUCTIONS, seed=3)
+    assert compared
+
+def test_decoded_engine_drops_entries_on_pages_written_between_runs():
+    engine = dirty_engine(assemble("""
+        RI MOV A, 1
+        RR HLT A, A, A
+    """))
+    machine = engine.machine
+    engine.run_for(10)
+    assert machine.regs[0] == 1 and engine.cache
+    patch = assemble("RI MOV A, 2")
+    machine.mem[:len(patch)] = patch
+    machine.pc, machine.run = 0, True
+    engine.run_for(10)
+    assert machine.regs[0] == 2
+
+def test_dirty_trackers_are_independent():
+    from memory import DirtyMemory
+    memory = DirtyMemory([0] * 0x1000)
+    display, snapshot = memory.tracker(), memory.tracker(dirty=True)
+    assert not display.is_dirty() and snapshot.dirty_pages() == list(range(16))
+    snapshot.clear()
+    memory[0x120] = 1
+    memory[0x300:0x500] = [2] * 0x200
+    assert display.dirty_ranges() == [(0x100, 0x200), (0x300, 0x500)]
+    display.clear()
+    assert not display.is_dirty() and snapshot.dirty_pages() == [1, 3, 4]
+    memory.touch(0xFF0, 0x1010)
+    assert display.dirty_pages() == [15] and display.is_dirty(0xF00, 0x1000)
+    assert not display.is_dirty(0, 0xF00)
+
+@pytest.mark.parametrize("flags", [mmu.PAGE_READ_ONLY, mmu.PAGE_NOT_PRESENT])
+def test_bulk_loop_faults_at_the_same_iteration_as_the_interpreter(flags):
+    from engine import DecodedEngine
+    image = assemble("""
+        RI MOV MP1, 0x8F00
+        RI MOV MP2, 0x1000
+        RI MOV C, 0x200
+    LOOP:
+        RM MOV A, [MP2 + 0]
+        RM STR A, [MP1 + 0]
+        RI INC MP2, 0
+        RI INC MP1, 0
+        RI DEC C, 0
+        RCM JCF A, NE, LOOP
+        RR HLT A, A, A
+    """)
+    machines = []
+    for engine in [False, True]:
+        machine = make_machine(image)
+        machine.mem[0x1000:0x1200] = range(1, 0x201)
+        mmu.enable(machine, 1 << 17).map(9, 9 | flags)
+        (DecodedEngine(machine) if engine else machine).run_for(10000)
+        machines.append(machine)
+    reference, candidate = machines
+    assert reference.halt_reason == "TRAP" and reference.regs[2] == 0x100
+    assert machine_state(candidate) == machine_state(reference)
+    assert candidate.last_trap.pc == reference.last_trap.pc
+    assert candidate.mmu.physical == reference.mmu.physical
+
+def test_compiled_engine_matches_interpreter():
+    from aot import CompiledEngine, compile_module
+    compared, _ = fuzz(lambda image: CompiledEngine(make_machine(image), compile_module(image)),
+                       programs=PROGRAMS, instructions=INSTRUCTIONS, seed=2)
+    assert compared
+
+def test_spawned_clones_do_not_share_writes():
+    from memory import CowMemory
+    template = make_machine(assemble("""
+        RM STR A, [0x9000]
+        RR HLT A, A, A
+    """))
+    template.mem[0x9001] = 0x1234
+    clones = template.spawn(3)
+    assert isinstance(template.mem, list)
+    assert all(isinstance(clone.mem, CowMemory) for clone in clones)
+    for value, clone in enumerate(clones, 1):
+        clone.regs[0] = value
+        clone.run_continuous()
+    assert [clone.mem[0x9000] for clone in clones] == [1, 2, 3]
+    assert all(clone.mem[0x9001] == 0x1234 for clone in clones)
+    assert template.mem[0x9000] == 0 and template.run
+    assert all(clone.mem.private_pages == 1 for clone in clones)
+    assert all(clone.regs is not template.regs for clone in clones)
+
+def test_batch_lanes_match_interpreter():
+    pytest.importorskip('numpy')
+    from batch import BatchCPU
+    rng = random.Random(3)
+    lanes = 4
+    for _ in range(3):
+        image = assemble(random_program(rng, 120))
+        batch = BatchCPU(image, lanes)
+        inputs = [[rng.randrange(0x10000) for _ in range(7)] for _ in range(lanes)]
+        batch.regs[:, :7] = inputs
+        batch.run(max_steps=1500)
+        for lane in range(lanes):
+            reference = make_machine(image)
+            reference.regs[:7] = inputs[lane]
+            reference.run_for(int(batch.retired[lane]))
+            reference.console.flush()
+            assert batch.lane_state(lane) == machine_state(reference)
+            assert batch.mem[lane].tolist() == list(reference.mem)
+            assert batch.consoles[lane].captured == reference.console.captured
+
+def test_batch_lanes_have_their_own_disk():
+    pytest.importorskip('numpy')
+    from batch import BatchCPU
+    batch = BatchCPU(assemble("""
+        RM STR D, [0x8000]
+        RI MOV A, 1
+        RI MOV B, 0
+        RI MOV C, 0x8000
+        RI INT A, 4
+        RI MOV A, 0
+        RI MOV C, 0x8100
+        RI INT A, 4
+        RR HLT A, A, A
+    """), 3)
+    batch.regs[:, 3] = [10, 20, 30]
+    batch.run()
+    assert batch.mem[:, 0x8100].tolist() == [10, 20, 30]
+    assert [disk.read_sector(0)[0] for disk in batch.disks] == [10, 20, 30]
+
+def test_batch_lane_behind_a_loop_is_not_starved():
+    pytest.importorskip('numpy')
+    from batch import BatchCPU
+    batch = BatchCPU(assemble("""
+        RI CMP D, 0
+        RCM JCF A, NE, OTHER
+    LOOP:
+        RI INC C, 0
+        RCM JMP A, AL, LOOP
+    OTHER:
+        RI MOV C, 5
+        RR HLT A, A, A
+    """), 2, patience=16)
+    batch.regs[1, 3] = 1
+    batch.run(max_steps=200)
+    assert batch.running.tolist() == [True, False]
+    assert batch.halt_reason[1] == "HLT" and batch.regs[1, 2] == 5
+
+def test_rewind_matches_fresh_run():
+    from rewind import Rewinder
+    image = assemble(random_program(random.Random(4)))
+    machine = make_machine(image)
+    rewinder = Rewinder(machine, checkpoint_interval=100)
+    rewinder.run(1000)
+    for cycle in [999, 437, 100, 0]:
+        rewinder.rewind_to(cycle)
+        reference = make_machine(image)
+        reference.run_for(cycle)
+        assert machine_state(machine) == machine_state(reference)
+        assert memory_difference(reference, machine) == []
+    rewinder.run(500)
+    reference = make_machine(image)
+    reference.run_for(500)
+    assert machine_state(machine) == machine_state(reference)
+    assert memory_difference(reference, machine) == []
+
+def test_rewind_through_mmu_mapping_changes():
+    from rewind import Rewinder
+    image = assemble("""
+        RI MOV A, 7
+        RM STR A, [0x2000]
+        RI MOV A, 4
+        RI MOV B, 2
+        RI MOV C, 0x20
+        RI INT A, 5
+        RI MOV A, 9
+        RM STR A, [0x2000]
+        RR HLT A, A, A
+    """)
+
+    def machine_with_mmu():
+        machine = make_machine(image)
+        return machine, mmu.enable(machine, 1 << 18)
+    machine, memory = machine_with_mmu()
+    rewinder = Rewinder(machine, checkpoint_interval=4)
+    rewinder.run()
+    assert memory.registers[2] == 0x20 and memory.physical[0x20000] == 9
+    for cycle in [8, 6, 2, 0]:
+        rewinder.rewind_to(cycle)
+        reference, reference_memory = machine_with_mmu()
+        reference.run_for(cycle)
+        assert machine_state(machine) == machine_state(reference)
+        assert memory_difference(reference, machine) == []
+        assert memory.registers == reference_memory.registers
+        assert memory.physical == reference_memory.physical
+    machine.run_for(10)
+    assert machine.mem[0x2000] == 9 and memory.physical[0x2000] == 7
+
+def test_journal_records_generator_and_strided_stores():
+    from rewind import JournalMemory
+    memory = JournalMemory([0] * 512)
+    memory[0:3] = (value for value in [1, 2, 3])
+    memory[10:16:2] = [4, 5, 6]
+    assert memory[:3] == [1, 2, 3] and memory[10:16] == [4, 0, 5, 0, 6, 0]
+    assert memory.writes == [(0, [1, 2, 3]), (10, 4), (12, 5), (14, 6)]
+
+def test_rewind_journal_budget_is_in_bytes():
+    from rewind import CHECKPOINT_WORD_BYTES, Rewinder
+    machine = make_machine(assemble(random_program(random.Random(6))))
+    budget = CHECKPOINT_WORD_BYTES * len(machine.mem) + 100000
+    rewinder = Rewinder(machine, checkpoint_interval=100, max_journal_bytes=budget)
+    rewinder.run(1000)
+    assert rewinder.earliest_cycle > 0 and len(rewinder.checkpoints) < 10
+    assert rewinder.bytes <= budget
+    assert rewinder.bytes == sum(checkpoint.bytes for checkpoint in rewinder.checkpoints)
+
+def test_checkpoints_copy_only_dirty_pages():
+    from rewind import CHECKPOINT_WORD_BYTES, Rewinder
+    machine = make_machine(assemble(random_program(random.Random(6))))
+    rewinder = Rewinder(machine, checkpoint_interval=100)
+    rewinder.run(300)
+    first, second = rewinder.checkpoints[0], rewinder.checkpoints[1]
+    assert first.bytes >= CHECKPOINT_WORD_BYTES * len(machine.mem)
+    shared = [page for page, newer in zip(first.pages, second.pages) if page is newer]
+    assert 0 < len(shared) < len(first.pages)
+    assert [word for page in second.pages for word in page] != list(machine.mem)
+    rewinder.rewind_to(100)
+    assert [word for page in second.pages for word in page] == list(machine.mem)
+
+def drifting(at):
+    """Candidate factory: a reference cpu whose G register flips once it has retired `at`"""
+    def make(image):
+        machine = make_machine(image)
+        run_for = machine.run_for
+
+        def drifting_run_for(count):
+            before = machine.cycles
+            retired = run_for(count)
+            if before < at <= machine.cycles:
+                machine.regs[14] ^= 1
+            return retired
+        machine.run_for = drifting_run_for
+        return machine
+    return make
+
+def test_fuzz_reports_the_first_diverging_instruction():
+    with pytest.raises(Divergence) as caught:
+        fuzz(drifting(300), programs=1, instructions=2000, seed=5)
+    assert caught.value.report.startswith("Divergence after 300 instructions (last sync 299)")
+    assert "  regs: reference=" in caught.value.report
+    assert caught.value.program == 0 and "START:" in caught.value.source
+
+def test_fuzz_counts_skipped_programs():
+    compared, skipped = fuzz(programs=3, instructions=100, length=1200)
+    assert skipped == 3 and compared == 0
+    compared, skipped = fuzz(programs=3, instructions=100)
+    assert skipped == 0 and 0 < compared <= 300
+
+def test_random_programs_halt_and_return_with_rti():
+    rng = random.Random(0)
+    sources = [random_program(rng) for _ in range(20)]
+    assert any("RR RTI" in source for source in sources)
+    assert any(run_source(source).halt_reason == "HLT" for source in sources)
+
+@pytest.fixture
+def export():
+    from viewer import DisplayExport
+    export = DisplayExport(make_machine(assemble("""
+        RI MOV A, 0
+        RI INT A, 2
+        RR HLT A, A, A
+    """)))
+    export.attach()
+    yield export
+    export.close()
+
+def test_viewer_snapshots_frames_and_delivers_keys(export):
+    from viewer import VIDEO, VIDEO_MODE, Viewer
+    machine = export.machine
+    viewer = Viewer(export.name)
+    base = machine.read_bda_word(machine.VIDEO_MEMORY_BASE)
+    machine.mem[base + 1] = ord("H")
+    assert export.publish()
+    frame = viewer.snapshot()
+    assert frame[VIDEO_MODE] == 0x03 and frame[VIDEO + 1] == ord("H")
+    assert viewer.snapshot() is None and not export.publish()
+    assert viewer.send_key(ord("k"))
+    machine.run_for(10)
+    assert machine.halt_reason == "HLT" and machine.regs[0] == ord("k")
+    viewer.close()
+
+def test_display_has_one_viewer_and_snapshots_time_out(export):
+    import threading
+    from viewer import HEARTBEAT, SEQUENCE, VIEWER, Viewer
+    first = Viewer(export.name)
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(0.01):
+            first.beat()
+    beating = threading.Thread(target=beat)
+    beating.start()
+    try:
+        with pytest.raises(ValueError):
+            Viewer(export.name)
+    finally:
+        stop.set()
+        beating.join()
+    assert first.owner() and export.viewer_attached()
+    first.close()
+    assert export.words[VIEWER] == 0 and export.words[HEARTBEAT] == 0
+    second = Viewer(export.name)
+    export.words[SEQUENCE] += 1     # The emulator stopped halfway through a frame
+    assert second.snapshot(timeout=0.05) is None
+    second.close()
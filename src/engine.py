@@ -0,0 +1,825 @@
+import sys
+import time
+
+from cpu import CPUTrap
+from memory import DIRTY_PAGE_BITS, DIRTY_PAGE_SIZE, DirtyMemory
+from mmu import PAGE_BITS, PAGE_NOT_PRESENT, PAGE_READ_ONLY, MappedMemory
+
+def decode(word):
+    """Split an instruction word into (format, opcode, a, b, c)
+
+    RR:  (0, opcode, rd, rs1, rs2)
+    RI:  (1, opcode, rd, imm, 0)        imm sign-extended as in cpu.execute()
+    RM:  (2, opcode, rd, mode, mem_field)
+    RCM: (3, opcode, reg, condition, address)
+    """
+    format = (word >> 30) & 0b11
+    opcode = (word >> 24) & 0b111111
+    match format:
+        case 0b00:
+            return (format, opcode, (word >> 8) & 0xF, (word >> 4) & 0xF, word & 0xF)
+        case 0b01:
+            imm = word & 0xFFFF
+            if imm & 0x8000:
+                imm |= 0xFFFF0000
+            return (format, opcode, (word >> 16) & 0xF, imm, 0)
+        case 0b10:
+            return (format, opcode, (word >> 19) & 0xF, (word >> 17) & 0b11, word & 0x1FFFF)
+        case 0b11:
+            return (format, opcode, (word >> 19) & 0xF, (word >> 16) & 0b111, word & 0xFFFF)
+
+def is_cmp(d):
+    return d[0] in (0b00, 0b01) and d[1] == 0x23
+
+def is_incdec(d):
+    return d[0] in (0b00, 0b01) and d[1] in (0x1D, 0x1E)
+
+def is_jcf(d):
+    return d[0] == 0b11 and d[1] == 0x27
+
+def is_rr(d, opcode):
+    return d[0] == 0b00 and d[1] == opcode
+
+def is_call(d):
+    return (d[0] == 0b11 and d[1] == 0x22) or (d[0] == 0b10 and d[1] == 0x22 and d[3] == 0b00)
+
+def is_ret(d):
+    return d[0] in (0b00, 0b01) and d[1] == 0x24
+
+def is_rm(d, opcode, mode):
+    return d[0] == 0b10 and d[1] == opcode and d[3] == mode
+
+def mp_operand(d):
+    """(MP register, offset field) of an RM instruction in mode 01/11"""
+    return 8 + ((d[4] >> 14) & 0b11), (d[4] >> 10) & 0b1111
+
+def read_range(mem, start, end):
+    """Words mem[start:end] as a list"""
+    block = mem[start:end]
+    return block if isinstance(block, list) else list(block)
+
+def write_range(mem, start, values):
+    """Store values at mem[start:]"""
+    if isinstance(mem, list):
+        mem[start:start + len(values)] = values
+    else:
+        for offset, value in enumerate(values):
+            mem[start + offset] = value
+
+def protected(mem, start, end, write):
+    """True if the MMU would fault part of mem[start:end] (unmapped, or read-only for a write)
+
+    Bulk operations check the whole range first and leave a loop that would
+    fault to the interpreter, which raises the trap at the right iteration.
+    """
+    if not isinstance(mem, MappedMemory):
+        return False
+    mask = PAGE_NOT_PRESENT | PAGE_READ_ONLY if write else PAGE_NOT_PRESENT
+    registers = mem.registers
+    return any(registers[page] & mask
+               for page in range(start >> PAGE_BITS, ((end - 1) >> PAGE_BITS) + 1))
+
+def copy_block(mem, src, dst, count):
+    """Element-by-element forward copy of count words, as the guest loop does it"""
+    if dst <= src or dst >= src + count:
+        block = read_range(mem, src, src + count)
+    else:
+        # Overlapping forward copy replicates the first dst - src words
+        pattern = read_range(mem, src, dst)
+        block = (pattern * (count // len(pattern) + 1))[:count]
+    write_range(mem, dst, block)
+
+class DecodedEngine:
+    """Execution engine that caches decoded instructions for a cpu
+
+    Each address is decoded once into a specialised handler. With fusion
+    enabled, common sequences are recognised at decode time and run as one
+    superinstruction:
+
+        CMP + JCF                compare and branch
+        INC/DEC + CMP + JCF      counted loop back-edge
+        PSH + JSR, PSH + PSH     call setup
+        POP + RET, POP + POP     call teardown
+
+    Handlers are keyed by the address they start at, so a jump into the
+    middle of a fused sequence simply uses (and if needed decodes) the
+    handler for that address. Every cached entry remembers the words it was
+    built from and is rebuilt when guest code overwrites them; fused
+    sequences that store to memory re-check the remaining words before
+    continuing. On DirtyMemory the engine keeps its own DirtyTracker and
+    checks the page stamp instead of the words, re-reading them only for
+    pages written since the current run_for() began.
+
+    With idioms enabled, canonical copy and fill loops are replaced by one
+    bulk slice operation on guest memory:
+
+        index form                      pointer form
+        RM MOV r, [MPa + I]   (copy)    RM MOV r, [MPa + k]   (copy)
+        RM STR r, [MPb + I]             RM STR r, [MPb + k]
+        INC I                           INC MPa               (copy)
+        CMP I, N                        INC MPb
+        JCF NE|LT, loop                 DEC C
+                                        JCF NE, loop
+
+    The final registers, flags and memory match running the loop, including
+    overlapping copies. Loops whose iteration count, address range (wrap,
+    out of range, overlap with the loop's own code, a page the MMU would
+    fault) or operands fall outside what the bulk form models are
+    interpreted normally.
+
+    State lives in the wrapped cpu, which the engine stands in for
+    (attribute access is forwarded), so traps, BIOS services and devices
+    behave exactly as in cpu.run_continuous().
+    """
+    def __init__(self, machine, fusion=True, idioms=True):
+        self.machine = machine
+        self.fusion = fusion
+        self.idioms = idioms
+        self.cache = {}     # pc -> (handler, length, word0, word1, word2)
+        self.decoded = {}   # word -> decode(word), shared by every pc holding that word
+        self.tracker = None         # DirtyTracker of the memory run_tracked() last ran on
+        self.code_pages = set()     # Dirty-tracking pages holding cached entries
+
+    def __getattr__(self, name):
+        return getattr(self.machine, name)
+
+    def invalidate(self, start=0, end=65536):
+        """Drop cached handlers overlapping [start, end)"""
+        for pc in [pc for pc, entry in self.cache.items() if pc < end and pc + entry[1] > start]:
+            del self.cache[pc]
+
+    def lookup(self, pc):
+        """Cached handler entry for pc, rebuilt if the code changed"""
+        entry = self.cache.get(pc)
+        mem = self.machine.mem
+        if entry is not None:
+            length = entry[1]
+            if mem[pc] == entry[2] and (length == 1 or (
+                    mem[pc + 1] == entry[3] and (length == 2 or mem[pc + 2] == entry[4]))):
+                return entry
+        entry = self.build(pc)
+        self.cache[pc] = entry
+        self.code_pages.add(pc >> DIRTY_PAGE_BITS)
+        return entry
+
+    def build(self, pc):
+        mem = self.machine.mem
+        words = [mem[pc]]
+        lookahead = 6 if self.idioms else 3 if self.fusion else 1
+        if isinstance(mem, DirtyMemory):
+            # Keep every entry inside one tracking page, so its page stamp covers all of it
+            lookahead = min(lookahead, DIRTY_PAGE_SIZE - (pc & (DIRTY_PAGE_SIZE - 1)))
+        for offset in range(1, lookahead):
+            try:
+                words.append(mem[pc + offset])
+            except (CPUTrap, IndexError):   # End of memory or an unmapped page: no fusion across it
+                break
+        table = self.decoded
+        decoded = []
+        for word in words:
+            entry = table.get(word)
+            if entry is None:
+                entry = table[word] = decode(word)
+            decoded.append(entry)
+
+        handler, length = None, 1
+        if self.idioms:
+            handler, length = self.idiom(pc, words, decoded)
+        if handler is None and self.fusion:
+            handler, length = self.fuse(pc, words, decoded)
+        if handler is None:
+            handler, length = self.single(pc, decoded[0]), 1
+        words += [None, None]
+        return (handler, length, words[0], words[1] if length > 1 else None,
+                words[2] if length > 2 else None)
+
+    def fuse(self, pc, words, decoded):
+        """Superinstruction for the sequence starting at pc, if any"""
+        count = len(decoded)
+        first = decoded[0]
+        if count >= 2 and is_cmp(first) and is_jcf(decoded[1]):
+            return self.fused_compare_branch(pc, None, first, decoded[1]), 2
+        if count >= 3 and is_incdec(first) and is_cmp(decoded[1]) and is_jcf(decoded[2]):
+            return self.fused_compare_branch(pc, first, decoded[1], decoded[2]), 3
+        if count >= 2 and is_rr(first, 0x02) and (is_call(decoded[1]) or is_rr(decoded[1], 0x02)):
+            return self.fused_pair(pc, words[1], first, decoded[1]), 2
+        if count >= 2 and is_rr(first, 0x03) and (is_ret(decoded[1]) or is_rr(decoded[1], 0x03)):
+            return self.fused_pair(pc, words[1], first, decoded[1]), 2
+        return None, 1
+
+    def idiom(self, pc, words, decoded):
+        """Bulk handler for a copy/fill loop starting at pc, if any"""
+        for match_loop in (self.index_loop, self.pointer_loop):
+            plan = match_loop(pc, decoded)
+            if plan is not None:
+                return self.bulk_loop(pc, words[:plan['length']], decoded[0], plan), plan['length']
+        return None, 1
+
+    def index_loop(self, pc, d):
+        """Match the [MPx + I] form (addressing mode 11)"""
+        if len(d) >= 5 and is_rm(d[0], 0x00, 0b11) and is_rm(d[1], 0x01, 0b11):
+            src_mp, index = mp_operand(d[0])
+            dst_mp, store_index = mp_operand(d[1])
+            value = d[0][2]
+            if store_index != index or d[1][2] != value or value in (index, src_mp, dst_mp):
+                return None
+            body = 2
+        elif len(d) >= 4 and is_rm(d[0], 0x01, 0b11):
+            src_mp = None
+            dst_mp, index = mp_operand(d[0])
+            value = d[0][2]
+            if value == index:
+                return None
+            body = 1
+        else:
+            return None
+
+        step, compare, branch = d[body], d[body + 1], d[body + 2]
+        if not (is_incdec(step) and step[1] == 0x1D and step[2] == index):
+            return None
+        if not (is_cmp(compare) and compare[2] == index):
+            return None
+        if not (is_jcf(branch) and branch[4] == pc and branch[3] in (0b101, 0b100)):
+            return None
+        if index in (src_mp, dst_mp):
+            return None
+        limit_reg = compare[3] if compare[0] == 0b00 else None
+        if limit_reg is not None and limit_reg in (index, value if src_mp is not None else None):
+            return None
+        return {
+            'form': 'index', 'length': body + 3, 'src_mp': src_mp, 'dst_mp': dst_mp,
+            'offsets': (0, 0), 'index': index, 'value': value, 'limit_reg': limit_reg,
+            'limit': compare[3] if limit_reg is None else None, 'below': branch[3] == 0b100,
+        }
+
+    def pointer_loop(self, pc, d):
+        """Match the [MPx + k] form with pointer increments and a down counter"""
+        if len(d) >= 6 and is_rm(d[0], 0x00, 0b01) and is_rm(d[1], 0x01, 0b01):
+            src_mp, src_offset = mp_operand(d[0])
+            dst_mp, dst_offset = mp_operand(d[1])
+            value = d[0][2]
+            if d[1][2] != value or src_mp == dst_mp:
+                return None
+            steps, body = d[2:4], 4
+            pointers = {src_mp, dst_mp}
+        elif len(d) >= 4 and is_rm(d[0], 0x01, 0b01):
+            src_mp, src_offset = None, 0
+            dst_mp, dst_offset = mp_operand(d[0])
+            value = d[0][2]
+            steps, body = d[1:2], 2
+            pointers = {dst_mp}
+        else:
+            return None
+
+        if not all(is_incdec(step) and step[1] == 0x1D for step in steps):
+            return None
+        if {step[2] for step in steps} != pointers or len(steps) != len(pointers):
+            return None
+        counter, branch = d[body], d[body + 1]
+        if not (is_incdec(counter) and counter[1] == 0x1E):
+            return None
+        if not (is_jcf(branch) and branch[4] == pc and branch[3] == 0b101):
+            return None
+        count = counter[2]
+        if count in pointers or value in pointers or value == count:
+            return None
+        return {
+            'form': 'pointer', 'length': body + 2, 'src_mp': src_mp, 'dst_mp': dst_mp,
+            'offsets': (src_offset, dst_offset), 'count': count, 'value': value,
+        }
+
+    def bulk_loop(self, pc, words, first, plan):
+        """Handler that runs a whole copy/fill loop as slice operations"""
+        m = self.machine
+        length = plan['length']
+        end_pc = pc + length
+        src_mp, dst_mp = plan['src_mp'], plan['dst_mp']
+        src_offset, dst_offset = plan['offsets']
+        value = plan['value']
+        interpret = self.single(pc, first)
+        tail = list(enumerate(words))[3:]
+
+        def handler():
+            mem = m.mem
+            for offset, word in tail:
+                if mem[pc + offset] != word:
+                    return interpret()  # Rest of the loop changed; rebuilt on next lookup
+            regs = m.regs
+
+            if plan['form'] == 'index':
+                start = regs[plan['index']]
+                limit = regs[plan['limit_reg']] if plan['limit_reg'] is not None else plan['limit']
+                if plan['below']:
+                    if not 0 <= start < limit <= 0x8000:
+                        return interpret()
+                    count = limit - start
+                else:
+                    count = ((limit - start - 1) & 0xFFFF) + 1
+                if start + count - 1 > 0xFFFF:
+                    return interpret()
+                src_base = regs[src_mp] + start if src_mp is not None else None
+                dst_base = regs[dst_mp] + start
+            else:
+                count = ((regs[plan['count']] - 1) & 0xFFFF) + 1
+                if regs[dst_mp] + count - 1 > 0xFFFF or (
+                        src_mp is not None and regs[src_mp] + count - 1 > 0xFFFF):
+                    return interpret()
+                src_base = regs[src_mp] + src_offset if src_mp is not None else None
+                dst_base = regs[dst_mp] + dst_offset
+
+            dst_end = dst_base + count
+            if dst_end > 0x10000 or (dst_base < end_pc and dst_end > pc):
+                return interpret()
+            if src_base is not None and src_base + count > 0x10000:
+                return interpret()
+            if protected(mem, dst_base, dst_end, True) or (
+                    src_base is not None and protected(mem, src_base, src_base + count, False)):
+                return interpret()
+
+            if src_base is not None:
+                copy_block(mem, src_base, dst_base, count)
+                regs[value] = mem[dst_end - 1]
+            else:
+                write_range(mem, dst_base, [regs[value]] * count)
+
+            if plan['form'] == 'index':
+                index = regs[plan['index']] = (regs[plan['index']] + count) & 0xFFFF
+                result = index - limit
+                m.zf = (result & 0xFFFF) == 0
+                m.sf = (result & 0x8000) != 0
+                m.cf = result > 0xFFFF or result < 0
+            else:
+                regs[dst_mp] = (regs[dst_mp] + count) & 0xFFFF
+                if src_mp is not None:
+                    regs[src_mp] = (regs[src_mp] + count) & 0xFFFF
+                regs[plan['count']] = 0
+                m.zf, m.sf, m.cf = True, False, False
+            m.pc = end_pc
+            return count * length
+        return handler
+
+    def fused_compare_branch(self, pc, step, compare, branch):
+        """[INC/DEC] + CMP + JCF as one handler"""
+        m = self.machine
+        _, _, _, cond, target = branch
+        c_lt, c_eq, c_gt = bool(cond & 0b100), bool(cond & 0b010), bool(cond & 0b001)
+        cmp_format, _, left, right, _ = compare
+        fallthrough = pc + (3 if step else 2)
+        length = 3 if step else 2
+
+        if step is not None:
+            # The step's flags are dead (CMP overwrites them); only the
+            # register update is kept
+            step_reg = step[2]
+            delta = 1 if step[1] == 0x1D else -1
+        else:
+            step_reg, delta = None, 0
+
+        if cmp_format == 0b00:
+            def handler():
+                regs = m.regs
+                if delta:
+                    regs[step_reg] = (regs[step_reg] + delta) & 0xFFFF
+                result = regs[left] - regs[right]
+                zf = m.zf = (result & 0xFFFF) == 0
+                sf = m.sf = (result & 0x8000) != 0
+                m.cf = result > 0xFFFF or result < 0
+                if (c_lt and sf) or (c_eq and zf) or (c_gt and not sf and not zf):
+                    m.pc = target
+                else:
+                    m.pc = fallthrough
+                return length
+        else:
+            imm = right
+            def handler():
+                regs = m.regs
+                if delta:
+                    regs[step_reg] = (regs[step_reg] + delta) & 0xFFFF
+                result = regs[left] - imm
+                zf = m.zf = (result & 0xFFFF) == 0
+                sf = m.sf = (result & 0x8000) != 0
+                m.cf = result > 0xFFFF or result < 0
+                if (c_lt and sf) or (c_eq and zf) or (c_gt and not sf and not zf):
+                    m.pc = target
+                else:
+                    m.pc = fallthrough
+                return length
+        return handler
+
+    def fused_pair(self, pc, second_word, first, second):
+        """Two stack/call instructions as one handler"""
+        m = self.machine
+        run_first = self.single(pc, first)
+        run_second = self.single(pc + 1, second)
+        def handler():
+            run_first()
+            if m.mem[pc + 1] != second_word:
+                return 1    # The first instruction overwrote the second
+            run_second()
+            return 2
+        return handler
+
+    def single(self, pc, decoded):
+        """Handler for one instruction"""
+        m = self.machine
+        format, opcode, a, b, c = decoded
+        next_pc = pc + 1
+
+        match format:
+            case 0b00:
+                rd, rs1, rs2 = a, b, c
+                match opcode:
+                    case 0x00:  # MOV
+                        def handler():
+                            regs = m.regs
+                            regs[rd] = regs[rs1]
+                            m.pc = next_pc
+                            return 1
+                        return handler
+                    case 0x10 | 0x11 | 0x14 | 0x15 | 0x16:  # ADD, SUB, AND, OR, XOR
+                        operation = ALU[opcode]
+                        def handler():
+                            regs = m.regs
+                            result = operation(regs[rs1], regs[rs2])
+                            m.zf = (result & 0xFFFF) == 0
+                            m.sf = (result & 0x8000) != 0
+                            m.cf = result > 0xFFFF or result < 0
+                            regs[rd] = result & 0xFFFF
+                            m.pc = next_pc
+                            return 1
+                        return handler
+                    case 0x1D | 0x1E:  # INC, DEC
+                        delta = 1 if opcode == 0x1D else -1
+                        def handler():
+                            regs = m.regs
+                            value = regs[rd] = (regs[rd] + delta) & 0xFFFF
+                            m.zf = value == 0
+                            m.sf = (value & 0x8000) != 0
+                            m.cf = False
+                            m.pc = next_pc
+                            return 1
+                        return handler
+                    case 0x23:  # CMP
+                        def handler():
+                            regs = m.regs
+                            result = regs[rd] - regs[rs1]
+                            m.zf = (result & 0xFFFF) == 0
+                            m.sf = (result & 0x8000) != 0
+                            m.cf = result > 0xFFFF or result < 0
+                            m.pc = next_pc
+                            return 1
+                        return handler
+                    case 0x02:  # PSH
+                        def handler():
+                            m.pc = next_pc
+                            m.push(m.regs[rd])
+                            return 1
+                        return handler
+                    case 0x03:  # POP
+                        def handler():
+                            m.pc = next_pc
+                            value = m.pop()
+                            m.regs[rd] = value
+                            return 1
+                        return handler
+                    case 0x24:  # RET
+                        def handler():
+                            m.pc = next_pc
+                            m.pc = m.pop()
+                            return 1
+                        return handler
+                def handler():
+                    m.pc = next_pc
+                    m.exec_rr(opcode, rd, rs1, rs2)
+                    return 1
+                return handler
+
+            case 0b01:
+                rd, imm = a, b
+                match opcode:
+                    case 0x00:  # MOV
+                        value = imm & 0xFFFF
+                        def handler():
+                            m.regs[rd] = value
+                            m.pc = next_pc
+                            return 1
+                        return handler
+                    case 0x10 | 0x11 | 0x14 | 0x15 | 0x16:  # ADD, SUB, AND, OR, XOR
+                        operation = ALU[opcode]
+                        def handler():
+                            regs = m.regs
+                            result = operation(regs[rd], imm)
+                            m.zf = (result & 0xFFFF) == 0
+                            m.sf = (result & 0x8000) != 0
+                            m.cf = result > 0xFFFF or result < 0
+                            regs[rd] = result & 0xFFFF
+                            m.pc = next_pc
+                            return 1
+                        return handler
+                    case 0x1D | 0x1E:  # INC, DEC (flags from the unmasked result)
+                        delta = 1 if opcode == 0x1D else -1
+                        def handler():
+                            regs = m.regs
+                            result = regs[rd] + delta
+                            m.zf = (result & 0xFFFF) == 0
+                            m.sf = (result & 0x8000) != 0
+                            m.cf = result > 0xFFFF or result < 0
+                            regs[rd] = result & 0xFFFF
+                            m.pc = next_pc
+                            return 1
+                        return handler
+                    case 0x23:  # CMP
+                        def handler():
+                            result = m.regs[rd] - imm
+                            m.zf = (result & 0xFFFF) == 0
+                            m.sf = (result & 0x8000) != 0
+                            m.cf = result > 0xFFFF or result < 0
+                            m.pc = next_pc
+                            return 1
+                        return handler
+                    case 0x24:  # RET
+                        def handler():
+                            m.pc = next_pc
+                            m.pc = m.pop()
+                            return 1
+                        return handler
+                def handler():
+                    m.pc = next_pc
+                    m.exec_ri(opcode, rd, imm)
+                    return 1
+                return handler
+
+            case 0b10:
+                rd, mode, mem_field = a, b, c
+                direct = mem_field & 0xFFFF
+                if mode == 0b00:
+                    match opcode:
+                        case 0x00:  # MOV (load)
+                            def handler():
+                                m.pc = next_pc
+                                m.regs[rd] = m.mem[direct]
+                                return 1
+                            return handler
+                        case 0x01:  # STR
+                            def handler():
+                                m.pc = next_pc
+                                m.mem[direct] = m.regs[rd]
+                                return 1
+                            return handler
+                        case 0x20:  # JMP
+                            def handler():
+                                m.pc = direct
+                                return 1
+                            return handler
+                else:
+                    match opcode:
+                        case 0x00:  # MOV (load)
+                            def handler():
+                                m.pc = next_pc
+                                m.regs[rd] = m.mem[m.calc_address(mode, mem_field)]
+                                return 1
+                            return handler
+                        case 0x01:  # STR
+                            def handler():
+                                m.pc = next_pc
+                                m.mem[m.calc_address(mode, mem_field)] = m.regs[rd]
+                                return 1
+                            return handler
+                def handler():
+                    m.pc = next_pc
+                    m.exec_rm(opcode, rd, m.calc_address(mode, mem_field))
+                    return 1
+                return handler
+
+            case 0b11:
+                reg, condition, address = a, b, c
+                match opcode:
+                    case 0x20:  # JMP
+                        def handler():
+                            m.pc = address
+                            return 1
+                        return handler
+                    case 0x27:  # JCF
+                        c_lt, c_eq = bool(condition & 0b100), bool(condition & 0b010)
+                        c_gt = bool(condition & 0b001)
+                        def handler():
+                            sf, zf = m.sf, m.zf
+                            if (c_lt and sf) or (c_eq and zf) or (c_gt and not sf and not zf):
+                                m.pc = address
+                            else:
+                                m.pc = next_pc
+                            return 1
+                        return handler
+                    case 0x22:  # JSR
+                        def handler():
+                            m.pc = next_pc
+                            m.push(next_pc)
+                            m.pc = address
+                            return 1
+                        return handler
+                def handler():
+                    m.pc = next_pc
+                    m.exec_rcm(opcode, reg, condition, address)
+                    return 1
+                return handler
+
+    def run_for(self, count):
+        """Run about count instructions (fused sequences may overshoot); returns how many retired"""
+        m = self.machine
+        if isinstance(m.mem, DirtyMemory):
+            return self.run_tracked(count)
+        lookup = self.lookup
+        cache = self.cache
+        executed = 0
+        while m.run and executed < count:
+            pc = m.pc
+            length = 1
+            try:
+                while m.run and executed < count:
+                    pc = m.pc
+                    length = 0
+                    entry = cache.get(pc)
+                    if entry is None or m.mem[pc] != entry[2] or (entry[1] > 1 and (
+                            m.mem[pc + 1] != entry[3] or (
+                                entry[1] > 2 and m.mem[pc + 2] != entry[4]))):
+                        entry = lookup(pc)
+                    length = entry[1]
+                    retired = entry[0]()
+                    executed += retired
+                    m.cycles += retired
+            except (CPUTrap, IndexError) as error:
+                executed += self.fault(error, pc, length)
+        return executed
+
+    def run_tracked(self, count):
+        """run_for over DirtyMemory: page stamps stand in for re-reading each entry's words
+
+        Entries on pages written since the previous call are dropped first;
+        during the call, dispatching on a page written since it began
+        re-validates the entry's words through lookup().
+        """
+        m = self.machine
+        mem = m.mem
+        tracker = self.tracker
+        if tracker is None or tracker.memory is not mem:
+            tracker = self.tracker = mem.tracker()
+            self.cache.clear()      # Built against other memory, maybe across pages
+            self.code_pages.clear()
+        else:
+            stale = self.code_pages.intersection(tracker.dirty_pages())
+            if stale:
+                for pc in [pc for pc in self.cache if pc >> DIRTY_PAGE_BITS in stale]:
+                    del self.cache[pc]
+                self.code_pages -= stale
+            tracker.clear()
+        stamps, mark = mem.stamps, tracker.mark
+        lookup = self.lookup
+        cache = self.cache
+        executed = 0
+        while m.run and executed < count:
+            pc = m.pc
+            length = 1
+            try:
+                while m.run and executed < count:
+                    pc = m.pc
+                    length = 0
+                    entry = cache.get(pc)
+                    if entry is None or stamps[pc >> DIRTY_PAGE_BITS] > mark:
+                        entry = lookup(pc)
+                    length = entry[1]
+                    retired = entry[0]()
+                    executed += retired
+                    m.cycles += retired
+            except (CPUTrap, IndexError) as error:
+                executed += self.fault(error, pc, length)
+        return executed
+
+    def fault(self, error, pc, length):
+        """Deliver a fault raised by the entry at pc; returns the instructions it retired"""
+        m = self.machine
+        if not length:
+            m.handle_fault(error, pc, retired=False)   # Fault fetching the instruction
+            return 0
+        # Instructions of a fused sequence that ran before the fault count as retired
+        retired = max(1, m.pc - pc) if length > 1 else 1
+        m.cycles += retired - 1     # handle_fault counts the faulting one
+        m.handle_fault(error)
+        return retired
+
+    def run_continuous(self):
+        """Run until HLT or an unhandled trap"""
+        while self.machine.run:
+            self.run_for(1 << 20)
+        self.machine.console.flush()
+
+ALU = {
+    0x10: lambda x, y: x + y,
+    0x11: lambda x, y: x - y,
+    0x14: lambda x, y: x & y,
+    0x15: lambda x, y: x | y,
+    0x16: lambda x, y: x ^ y,
+}
+
+BENCHMARKS = {
+    'count': """
+        RI MOV C, 0
+    LOOP:
+        RI INC C, 0
+        RI CMP C, 30000
+        RCM JCF A, NE, LOOP
+        RR HLT A, A
+    """,
+    'sum': """
+        RI MOV A, 0
+        RI MOV X, 0
+    LOOP:
+        RR ADD A, A, X
+        RR INC X, X
+        RI CMP X, 20000
+        RCM JCF A, LT, LOOP
+        RR HLT A, A
+    """,
+    'calls': """
+        RI MOV SP, 0xA000
+        RI MOV C, 5000
+    LOOP:
+        RR PSH C, C
+        RCM JSR A, AL, WORK
+        RR POP C, C
+        RR DEC C, C
+        RI CMP C, 0
+        RCM JCF A, NE, LOOP
+        RR HLT A, A
+    WORK:
+        RR PSH B, B
+        RI ADD B, 3
+        RR POP B, B
+        RR RET A, A
+    """,
+    'clear': """
+        RI MOV MP1, 0x1000
+        RI MOV D, 0
+        RI MOV X, 0
+    LOOP:
+        RM STR D, [MP1 + X]
+        RR INC X, X
+        RI CMP X, 0x8000
+        RCM JCF A, NE, LOOP
+        RR HLT A, A
+    """,
+    'copy': """
+        RI MOV MP1, 0x1000
+        RI MOV MP2, 0x6000
+        RI MOV C, 0x4000
+    LOOP:
+        RM MOV A, [MP1 + 0]
+        RM STR A, [MP2 + 0]
+        RR INC MP1, MP1
+        RR INC MP2, MP2
+        RR DEC C, C
+        RCM JCF A, NE, LOOP
+        RR HLT A, A
+    """,
+}
+
+VARIANTS = {
+    'decoded': {'fusion': False, 'idioms': False},
+    'fused': {'fusion': True, 'idioms': False},
+    'idioms': {'fusion': True, 'idioms': True},
+}
+
+def benchmark(repeat=3):
+    """Time the loop benchmarks with cpu and each engine variant"""
+    from assembler import Assembler
+    from cpu import cpu
+
+    results = {}
+    for name, source in BENCHMARKS.items():
+        image = Assembler().assemble(source)
+        timings = {}
+        machine = cpu()
+        machine.mem[:len(image)] = image
+        retired = machine.run_for(1 << 30)
+        for variant in ('cpu', *VARIANTS):
+            best = None
+            for _ in range(repeat):
+                machine = cpu()
+                machine.mem[:len(image)] = image
+                start = time.perf_counter()
+                if variant == 'cpu':
+                    machine.run_continuous()
+                else:
+                    DecodedEngine(machine, **VARIANTS[variant]).run_continuous()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            timings[variant] = (retired / best, best)
+        results[name] = timings
+    return results
+
+if __name__ == '__main__':
+    for name, timings in benchmark().items():
+        base = timings['cpu'][0]
+        print(f"{name:>6}: " + "  ".join(
+            f"{variant} {rate / 1e6:.2f} Minstr/s (x{rate / base:.2f})"
+            for variant, (rate, _) in timings.items()))
+    sys.stdout.flush()
@@ -0,0 +1,212 @@
+from array import array
+
+DIRTY_PAGE_BITS = 8
+DIRTY_PAGE_SIZE = 1 << DIRTY_PAGE_BITS    # 256 words per tracked page
+
+class DirtyMemory(list):
+    """Guest memory that stamps each 256-word page when it is written
+
+    Every store path (STR, push, BIOS and disk writes, slice stores) goes
+    through __setitem__, which records the current epoch in the page's
+    stamp, so tracking costs one list store per write. Consumers each hold a
+    DirtyTracker with their own mark; a page is dirty for a tracker if it
+    was stamped after that tracker last cleared. Clearing advances the
+    epoch, so any number of independent consumers can share one memory.
+    """
+    __slots__ = ('stamps', 'epoch')
+
+    def __init__(self, contents):
+        super().__init__(contents)
+        self.stamps = [0] * ((len(self) + DIRTY_PAGE_SIZE - 1) >> DIRTY_PAGE_BITS)
+        self.epoch = 1
+
+    def __setitem__(self, index, value):
+        list.__setitem__(self, index, value)
+        try:
+            self.stamps[index >> DIRTY_PAGE_BITS] = self.epoch
+        except TypeError:
+            start, stop, step = index.indices(len(self))
+            if step < 0:
+                start, stop = stop + 1, start + 1
+            epoch = self.epoch
+            last = (max(stop, start + 1) - 1) >> DIRTY_PAGE_BITS
+            for page in range(start >> DIRTY_PAGE_BITS, last + 1):
+                self.stamps[page] = epoch
+
+    def touch(self, start, end):
+        """Stamp the pages of [start, end) as written, for stores that bypass __setitem__"""
+        epoch = self.epoch
+        last = (max(end, start + 1) - 1) >> DIRTY_PAGE_BITS
+        for page in range(max(start, 0) >> DIRTY_PAGE_BITS, last + 1):
+            if page < len(self.stamps):
+                self.stamps[page] = epoch
+
+    def advance(self):
+        """Start a new epoch; returns the one that just ended"""
+        epoch = self.epoch
+        self.epoch += 1
+        return epoch
+
+    def tracker(self, dirty=False):
+        """New consumer that sees pages written from now on (dirty: every page to start with)"""
+        return DirtyTracker(self, dirty)
+
+class DirtyTracker:
+    """One consumer's view of which pages changed since it last cleared"""
+    def __init__(self, memory, dirty=False):
+        self.memory = memory
+        self.mark = memory.advance()
+        if dirty:
+            self.mark = -1      # Below every stamp, including never-written pages
+
+    def page_range(self, start, end):
+        end = min(end, len(self.memory))
+        return range(max(start, 0) >> DIRTY_PAGE_BITS,
+                     (end + DIRTY_PAGE_SIZE - 1) >> DIRTY_PAGE_BITS)
+
+    def is_dirty(self, start=0, end=65536):
+        """True if any word in [start, end) may have been written"""
+        stamps, mark = self.memory.stamps, self.mark
+        return any(stamps[page] > mark for page in self.page_range(start, end))
+
+    def dirty_pages(self, start=0, end=65536):
+        """Indexes of the dirty pages overlapping [start, end)"""
+        stamps, mark = self.memory.stamps, self.mark
+        return [page for page in self.page_range(start, end) if stamps[page] > mark]
+
+    def dirty_ranges(self, start=0, end=65536):
+        """Dirty pages in [start, end) merged into (start, end) word ranges"""
+        ranges = []
+        for page in self.dirty_pages(start, end):
+            low = max(page << DIRTY_PAGE_BITS, start)
+            high = min((page + 1) << DIRTY_PAGE_BITS, end, len(self.memory))
+            if ranges and ranges[-1][1] == low:
+                ranges[-1] = (ranges[-1][0], high)
+            else:
+                ranges.append((low, high))
+        return ranges
+
+    def clear(self):
+        """Forget everything written so far"""
+        self.mark = self.memory.advance()
+
+COW_PAGE_BITS = 8
+COW_PAGE_SIZE = 1 << COW_PAGE_BITS      # 256 words per shared page
+COW_PAGE_OFFSET = COW_PAGE_SIZE - 1
+
+class CowMemory:
+    """Guest memory whose pages are shared with other instances until written
+
+    Memory is a list of 256-word page lists. Forked instances start with
+    references to the same pages and copy a page privately only on their
+    first store to it, so thousands of machines spawned from one template
+    cost a page table each plus the pages they actually dirty. Shared pages
+    are never modified in place by anyone.
+
+    Supports indexing, slices and len() like the plain list it replaces.
+    """
+    __slots__ = ('pages', 'owned')
+
+    def __init__(self, pages, owned=None):
+        self.pages = pages
+        self.owned = owned if owned is not None else bytearray(len(pages))
+
+    @classmethod
+    def from_list(cls, words):
+        """Shared pages holding a copy of words"""
+        return cls([list(words[start:start + COW_PAGE_SIZE])
+                    for start in range(0, len(words), COW_PAGE_SIZE)])
+
+    def fork(self):
+        """New memory sharing every current page; this one gives up ownership too"""
+        self.owned = bytearray(len(self.pages))
+        return CowMemory(list(self.pages))
+
+    @property
+    def private_pages(self):
+        return sum(self.owned)
+
+    def __len__(self):
+        return len(self.pages) << COW_PAGE_BITS
+
+    def __getitem__(self, address):
+        try:
+            return self.pages[address >> COW_PAGE_BITS][address & COW_PAGE_OFFSET]
+        except TypeError:
+            start, stop, step = address.indices(len(self))
+            if step != 1:
+                return [self[index] for index in range(start, stop, step)]
+            words = []
+            pages = self.pages
+            while start < stop:
+                offset = start & COW_PAGE_OFFSET
+                length = min(stop - start, COW_PAGE_SIZE - offset)
+                words += pages[start >> COW_PAGE_BITS][offset:offset + length]
+                start += length
+            return words
+
+    def __setitem__(self, address, value):
+        try:
+            page = address >> COW_PAGE_BITS
+        except TypeError:
+            return self.write_slice(address, value)
+        if not self.owned[page]:
+            self.copy_page(page)
+        self.pages[page][address & COW_PAGE_OFFSET] = value
+
+    def copy_page(self, page):
+        """First store to a shared page: take a private copy"""
+        self.pages[page] = list(self.pages[page])
+        self.owned[page] = 1
+
+    def write_slice(self, index, values):
+        start, stop, step = index.indices(len(self))
+        values = list(values)
+        if step != 1:
+            for address, value in zip(range(start, stop, step), values):
+                self[address] = value
+            return
+        if len(values) != max(stop - start, 0):
+            raise ValueError("CowMemory slices cannot change length")
+        position = 0
+        while start < stop:
+            page = start >> COW_PAGE_BITS
+            offset = start & COW_PAGE_OFFSET
+            length = min(stop - start, COW_PAGE_SIZE - offset)
+            if not self.owned[page]:
+                self.copy_page(page)
+            self.pages[page][offset:offset + length] = values[position:position + length]
+            position += length
+            start += length
+
+class SharedWords:
+    """List-compatible view of the 32-bit words in a shared buffer
+
+    A memoryview cast to 'I' indexes like a list, but slice reads return
+    views and slice stores only accept another buffer, while the BIOS, disk
+    and video code read and store lists. This returns lists for slice reads
+    and converts slice stores, so a cpu can use shared memory directly.
+    """
+    __slots__ = ('words',)
+
+    def __init__(self, words):
+        self.words = words
+
+    def __len__(self):
+        return len(self.words)
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __getitem__(self, address):
+        if address.__class__ is slice:
+            return self.words[address].tolist()
+        return self.words[address]
+
+    def __setitem__(self, address, value):
+        if address.__class__ is slice:
+            value = array('I', value)
+        self.words[address] = value
+
+    def release(self):
+        self.words.release()
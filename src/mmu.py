@@ -0,0 +1,180 @@
+from cpu import CPUTrap, TRAP_MEMORY_FAULT
+from memory import DIRTY_PAGE_BITS, DirtyMemory
+
+PAGE_BITS = 12
+PAGE_SIZE = 1 << PAGE_BITS          # 4096 words
+PAGE_OFFSET = PAGE_SIZE - 1
+VIRTUAL_PAGES = 65536 // PAGE_SIZE  # 16
+
+# Mapping registers, one per virtual page, at I/O ports 0x9100-0x910F
+MMU_PORT = 0x9100
+PAGE_FRAME = 0x0FFF                 # Physical page number
+PAGE_READ_ONLY = 0x4000             # Writes raise a memory fault
+PAGE_NOT_PRESENT = 0x8000           # Any access raises a memory fault
+
+EMPTY_PAGE = [0] * PAGE_SIZE
+
+class MappedMemory(DirtyMemory):
+    """Guest memory seen through a page table onto a larger physical memory
+
+    The 16-bit address space is split into 16 pages of 4096 words, each
+    mapped by a register (physical page | PAGE_READ_ONLY | PAGE_NOT_PRESENT)
+    onto a physical memory of up to 4096 pages.
+
+    The list itself holds the current translation of all 16 pages, so loads
+    and instruction fetches stay plain list reads with no translation cost;
+    a mapping change copies the new page in. Stores go through a 16-entry
+    software TLB of physical page bases and are written through to physical
+    memory. A TLB miss walks the register, raising a memory-fault CPUTrap for
+    read-only or unmapped pages; pages aliased to the same physical page are
+    never cached, so their stores update every alias. While any page is
+    unmapped the memory switches to PartialMappedMemory, whose reads check
+    presence too. Every change to the window, including a page swap, stamps
+    the DirtyMemory pages it touches.
+    """
+    __slots__ = ('physical', 'registers', 'tlb_write', 'tlb_misses')
+
+    def __init__(self, physical_words=1 << 20, contents=None):
+        pages = physical_words // PAGE_SIZE
+        if physical_words % PAGE_SIZE or not VIRTUAL_PAGES <= pages <= PAGE_FRAME + 1:
+            raise ValueError(f"Physical memory must be 16 to 4096 pages of {PAGE_SIZE} words")
+        super().__init__(EMPTY_PAGE * VIRTUAL_PAGES)
+        self.physical = [0] * physical_words
+        if contents is not None:
+            self.physical[:len(contents)] = contents
+        self.tlb_misses = 0
+        self.reset()
+
+    @property
+    def physical_pages(self):
+        return len(self.physical) // PAGE_SIZE
+
+    def reset(self):
+        """Back to the identity mapping"""
+        self.registers = list(range(VIRTUAL_PAGES))
+        self.reload()
+
+    def reload(self):
+        """Rebuild the view, TLB and class from the registers and physical memory"""
+        self.tlb_write = [None] * VIRTUAL_PAGES
+        for page in range(VIRTUAL_PAGES):
+            self.load_page(page)
+        partial = any(entry & PAGE_NOT_PRESENT for entry in self.registers)
+        self.__class__ = PartialMappedMemory if partial else MappedMemory
+
+    def map(self, page, value):
+        """Set the mapping register of a virtual page"""
+        page &= VIRTUAL_PAGES - 1
+        if (value & PAGE_FRAME) >= self.physical_pages and not value & PAGE_NOT_PRESENT:
+            raise CPUTrap(TRAP_MEMORY_FAULT,
+                          f"page {page} mapped to missing physical page {value & PAGE_FRAME:#x}")
+        self.registers[page] = value & (PAGE_FRAME | PAGE_READ_ONLY | PAGE_NOT_PRESENT)
+        self.tlb_write = [None] * VIRTUAL_PAGES     # Aliasing may have changed
+        self.load_page(page)
+        partial = any(entry & PAGE_NOT_PRESENT for entry in self.registers)
+        self.__class__ = PartialMappedMemory if partial else MappedMemory
+
+    def load_page(self, page):
+        """Copy the physical page now mapped at a virtual page into view"""
+        entry = self.registers[page]
+        start = page << PAGE_BITS
+        self.touch(start, start + PAGE_SIZE)
+        if entry & PAGE_NOT_PRESENT:
+            list.__setitem__(self, slice(start, start + PAGE_SIZE), EMPTY_PAGE)
+        else:
+            base = (entry & PAGE_FRAME) << PAGE_BITS
+            list.__setitem__(self, slice(start, start + PAGE_SIZE),
+                             self.physical[base:base + PAGE_SIZE])
+
+    def aliases(self, frame):
+        """Virtual pages currently mapped to a physical page"""
+        return [page for page, entry in enumerate(self.registers)
+                if not entry & PAGE_NOT_PRESENT and entry & PAGE_FRAME == frame]
+
+    def writable(self, page):
+        """Check a store to a virtual page; returns its physical page"""
+        entry = self.registers[page]
+        if entry & PAGE_NOT_PRESENT:
+            raise CPUTrap(TRAP_MEMORY_FAULT, f"page {page:#x} not present")
+        if entry & PAGE_READ_ONLY:
+            raise CPUTrap(TRAP_MEMORY_FAULT, f"write to read-only page {page:#x}")
+        return entry & PAGE_FRAME
+
+    def __setitem__(self, address, value):
+        try:
+            base = self.tlb_write[address >> PAGE_BITS]
+        except TypeError:
+            return self.write_slice(address, value)
+        if base is None:
+            return self.store_miss(address, value)
+        self.physical[base + (address & PAGE_OFFSET)] = value
+        list.__setitem__(self, address, value)
+        self.stamps[address >> DIRTY_PAGE_BITS] = self.epoch
+
+    def store_miss(self, address, value):
+        """TLB miss: walk the mapping register, then store and maybe cache it"""
+        self.tlb_misses += 1
+        if not -len(self) <= address < len(self):
+            raise IndexError("list assignment index out of range")
+        address &= 0xFFFF
+        page = address >> PAGE_BITS
+        frame = self.writable(page)
+        offset = address & PAGE_OFFSET
+        self.physical[(frame << PAGE_BITS) + offset] = value
+        aliases = self.aliases(frame)
+        for alias in aliases:
+            list.__setitem__(self, (alias << PAGE_BITS) + offset, value)
+            self.touch((alias << PAGE_BITS) + offset, (alias << PAGE_BITS) + offset + 1)
+        if len(aliases) == 1:
+            self.tlb_write[page] = frame << PAGE_BITS
+
+    def write_slice(self, index, values):
+        start, stop, step = index.indices(len(self))
+        values = list(values)
+        if step != 1:
+            for address, value in zip(range(start, stop, step), values):
+                self[address] = value
+            return
+        if len(values) != max(stop - start, 0):
+            raise ValueError("MappedMemory slices cannot change length")
+        while start < stop:
+            page = start >> PAGE_BITS
+            length = min(stop, (page + 1) << PAGE_BITS) - start
+            frame = self.writable(page)
+            offset = start & PAGE_OFFSET
+            run = values[:length]
+            base = (frame << PAGE_BITS) + offset
+            self.physical[base:base + length] = run
+            for alias in self.aliases(frame):
+                target = (alias << PAGE_BITS) + offset
+                list.__setitem__(self, slice(target, target + length), run)
+                self.touch(target, target + length)
+            values = values[length:]
+            start += length
+
+class PartialMappedMemory(MappedMemory):
+    """MappedMemory with unmapped pages: reads check presence as well"""
+    __slots__ = ()
+
+    def __getitem__(self, address):
+        registers = self.registers
+        try:
+            entry = registers[address >> PAGE_BITS]
+        except TypeError:
+            start, stop, step = address.indices(len(self))
+            for page in range(start >> PAGE_BITS, ((max(stop, start + 1) - 1) >> PAGE_BITS) + 1):
+                if registers[page] & PAGE_NOT_PRESENT:
+                    raise CPUTrap(TRAP_MEMORY_FAULT, f"page {page:#x} not present") from None
+            return list.__getitem__(self, address)
+        if entry & PAGE_NOT_PRESENT:
+            raise CPUTrap(TRAP_MEMORY_FAULT,
+                          f"page {(address & 0xFFFF) >> PAGE_BITS:#x} not present")
+        return list.__getitem__(self, address)
+
+def enable(machine, physical_words=1 << 20):
+    """Give a cpu an MMU, keeping its current 64K as physical pages 0-15"""
+    memory = MappedMemory(physical_words, machine.mem[:])
+    machine.mem = memory
+    machine.mmu = memory
+    machine.write_bda_word(machine.INSTALLED_MEMORY, physical_words // 1024)
+    return memory
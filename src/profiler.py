@@ -0,0 +1,176 @@
+import sys
+from collections import Counter
+
+class Profiler:
+    """Sampling guest profiler with a shadow call stack
+
+    Every `interval` instructions the current PC is sampled and charged to
+    the label containing it (exclusive), to its source line, and to every
+    function on the shadow call stack (inclusive). The stack is maintained
+    by hooking JSR and RET on the machine instance, so the guest stack is
+    never inspected; a RET that does not match the innermost frame unwinds
+    to the frame with the matching return address. Counts are scaled by
+    the interval, so they estimate instructions executed.
+
+    Profiling runs on the interpreter (cpu.run_for); engines that bypass
+    cpu.exec_* do not report calls.
+    """
+    def __init__(self, machine, debug_map, interval=100):
+        self.machine = machine
+        self.debug_map = debug_map
+        self.interval = interval
+
+        root = debug_map.label_for(machine.pc) or '<root>'
+        self.stack = [(root, None)]     # (function, return address)
+        self.samples = Counter()        # pc -> samples
+        self.exclusive = Counter()      # label -> instructions
+        self.inclusive = Counter()      # function/label -> instructions
+        self.lines = Counter()          # source line -> instructions
+        self.tree = Counter()           # call path tuple -> instructions (exclusive)
+        self.calls = Counter()          # function -> calls
+        self.instructions = 0
+        self.attached = False
+
+    def attach(self):
+        """Install JSR/RET hooks on the machine instance"""
+        if self.attached:
+            return
+        machine = self.machine
+        exec_rr, exec_ri = machine.exec_rr, machine.exec_ri
+        exec_rm, exec_rcm = machine.exec_rm, machine.exec_rcm
+
+        def hooked_rr(opcode, rd, rs1, rs2):
+            exec_rr(opcode, rd, rs1, rs2)
+            if opcode == 0x24:  # RET
+                self.leave(machine.pc)
+
+        def hooked_ri(opcode, rd, imm):
+            exec_ri(opcode, rd, imm)
+            if opcode == 0x24:  # RET
+                self.leave(machine.pc)
+
+        def hooked_rm(opcode, rd, address):
+            if opcode == 0x22:  # JSR
+                return_address = machine.pc
+                exec_rm(opcode, rd, address)
+                self.enter(machine.pc, return_address)
+            else:
+                exec_rm(opcode, rd, address)
+
+        def hooked_rcm(opcode, reg, condition, address):
+            if opcode == 0x22:  # JSR
+                return_address = machine.pc
+                exec_rcm(opcode, reg, condition, address)
+                self.enter(machine.pc, return_address)
+            else:
+                exec_rcm(opcode, reg, condition, address)
+
+        machine.exec_rr, machine.exec_ri = hooked_rr, hooked_ri
+        machine.exec_rm, machine.exec_rcm = hooked_rm, hooked_rcm
+        self.attached = True
+
+    def detach(self):
+        """Remove the hooks, restoring the class methods"""
+        if self.attached:
+            for name in ('exec_rr', 'exec_ri', 'exec_rm', 'exec_rcm'):
+                del self.machine.__dict__[name]
+            self.attached = False
+
+    def enter(self, target, return_address):
+        function = self.debug_map.function_for(target) or f"{target:#06x}"
+        self.stack.append((function, return_address))
+        self.calls[function] += 1
+
+    def leave(self, pc):
+        stack = self.stack
+        for depth in range(len(stack) - 1, 0, -1):
+            if stack[depth][1] == pc:
+                del stack[depth:]
+                return
+        # Not a return to any known caller (e.g. a computed jump through RET)
+
+    def sample(self, weight):
+        machine = self.machine
+        pc = machine.pc if machine.run else (machine.pc - 1) & 0xFFFF     # The HLT, not past it
+        debug_map = self.debug_map
+        label = debug_map.label_for(pc) or '<unknown>'
+        self.samples[pc] += 1
+        self.exclusive[label] += weight
+        location = debug_map.line_for(pc)
+        if location:
+            self.lines[location] += weight
+
+        path = tuple(function for function, _ in self.stack)
+        for name in set(path) | {label}:
+            self.inclusive[name] += weight
+        self.tree[path] += weight
+
+    def run(self, max_instructions=None):
+        """Run the machine until it stops (or max_instructions), sampling as it goes"""
+        self.attach()
+        machine = self.machine
+        try:
+            while machine.run and (max_instructions is None
+                                   or self.instructions < max_instructions):
+                count = self.interval
+                if max_instructions is not None:
+                    count = min(count, max_instructions - self.instructions)
+                executed = machine.run_for(count)
+                self.instructions += executed
+                if executed:
+                    self.sample(executed)
+        finally:
+            self.detach()
+        machine.console.flush()
+
+    def report(self, limit=20, file=None):
+        """Print the flat profile, hottest source lines and the call tree"""
+        file = file or sys.stdout
+        total = max(sum(self.exclusive.values()), 1)
+        print(f"{self.instructions} instructions, {sum(self.samples.values())} samples "
+              f"every {self.interval}", file=file)
+
+        print(f"\n{'exclusive':>10} {'%':>6} {'inclusive':>10} {'calls':>7}  label", file=file)
+        labels = sorted(self.inclusive,
+                        key=lambda label: (-self.exclusive[label], -self.inclusive[label]))
+        for label in labels[:limit]:
+            count = self.exclusive[label]
+            print(f"{count:>10} {100 * count / total:>6.1f} {self.inclusive[label]:>10} "
+                  f"{self.calls[label]:>7}  {label}", file=file)
+
+        print(f"\n{'count':>10} {'%':>6}  line", file=file)
+        for (filename, line), count in self.lines.most_common(limit):
+            print(f"{count:>10} {100 * count / total:>6.1f}  {filename}:{line}", file=file)
+
+        print("\ncall tree (inclusive)", file=file)
+        subtree = Counter()
+        for path, count in self.tree.items():
+            for depth in range(1, len(path) + 1):
+                subtree[path[:depth]] += count
+
+        def show(path):
+            print(f"{subtree[path]:>10} {'  ' * (len(path) - 1)}{path[-1]}", file=file)
+            children = [child for child in subtree if len(child) == len(path) + 1
+                        and child[:len(path)] == path]
+            for child in sorted(children, key=lambda child: -subtree[child]):
+                show(child)
+
+        roots = [path for path in subtree if len(path) == 1]
+        for root in sorted(roots, key=lambda path: -subtree[path]):
+            show(root)
+
+if __name__ == '__main__':
+    # python profiler.py program.asm [interval]
+    from codecache import CodeCache
+    from cpu import STACK_TOP, cpu
+
+    cache = CodeCache()
+    with open(sys.argv[1]) as source:
+        image = cache.assemble(source.read(), sys.argv[1])
+    machine = cpu()
+    machine.mem[:len(image)] = image
+    machine.regs[7] = STACK_TOP
+    interval = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    profiler = Profiler(machine, cache.debug_map, interval)
+    profiler.run()
+    profiler.report()
@@ -0,0 +1,248 @@
+from collections import deque
+from itertools import chain
+
+from memory import DIRTY_PAGE_SIZE, DirtyMemory
+
+# Approximate host memory use, for the max_journal_bytes budget
+RECORD_BYTES = 120          # Per-instruction record: tuple, PC and flags
+ENTRY_BYTES = 80            # One changed register or written word: (index, value) pair
+WORD_BYTES = 40             # Each word of a bulk (slice) write
+CHECKPOINT_WORD_BYTES = 8   # Each word a checkpoint copies
+CHECKPOINT_PAGE_BYTES = 8   # Each page reference in a checkpoint's page table
+
+MMU_REGISTER = 16           # Journal index of mapping register 0 (0-15 are CPU registers)
+
+class JournalMemory(DirtyMemory):
+    """Guest memory that records every word written into it (and stamps its page)"""
+    __slots__ = ('writes',)
+
+    def __init__(self, contents):
+        super().__init__(contents)
+        self.writes = []
+
+    def __setitem__(self, index, value):
+        if not isinstance(index, slice):
+            DirtyMemory.__setitem__(self, index, value)
+            self.writes.append((index, value))
+            return
+        value = list(value)     # May be an iterator, consumed by the store
+        DirtyMemory.__setitem__(self, index, value)
+        start, stop, step = index.indices(len(self))
+        if step == 1:
+            self.writes.append((start, value))
+        else:
+            self.writes.extend(zip(range(start, stop, step), value))
+
+def record_bytes(changed, writes):
+    """Approximate size of one journal record"""
+    size = RECORD_BYTES + ENTRY_BYTES * (len(changed) + len(writes))
+    for _, value in writes:
+        if isinstance(value, list):
+            size += WORD_BYTES * len(value)
+    return size
+
+class Checkpoint:
+    """Full machine state plus the journal of the instructions that follow it
+
+    memory is the journaled memory: the cpu's own, or the MMU's physical
+    memory together with its mapping registers. It is kept as a table of
+    immutable page copies; only the dirty pages are copied, the rest are
+    shared with the previous checkpoint's table.
+    """
+    def __init__(self, cycle, machine, memory, previous=None, dirty=None):
+        self.cycle = cycle
+        self.regs = list(machine.regs)
+        self.pc = machine.pc
+        self.cycles = machine.cycles
+        self.flags = pack_flags(machine)
+        self.halt_reason = machine.halt_reason
+        count = (len(memory) + DIRTY_PAGE_SIZE - 1) // DIRTY_PAGE_SIZE
+        if previous is None or dirty is None:
+            self.pages, dirty = [None] * count, range(count)
+        else:
+            self.pages = list(previous.pages)
+        copied = 0
+        for page in dirty:
+            start = page * DIRTY_PAGE_SIZE
+            self.pages[page] = words = tuple(memory[start:start + DIRTY_PAGE_SIZE])
+            copied += len(words)
+        self.mapping = list(machine.mmu.registers) if machine.mmu else None
+        self.journal = []           # One record per instruction
+        # Approximate, with the journal; shared pages are charged to the checkpoint that copied them
+        self.bytes = CHECKPOINT_WORD_BYTES * copied + CHECKPOINT_PAGE_BYTES * count
+
+    def restore(self, machine, memory):
+        machine.regs = list(self.regs)
+        machine.pc = self.pc
+        machine.cycles = self.cycles
+        unpack_flags(machine, self.flags)
+        machine.halt_reason = self.halt_reason
+        list.__setitem__(memory, slice(None), chain.from_iterable(self.pages))
+        memory.touch(0, len(memory))
+        if self.mapping is not None:
+            machine.mmu.registers = list(self.mapping)
+
+def pack_flags(machine):
+    return (machine.zf | machine.cf << 1 | machine.sf << 2
+            | machine.ie << 3 | machine.run << 4)
+
+def unpack_flags(machine, flags):
+    machine.zf = bool(flags & 1)
+    machine.cf = bool(flags & 2)
+    machine.sf = bool(flags & 4)
+    machine.ie = bool(flags & 8)
+    machine.run = bool(flags & 16)
+
+class Rewinder:
+    """Reverse execution for a cpu through checkpoints and a delta journal
+
+    Every checkpoint_interval instructions a checkpoint is taken, copying
+    only the memory pages a DirtyTracker saw written since the last one; in
+    between, each instruction logs only its new PC and flags, the registers
+    it changed and the memory words it wrote. Rewinding restores the nearest
+    earlier checkpoint and replays the journal forward, so no guest code is
+    re-executed and host I/O is not repeated. The oldest checkpoints (with
+    their journals) are evicted once max_checkpoints or max_journal_bytes
+    (an estimate of the host memory held by checkpoints and journals) is
+    exceeded, which bounds how far back a rewind can go.
+
+    With an MMU the physical memory is journaled, along with the mapping
+    registers, and the mapped view is rebuilt after a rewind; enable the MMU
+    before creating the Rewinder.
+
+    Host device state (console output, disk) is not rewound.
+    """
+    def __init__(self, machine, checkpoint_interval=10000, max_checkpoints=16,
+                 max_journal_bytes=64 << 20):
+        self.machine = machine
+        self.checkpoint_interval = checkpoint_interval
+        self.max_checkpoints = max_checkpoints
+        self.max_journal_bytes = max_journal_bytes
+
+        mmu = machine.mmu
+        if mmu:
+            if not isinstance(mmu.physical, JournalMemory):
+                mmu.physical = JournalMemory(mmu.physical)
+            self.memory = mmu.physical
+        else:
+            if not isinstance(machine.mem, JournalMemory):
+                machine.mem = JournalMemory(machine.mem)
+            self.memory = machine.mem
+        self.tracker = self.memory.tracker(dirty=True)
+        self.cycle = 0
+        self.bytes = 0
+        self.checkpoints = deque()
+        self.checkpoint()
+
+    def checkpoint(self):
+        """Take a checkpoint at the current cycle"""
+        previous = self.checkpoints[-1] if self.checkpoints else None
+        dirty = self.tracker.dirty_pages(0, len(self.memory))
+        self.tracker.clear()
+        checkpoint = Checkpoint(self.cycle, self.machine, self.memory, previous, dirty)
+        self.checkpoints.append(checkpoint)
+        self.bytes += checkpoint.bytes
+        self.evict()
+
+    def evict(self):
+        """Drop the oldest checkpoints until the journal fits its budget"""
+        while len(self.checkpoints) > 1 and (
+                len(self.checkpoints) > self.max_checkpoints
+                or self.bytes > self.max_journal_bytes):
+            oldest = self.checkpoints.popleft()
+            # Pages the next checkpoint still shares stay alive: charge them to it instead
+            newer = self.checkpoints[0]
+            kept = CHECKPOINT_WORD_BYTES * sum(
+                len(page) for page, shared in zip(oldest.pages, newer.pages) if page is shared)
+            newer.bytes += kept
+            self.bytes -= oldest.bytes - kept
+
+    @property
+    def earliest_cycle(self):
+        """Oldest cycle that can still be rewound to"""
+        return self.checkpoints[0].cycle
+
+    def step(self):
+        """Execute one instruction, journaling its effects"""
+        machine = self.machine
+        if not machine.run:
+            return
+        latest = self.checkpoints[-1]
+        if self.cycle - latest.cycle >= self.checkpoint_interval:
+            self.checkpoint()
+            latest = self.checkpoints[-1]
+
+        mem = self.memory
+        mmu = machine.mmu
+        before = list(machine.regs)
+        if mmu:
+            before += mmu.registers
+        mem.writes = []
+        machine.run_for(1)
+
+        after = machine.regs + mmu.registers if mmu else machine.regs
+        changed = tuple((index, value) for index, (old, value)
+                        in enumerate(zip(before, after)) if old != value)
+        writes = tuple(mem.writes)
+        latest.journal.append((machine.pc, pack_flags(machine), machine.halt_reason,
+                               changed, writes))
+        size = record_bytes(changed, writes)
+        latest.bytes += size
+        self.bytes += size
+        self.cycle += 1
+        if self.bytes > self.max_journal_bytes:
+            self.evict()
+
+    def run(self, count=None):
+        """Run until the CPU stops, or for count instructions"""
+        end = None if count is None else self.cycle + count
+        while self.machine.run and (end is None or self.cycle < end):
+            self.step()
+        self.machine.console.flush()
+
+    def rewind_to(self, cycle):
+        """Restore the machine to the state after `cycle` instructions"""
+        if cycle > self.cycle:
+            raise ValueError(f"Cycle {cycle} has not been executed yet (at {self.cycle})")
+        if cycle < self.earliest_cycle:
+            raise ValueError(f"Cycle {cycle} was evicted (earliest is {self.earliest_cycle})")
+
+        # Nearest checkpoint at or before the target; later ones are discarded
+        while self.checkpoints[-1].cycle > cycle:
+            self.bytes -= self.checkpoints.pop().bytes
+        checkpoint = self.checkpoints[-1]
+        machine = self.machine
+        mem = self.memory
+        checkpoint.restore(machine, mem)
+
+        # Replay the journal forward (restore already marked every page dirty)
+        regs = machine.regs
+        replay = cycle - checkpoint.cycle
+        for pc, flags, halt_reason, changed, writes in checkpoint.journal[:replay]:
+            machine.pc = pc
+            unpack_flags(machine, flags)
+            machine.halt_reason = halt_reason
+            for index, value in changed:
+                if index < MMU_REGISTER:
+                    regs[index] = value
+                else:
+                    machine.mmu.registers[index - MMU_REGISTER] = value
+            for address, value in writes:
+                if isinstance(value, list):
+                    list.__setitem__(mem, slice(address, address + len(value)), value)
+                else:
+                    list.__setitem__(mem, address, value)
+        if machine.mmu:
+            machine.mmu.reload()
+
+        for _, _, _, changed, writes in checkpoint.journal[replay:]:
+            size = record_bytes(changed, writes)
+            checkpoint.bytes -= size
+            self.bytes -= size
+        del checkpoint.journal[replay:]
+        machine.cycles += replay
+        self.cycle = cycle
+
+    def step_back(self, count=1):
+        """Undo the last count instructions"""
+        self.rewind_to(max(self.cycle - count, 0))
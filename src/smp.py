@@ -0,0 +1,221 @@
+import multiprocessing
+import queue
+import time
+from multiprocessing import shared_memory
+
+from cpu import cpu, CPUTrap, STACK_TOP, TRAP_INVALID_OPCODE
+from memory import SharedWords
+
+FIRST_IPI_VECTOR = 4    # Vectors 0-3 are the CPU trap vectors
+
+class SMPSystem:
+    """N cpu cores, one host process each, sharing one guest memory
+
+    Guest memory lives in a multiprocessing.shared_memory block viewed as
+    32-bit cells (instruction words are 32 bits wide, see SharedWords), so
+    every core sees the other cores' stores. Each core has its own
+    registers, PC and flags.
+    Boot protocol: every core starts at the entry point with A = core number
+    and SP = stack_top - core * stack_size, by default below video memory.
+
+    Cores coordinate with TAS/CAS (atomic under a shared bus lock) and IPI,
+    which sets a bit in the target core's mailbox. Mailboxes are polled every
+    poll_interval instructions and delivered through the interrupt vector
+    table when the target core has interrupts enabled (STI); an IPI whose
+    vector has no handler stays pending until one is installed. Entering a
+    handler disables interrupts, so IPIs do not nest; handlers re-enable
+    them with STI before RTI. IPI vectors 0-3 are reserved for CPU traps and
+    raise an invalid-opcode trap.
+    """
+    def __init__(self, num_cores=None, poll_interval=256):
+        self.num_cores = num_cores or multiprocessing.cpu_count()
+        self.poll_interval = poll_interval
+
+        self.memory = shared_memory.SharedMemory(create=True, size=65536 * 4)
+        self.mailboxes = shared_memory.SharedMemory(create=True, size=self.num_cores * 4)
+        self.mem = SharedWords(self.memory.buf.cast('I'))
+        self.mailboxes.buf[:] = bytes(self.num_cores * 4)
+
+        self.bus_lock = multiprocessing.Lock()
+        self.results = multiprocessing.Queue()
+        self.processes = []
+
+        # Power-on state of the shared memory (BIOS Data Area)
+        boot = cpu()
+        for address, value in enumerate(boot.mem):
+            if value:
+                self.mem[address] = value
+
+    def load(self, image, address=0):
+        """Copy a machine-code or data image into shared memory"""
+        self.mem[address:address + len(image)] = image
+
+    def start(self, entry=0, stack_top=STACK_TOP, stack_size=0x400, max_instructions=None):
+        """Start every core in its own process"""
+        for core in range(self.num_cores):
+            process = multiprocessing.Process(
+                target=core_main,
+                args=(core, self.num_cores, self.memory.name, self.mailboxes.name,
+                      self.bus_lock, self.results, entry,
+                      (stack_top - core * stack_size) & 0xFFFF,
+                      self.poll_interval, max_instructions),
+                daemon=True,
+            )
+            process.start()
+            self.processes.append(process)
+
+    def join(self, timeout=None, poll=0.5):
+        """Wait for all cores to stop; returns one result dict per core
+
+        Raises RuntimeError if a core process dies without reporting, and
+        TimeoutError if the cores are still running after timeout seconds.
+        """
+        results = []
+        waited = 0.0
+        while len(results) < len(self.processes):
+            try:
+                results.append(self.results.get(timeout=poll))
+                continue
+            except queue.Empty:
+                waited += poll
+            if not any(process.is_alive() for process in self.processes):
+                # Every process has exited; pick up anything still in flight
+                try:
+                    while len(results) < len(self.processes):
+                        results.append(self.results.get(timeout=poll))
+                except queue.Empty:
+                    reported = {result['core'] for result in results}
+                    missing = [core for core in range(len(self.processes))
+                               if core not in reported]
+                    raise RuntimeError(
+                        f"Core processes {missing} exited without a result") from None
+            elif timeout is not None and waited >= timeout:
+                raise TimeoutError(f"Cores still running after {timeout} seconds")
+        for process in self.processes:
+            process.join(poll)
+        self.processes = []
+        return sorted(results, key=lambda result: result['core'])
+
+    def run(self, entry=0, **kwargs):
+        """Start all cores and wait for them to finish"""
+        self.start(entry, **kwargs)
+        return self.join()
+
+    def close(self):
+        """Stop the cores and release the shared memory blocks"""
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        self.processes = []
+        self.mem.release()
+        self.memory.close()
+        self.memory.unlink()
+        self.mailboxes.close()
+        self.mailboxes.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def core_main(core, num_cores, memory_name, mailbox_name, bus_lock, results,
+              entry, stack_pointer, poll_interval, max_instructions):
+    """Entry point of a core process"""
+    memory = shared_memory.SharedMemory(name=memory_name)
+    mailbox_block = shared_memory.SharedMemory(name=mailbox_name)
+    mailboxes = mailbox_block.buf.cast('I')
+
+    core_cpu = cpu()
+    core_cpu.mem = SharedWords(memory.buf.cast('I'))
+    core_cpu.core_id = core
+    core_cpu.bus_lock = bus_lock
+    core_cpu.pc = entry
+    core_cpu.regs[0] = core
+    core_cpu.regs[7] = stack_pointer
+
+    def send_ipi(target, vector):
+        if vector < FIRST_IPI_VECTOR:
+            raise CPUTrap(TRAP_INVALID_OPCODE, f"IPI vector {vector} is reserved for CPU traps")
+        if target < num_cores:
+            with bus_lock:
+                mailboxes[target] |= 1 << vector
+    core_cpu.ipi_handler = send_ipi
+
+    def next_ipi():
+        """Take the lowest pending vector that has a handler; others stay pending"""
+        with bus_lock:
+            pending = mailboxes[core]
+            for vector in range(FIRST_IPI_VECTOR, 16):
+                if pending & (1 << vector) and core_cpu.mem[core_cpu.INTERRUPT_VECTORS + vector]:
+                    mailboxes[core] = pending & ~(1 << vector)
+                    return vector
+        return None
+
+    executed = 0
+    try:
+        while core_cpu.run:
+            executed += core_cpu.run_for(poll_interval)
+            if max_instructions is not None and executed >= max_instructions:
+                break
+            if mailboxes[core] and core_cpu.ie:
+                vector = next_ipi()
+                if vector is not None:
+                    try:
+                        core_cpu.interrupt(vector)
+                    except CPUTrap as error:
+                        core_cpu.handle_fault(error)
+    finally:
+        # Always report, so join() never waits on a core that died
+        core_cpu.console.flush()
+        results.put({
+            'core': core,
+            'regs': list(core_cpu.regs),
+            'pc': core_cpu.pc,
+            'flags': (core_cpu.zf, core_cpu.cf, core_cpu.sf),
+            'halt_reason': core_cpu.halt_reason,
+            'instructions': executed,
+        })
+
+        core_cpu.mem.release()
+        mailboxes.release()
+        memory.close()
+        mailbox_block.close()
+
+BENCHMARK = """
+    RI MOV C, 0
+LOOP:
+    RI INC C, 0
+    RI CMP C, 60000
+    RCM JCF A, NE, LOOP
+    RR HLT A, A
+"""
+
+def benchmark(max_cores=None, repeat=3):
+    """Aggregate instructions per second with the same loop on 1, 2, 4 ... cores
+
+    Timings include starting the core processes, as SMPSystem.run does.
+    """
+    from assembler import Assembler
+
+    image = Assembler().assemble(BENCHMARK)
+    max_cores = max_cores or multiprocessing.cpu_count()
+    counts = sorted({1 << shift for shift in range(max_cores.bit_length())} | {max_cores})
+    results = {}
+    for cores in counts:
+        best = None
+        for _ in range(repeat):
+            with SMPSystem(cores) as system:
+                system.load(image)
+                start = time.perf_counter()
+                retired = sum(result['instructions'] for result in system.run())
+                elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[cores] = (retired / best, best)
+    return results
+
+if __name__ == '__main__':
+    timings = benchmark()
+    base = timings[1][0]
+    for cores, (rate, elapsed) in timings.items():
+        print(f"{cores:>3} cores: {rate / 1e6:.2f} Minstr/s (x{rate / base:.2f}), {elapsed:.3f}s")
@@ -0,0 +1,109 @@
+import numpy as np
+import pygame
+
+from cpu import GRAPHICS_WIDTH, GRAPHICS_HEIGHT, FRAMEBUFFER_WORDS
+
+# Mode 0x13 framebuffer: 4 bits per pixel packed four to a word (leftmost
+# pixel in the low nibble), rows stored in order from VIDEO_MEMORY_BASE.
+# Rows that would lie past the end of guest memory are clipped like
+# off-screen pixels.
+PIXELS_PER_WORD = 4
+WORDS_PER_ROW = GRAPHICS_WIDTH // PIXELS_PER_WORD
+
+SHIFTS = np.arange(0, 16, 4, dtype=np.uint32)
+
+def unpack_pixels(words, rows):
+    """Packed framebuffer words -> (rows, 320) array of colour indexes"""
+    words = np.asarray(words, dtype=np.uint32).reshape(rows, WORDS_PER_ROW, 1)
+    return ((words >> SHIFTS) & 0xF).astype(np.uint8).reshape(rows, GRAPHICS_WIDTH)
+
+def pack_pixels(pixels):
+    """(rows, 320) colour indexes -> list of packed framebuffer words"""
+    nibbles = pixels.reshape(-1, PIXELS_PER_WORD).astype(np.uint32) << SHIFTS
+    return np.bitwise_or.reduce(nibbles, axis=1).tolist()
+
+def palette_rgb(entries):
+    """16 palette words (0xRGB) -> (16, 3) uint8 colours"""
+    entries = np.asarray(entries, dtype=np.uint32)
+    channels = np.stack([(entries >> 8) & 0xF, (entries >> 4) & 0xF, entries & 0xF], axis=1)
+    return (channels * 17).astype(np.uint8)
+
+def visible_rows(machine, base):
+    """Framebuffer rows lying wholly inside guest memory (the guest sets the base)"""
+    return max(0, min(GRAPHICS_HEIGHT, (len(machine.mem) - base) // WORDS_PER_ROW))
+
+def clip_box(x0, y0, x1, y1, rows=GRAPHICS_HEIGHT):
+    """Clip an inclusive box to the screen's first rows; None if nothing is left"""
+    x0, x1 = max(x0, 0), min(x1, GRAPHICS_WIDTH - 1)
+    y0, y1 = max(y0, 0), min(y1, rows - 1)
+    if x0 > x1 or y0 > y1:
+        return None
+    return x0, y0, x1, y1
+
+def update_rows(machine, base, y0, y1, paint):
+    """Unpack framebuffer rows y0..y1, let paint(pixels) edit them, write them back"""
+    start = base + y0 * WORDS_PER_ROW
+    end = base + (y1 + 1) * WORDS_PER_ROW
+    pixels = unpack_pixels(machine.mem[start:end], y1 - y0 + 1)
+    paint(pixels)
+    machine.mem[start:end] = pack_pixels(pixels)
+
+def plot_pixel(machine, base, x, y, colour):
+    if 0 <= x < GRAPHICS_WIDTH and 0 <= y < visible_rows(machine, base):
+        address = base + y * WORDS_PER_ROW + x // PIXELS_PER_WORD
+        shift = (x % PIXELS_PER_WORD) * 4
+        word = machine.mem[address] & ~(0xF << shift) & 0xFFFF
+        machine.mem[address] = word | ((colour & 0xF) << shift)
+
+def read_pixel(machine, base, x, y):
+    if 0 <= x < GRAPHICS_WIDTH and 0 <= y < visible_rows(machine, base):
+        word = machine.mem[base + y * WORDS_PER_ROW + x // PIXELS_PER_WORD]
+        return (word >> ((x % PIXELS_PER_WORD) * 4)) & 0xF
+    return 0
+
+def fill_rect(machine, base, x, y, width, height, colour):
+    box = clip_box(x, y, x + width - 1, y + height - 1, visible_rows(machine, base))
+    if box is None:
+        return
+    x0, y0, x1, y1 = box
+    if x0 == 0 and x1 == GRAPHICS_WIDTH - 1:
+        # Whole rows: one slice store of a repeated word
+        nibble = colour & 0xF
+        word = nibble | nibble << 4 | nibble << 8 | nibble << 12
+        start, end = base + y0 * WORDS_PER_ROW, base + (y1 + 1) * WORDS_PER_ROW
+        machine.mem[start:end] = [word] * (end - start)
+        return
+
+    def paint(pixels):
+        pixels[:, x0:x1 + 1] = colour & 0xF
+    update_rows(machine, base, y0, y1, paint)
+
+def draw_line(machine, base, x0, y0, x1, y1, colour):
+    steps = max(abs(x1 - x0), abs(y1 - y0)) + 1
+    xs = np.rint(np.linspace(x0, x1, steps)).astype(np.int64)
+    ys = np.rint(np.linspace(y0, y1, steps)).astype(np.int64)
+    rows = visible_rows(machine, base)
+    visible = (xs >= 0) & (xs < GRAPHICS_WIDTH) & (ys >= 0) & (ys < rows)
+    xs, ys = xs[visible], ys[visible]
+    if not len(xs):
+        return
+    top, bottom = int(ys.min()), int(ys.max())
+
+    def paint(pixels):
+        pixels[ys - top, xs] = colour & 0xF
+    update_rows(machine, base, top, bottom, paint)
+
+class GraphicsRenderer:
+    """Draws the mode 0x13 framebuffer with one NumPy conversion and one blit per frame"""
+    def __init__(self):
+        self.surface = pygame.Surface((GRAPHICS_WIDTH, GRAPHICS_HEIGHT))
+        self.rgb = np.zeros((GRAPHICS_WIDTH, GRAPHICS_HEIGHT, 3), dtype=np.uint8)
+
+    def render(self, machine, screen, base, palette):
+        words = machine.mem[base:base + FRAMEBUFFER_WORDS]
+        if len(words) < FRAMEBUFFER_WORDS:     # Framebuffer runs off the end of memory
+            words = list(words) + [0] * (FRAMEBUFFER_WORDS - len(words))
+        pixels = unpack_pixels(words, GRAPHICS_HEIGHT)
+        np.take(palette_rgb(palette), pixels.T, axis=0, out=self.rgb)
+        pygame.surfarray.blit_array(self.surface, self.rgb)
+        pygame.transform.scale(self.surface, screen.get_size(), screen)
@@ -0,0 +1,357 @@
+import secrets
+import sys
+import time
+from array import array
+from multiprocessing import resource_tracker, shared_memory
+from types import SimpleNamespace
+
+import pygame
+
+from cpu import GRAPHICS_MODE, FRAMEBUFFER_WORDS, pygame_key_codes
+from memory import DirtyMemory
+from IO import RingBuffer
+
+# Shared segment layout, in 32-bit words
+VIEW_MAGIC = 0x44564353     # 'SCVD'
+MAGIC = 0
+SEQUENCE = 1        # Seqlock counter: odd while a frame is being written
+FRAME = 2           # Frames published so far
+VIDEO_MODE = 3
+SCREEN_WIDTH = 4
+SCREEN_HEIGHT = 5
+CURSOR_X = 6
+CURSOR_Y = 7
+RUNNING = 8         # 1 while a machine is attached and running
+HEARTBEAT = 9       # Bumped by the viewer every frame; 0 while none is attached
+VIEWER = 10         # Token of the attached viewer; 0 while none is attached
+PALETTE = 16        # 16 words (0xRGB)
+VIDEO = 32          # Video memory, up to FRAMEBUFFER_WORDS words
+VIEW_WORDS = VIDEO + FRAMEBUFFER_WORDS
+
+KEY_RING = VIEW_WORDS * 4   # Byte offset of the viewer -> emulator key RingBuffer
+KEY_CAPACITY = 256
+SEGMENT_SIZE = KEY_RING + RingBuffer.size(KEY_CAPACITY)
+
+WAIT_INTERVAL = 0.01        # Seconds between key checks while the guest waits for input
+VIEWER_TIMEOUT = 1.0        # A viewer whose heartbeat stops this long has gone away
+CLAIM_SETTLE = 0.05         # Seconds a new viewer waits before checking its claim held
+
+class DisplayExport:
+    """Publishes a machine's screen through shared memory to viewer processes
+
+    The emulator process never touches pygame: publish() copies the video
+    memory, palette and cursor/mode words of the BDA into a named
+    SharedMemory segment and bumps a seqlock counter (odd while writing), so
+    readers take consistent frames without a lock. With a DirtyMemory only
+    the pages written since the last frame are copied, and an unchanged
+    screen publishes nothing. Keys typed in a viewer come back through a
+    RingBuffer in the same segment; while attached the export is the
+    machine's keyboard source and moves them into the BDA buffer whenever
+    the guest reads the keyboard.
+
+    One viewer at a time (python viewer.py --attach NAME) may connect and
+    disconnect while the session runs: the key ring and the heartbeat have
+    a single writer.
+    """
+    def __init__(self, machine, name=None):
+        self.machine = machine
+        self.segment = shared_memory.SharedMemory(name, create=True, size=SEGMENT_SIZE)
+        self.name = self.segment.name
+        self.words = self.segment.buf[:KEY_RING].cast('I')
+        self.words[MAGIC] = VIEW_MAGIC
+        self.keys = RingBuffer(self.segment.buf[KEY_RING:], KEY_CAPACITY)
+        self.tracker = None
+        self.layout = None          # (mode, width, height, base) of the last frame
+        self.previous = None        # Keyboard source replaced while attached
+        self.dropped = 0            # Keys the BDA buffer had no room for
+        self.attached = False
+        self.last_publish = 0.0
+        self.heartbeat = 0          # Last viewer heartbeat seen, and when
+        self.heartbeat_time = 0.0
+
+    def attach(self):
+        """Become the machine's keyboard source and start tracking video writes"""
+        if self.attached:
+            return
+        machine = self.machine
+        if type(machine.mem) is list:
+            machine.mem = DirtyMemory(machine.mem)
+        if isinstance(machine.mem, DirtyMemory):
+            self.tracker = machine.mem.tracker()
+        self.previous = machine.keyboard
+        machine.keyboard = self
+        self.layout = None
+        self.words[RUNNING] = 1
+        self.attached = True
+
+    def detach(self):
+        """Give the keyboard back; viewers keep showing the last frame"""
+        if self.attached:
+            self.machine.keyboard = self.previous
+            self.previous = None
+            self.tracker = None
+            self.words[RUNNING] = 0
+            self.attached = False
+
+    def publish(self):
+        """Copy the screen out if it changed; True if a new frame was published"""
+        m = self.machine
+        mode = m.read_bda_byte(m.VIDEO_MODE)
+        width = m.read_bda_byte(m.SCREEN_WIDTH)
+        height = m.read_bda_byte(m.SCREEN_HEIGHT)
+        base = m.read_bda_word(m.VIDEO_MEMORY_BASE)
+        length = FRAMEBUFFER_WORDS if mode == GRAPHICS_MODE else width * height
+        end = base + max(min(length, FRAMEBUFFER_WORDS, len(m.mem) - base), 0)
+
+        layout = (mode, width, height, base)
+        tracker = self.tracker
+        if tracker is None or layout != self.layout:
+            ranges = [(base, end)]
+        else:
+            ranges = tracker.dirty_ranges(base, end)
+            if not ranges and not tracker.is_dirty(m.BDA_BASE, m.BDA_BASE + 0x100):
+                return False
+        if tracker is not None:
+            tracker.clear()
+
+        words = self.words
+        words[SEQUENCE] += 1
+        words[VIDEO_MODE], words[SCREEN_WIDTH], words[SCREEN_HEIGHT] = mode, width, height
+        words[CURSOR_X] = m.read_bda_byte(m.CURSOR_X)
+        words[CURSOR_Y] = m.read_bda_byte(m.CURSOR_Y)
+        words[PALETTE:PALETTE + 16] = array('I', m.mem[m.PALETTE:m.PALETTE + 16])
+        for start, stop in ranges:
+            offset = VIDEO + start - base
+            words[offset:offset + stop - start] = array('I', m.mem[start:stop])
+        words[FRAME] += 1
+        words[SEQUENCE] += 1
+        self.layout = layout
+        return True
+
+    def poll(self, machine):
+        """Move keys typed in viewers into the BDA keyboard buffer"""
+        if self.previous is not None:
+            self.previous.poll(machine)
+        words = self.keys.words
+        if words[0] != words[1]:
+            keys = self.keys.drain(machine.keyboard_buffer_space())
+            self.dropped += len(keys) - machine.add_keys_to_buffer(keys)
+
+    def viewer_attached(self):
+        """True while the viewer's heartbeat is still advancing"""
+        heartbeat = self.words[HEARTBEAT]
+        now = time.monotonic()
+        if heartbeat != self.heartbeat:
+            self.heartbeat, self.heartbeat_time = heartbeat, now
+        return heartbeat != 0 and now - self.heartbeat_time < VIEWER_TIMEOUT
+
+    def wait(self, machine):
+        """The guest is blocked on input: show the screen and wait for a viewer's key
+
+        Returns False (no input available) at once when no viewer is
+        attached, or once the attached viewer goes away, so a headless
+        session never hangs on a keyboard read.
+        """
+        if self.previous is not None and self.previous.wait(machine):
+            return True
+        self.publish()
+        while not len(self.keys):
+            if not self.viewer_attached():
+                return False
+            time.sleep(WAIT_INTERVAL)
+        self.poll(machine)
+        return True
+
+    def run(self, instructions_per_frame=20000, fps=60):
+        """Run the machine headless, publishing at most fps frames a second"""
+        machine = self.machine
+        interval = 1 / fps
+        self.attach()
+        try:
+            while machine.run:
+                machine.run_for(instructions_per_frame)
+                now = time.monotonic()
+                if now - self.last_publish >= interval:
+                    self.publish()
+                    self.last_publish = now
+            self.publish()
+        finally:
+            self.detach()
+            machine.console.flush()
+
+    def close(self):
+        """Detach and remove the shared segment"""
+        self.detach()
+        self.keys.release()
+        self.words.release()
+        self.segment.close()
+        self.segment.unlink()
+
+class Viewer:
+    """Renders a DisplayExport in its own process and sends key presses back
+
+    A session has at most one viewer. A new one claims the VIEWER word with
+    a random token and raises ValueError while another viewer's heartbeat
+    is still advancing; it takes over from one that has stopped. The claim
+    is re-read after CLAIM_SETTLE and on every frame, so when two viewers
+    attach at once only the one whose token stuck stays.
+    """
+    def __init__(self, name):
+        self.segment = shared_memory.SharedMemory(name)
+        # Attaching registers the segment with this process's resource
+        # tracker, which would unlink it when the viewer exits
+        resource_tracker.unregister(self.segment._name, 'shared_memory')
+        self.words = self.segment.buf[:KEY_RING].cast('I')
+        if self.words[MAGIC] != VIEW_MAGIC:
+            self.close()
+            raise ValueError(f"{name} is not an exported display")
+        self.keys = RingBuffer(self.segment.buf[KEY_RING:], KEY_CAPACITY)
+        self.token = secrets.randbits(32) | 1
+        self.sequence = None
+        self.screen = None
+        self.font = None
+        self.graphics = None
+        try:
+            self.claim()
+        except ValueError:
+            self.close()
+            raise
+
+    def claim(self):
+        """Become the session's only viewer; ValueError if another one is live"""
+        words = self.words
+        owner, heartbeat = words[VIEWER], words[HEARTBEAT]
+        deadline = time.monotonic() + VIEWER_TIMEOUT
+        while words[VIEWER] and time.monotonic() < deadline:
+            if words[VIEWER] != owner or words[HEARTBEAT] != heartbeat:
+                raise ValueError("The display already has a viewer")
+            time.sleep(WAIT_INTERVAL)
+        words[VIEWER] = self.token
+        time.sleep(CLAIM_SETTLE)
+        if not self.owner():
+            raise ValueError("Another viewer attached to the display at the same time")
+        self.beat()
+
+    def owner(self):
+        """True while this viewer holds the session"""
+        return self.words[VIEWER] == self.token
+
+    def beat(self):
+        """Tell the emulator this viewer is still there"""
+        self.words[HEARTBEAT] = (self.words[HEARTBEAT] + 1) & 0xFFFFFFFF or 1
+
+    def snapshot(self, timeout=VIEWER_TIMEOUT):
+        """Consistent copy of the exported words, or None if no new frame
+
+        Also None if a frame is still half-written after timeout seconds,
+        as when the emulator died while publishing it.
+        """
+        words = self.words
+        deadline = time.monotonic() + timeout
+        while True:
+            sequence = words[SEQUENCE]
+            if sequence == self.sequence:
+                return None
+            if not sequence & 1:        # Odd while the frame is being written
+                data = words[:VIEW_WORDS].tobytes()
+                if words[SEQUENCE] == sequence:
+                    self.sequence = sequence
+                    frame = array('I')
+                    frame.frombytes(data)
+                    return frame
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(0)
+
+    def send_key(self, key):
+        """Queue a key for the guest; False if the emulator is not keeping up"""
+        return self.owner() and self.keys.push(key)
+
+    def render(self, frame):
+        self.screen.fill((0, 0, 0))
+        if frame[VIDEO_MODE] == GRAPHICS_MODE:
+            if self.graphics is None:
+                from video import GraphicsRenderer
+                self.graphics = GraphicsRenderer()
+            self.graphics.render(SimpleNamespace(mem=frame), self.screen, VIDEO,
+                                 frame[PALETTE:PALETTE + 16])
+        elif frame[VIDEO_MODE] == 0x03:
+            self.render_text(frame)
+
+    def render_text(self, frame):
+        char_width, char_height = 8, 16
+        width, height = frame[SCREEN_WIDTH], frame[SCREEN_HEIGHT]
+        for y in range(height):
+            for x in range(width):
+                index = VIDEO + y * width + x
+                if index >= len(frame):
+                    break
+                char_code = frame[index]
+                if char_code == 0:
+                    continue
+                char = chr(char_code) if 32 <= char_code <= 126 else '?'
+                text_surface = self.font.render(char, True, (255, 255, 255))
+                self.screen.blit(text_surface, (x * char_width, y * char_height))
+        cursor = (frame[CURSOR_X] * char_width, frame[CURSOR_Y] * char_height, char_width, 2)
+        pygame.draw.rect(self.screen, (255, 255, 255), cursor)
+
+    def run(self, fps=60):
+        """Show frames until the window is closed (the session keeps running)"""
+        pygame.init()
+        self.screen = pygame.display.set_mode((640, 400))
+        self.font = pygame.font.Font(None, 24)
+        clock = pygame.time.Clock()
+        running = None
+        try:
+            while self.owner():
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        return
+                    if event.type == pygame.KEYDOWN:
+                        for key in pygame_key_codes(event):
+                            self.send_key(key)
+
+                if running != self.words[RUNNING]:
+                    running = self.words[RUNNING]
+                    pygame.display.set_caption(
+                        "CPU Emulator" if running else "CPU Emulator (stopped)")
+                self.beat()
+                frame = self.snapshot()
+                if frame is not None:
+                    self.render(frame)
+                pygame.display.flip()
+                clock.tick(fps)
+        finally:
+            pygame.quit()
+            self.close()
+
+    def close(self):
+        if hasattr(self, 'token') and self.owner():
+            self.words[HEARTBEAT] = 0
+            self.words[VIEWER] = 0
+        if hasattr(self, 'keys'):
+            self.keys.release()
+        self.words.release()
+        self.segment.close()
+
+if __name__ == '__main__':
+    # python viewer.py program.asm       run headless, exporting the display
+    # python viewer.py --attach NAME     view a running session
+    if sys.argv[1] == '--attach':
+        Viewer(sys.argv[2]).run()
+    else:
+        from codecache import CodeCache
+        from cpu import STACK_TOP, cpu
+
+        with open(sys.argv[1]) as source:
+            image = CodeCache().assemble(source.read(), sys.argv[1])
+        machine = cpu()
+        machine.mem[:len(image)] = image
+        machine.regs[7] = STACK_TOP
+        export = DisplayExport(machine)
+        print(f"Display exported; attach with: python viewer.py --attach {export.name}",
+              file=sys.stderr)
+        try:
+            export.run()
+        finally:
+            export.close()